@@ -0,0 +1,721 @@
+"""
+This module contains benchmarks for the slow parts of the pipeline.
+
+Each benchmark returns a dict of timings so that runs can be compared
+before and after a change. Where a function was rewritten for speed,
+the original implementation is kept here as the baseline.
+
+`run_benchmark_suite` times the main stages of the pipeline end to end
+on synthetic data from `fixtures`, so it runs without the real dump.
+
+"""
+
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from . import checkpoints
+from . import data
+from . import fixtures
+from . import models
+from . import parse_cache
+from . import transforms
+from . import utils
+from . import wikipedia
+
+
+def benchmark_pattern_matching(num_pages=10000, repeat=3):
+    """
+    Time the title and category checks done for each page of the dump.
+
+    Compares the original pattern by pattern `re.search` loop with
+    the combined matchers used by `wikipedia.get_pages_with_categories`.
+
+    Args:
+        num_pages (int): The number of pages to sample from the start
+            of the dump.
+        repeat (int): The number of times to repeat each timing. The
+            fastest run is reported.
+
+    Returns:
+        Dict[str, float]: The per page cost of each approach in
+            microseconds.
+
+    """
+    query = data._get_character_query()
+    black_list = wikipedia._get_title_black_list(query['title_black_list'])
+    category_patterns = [r'\[Category:' + p + r'\]' for p in query['category_patterns']]
+
+    records = itertools.islice(wikipedia.get_page_record_iterator(workers=1), num_pages)
+    pages = [(title, text) for title, _, _, text in records]
+
+    def run_loop():
+        for title, text in pages:
+            _matches_patterns_loop(black_list, title)
+            _matches_patterns_loop(category_patterns, text)
+
+    def run_compiled():
+        black_list_matcher = utils.compile_patterns(black_list)
+        category_matcher = wikipedia._get_category_matcher(query['category_patterns'])
+        for title, text in pages:
+            black_list_matcher.search(title)
+            category_matcher.search(text)
+
+    return {
+        'loop_us_per_page': _time(run_loop, repeat) / len(pages) * 1e6,
+        'compiled_us_per_page': _time(run_compiled, repeat) / len(pages) * 1e6
+    }
+
+
+def benchmark_de_wiki(name_to_article=None, repeat=3):
+    """
+    Time `wikipedia.de_wiki` against the original regex implementation.
+
+    Args:
+        name_to_article (Dict[str, str]): The articles to strip. Defaults
+            to the regression corpus.
+        repeat (int): The number of times to repeat each timing.
+
+    Returns:
+        Dict[str, float]: The per article cost of each implementation
+            in milliseconds.
+
+    """
+    if name_to_article is None:
+        name_to_article = DE_WIKI_REGRESSION_CORPUS
+    articles = list(name_to_article.values())
+
+    def run(func):
+        return lambda: [func(article, remove_section_names=True) for article in articles]
+
+    return {
+        'regex_ms_per_article': _time(run(_de_wiki_regex), repeat) / len(articles) * 1e3,
+        'scanner_ms_per_article': _time(run(wikipedia.de_wiki), repeat) / len(articles) * 1e3
+    }
+
+
+def check_de_wiki_regression(name_to_article=None):
+    """
+    Compare the output of `wikipedia.de_wiki` with the original regexes.
+
+    The outputs only differ for templates nested more than three deep,
+    which the original only partially removed. See `wikipedia.de_wiki`.
+
+    Args:
+        name_to_article (Dict[str, str]): The articles to compare.
+            Defaults to the regression corpus.
+
+    Returns:
+        Dict[str, Tuple[str, str]]: A dictionary mapping the names of
+            the articles whose outputs differ to the (original, new)
+            outputs.
+
+    """
+    if name_to_article is None:
+        name_to_article = DE_WIKI_REGRESSION_CORPUS
+    mismatches = {}
+    for name, article in name_to_article.items():
+        for remove_section_names in (False, True):
+            expected = _de_wiki_regex(article, remove_section_names=remove_section_names)
+            actual = wikipedia.de_wiki(article, remove_section_names=remove_section_names)
+            if expected != actual:
+                mismatches[name] = (expected, actual)
+    return mismatches
+
+
+def benchmark_black_list_removal(name_to_article=None, repeat=3):
+    """
+    Time `transforms.remove_black_listed_words` against the original loop.
+
+    Args:
+        name_to_article (Dict[str, str]): The articles to filter. Defaults
+            to the regression corpus after `wikipedia.de_wiki`.
+        repeat (int): The number of times to repeat each timing.
+
+    Returns:
+        Dict[str, float]: The per article cost of each implementation
+            in milliseconds.
+
+    """
+    if name_to_article is None:
+        name_to_article = {name: wikipedia.de_wiki(article) 
+                           for name, article in DE_WIKI_REGRESSION_CORPUS.items()}
+    articles = list(name_to_article.values())
+
+    def run(func):
+        return lambda: [func(article) for article in articles]
+
+    return {
+        'loop_ms_per_article': _time(run(_remove_black_listed_words_loop), repeat) / len(articles) * 1e3,
+        'compiled_ms_per_article': _time(run(transforms.remove_black_listed_words), repeat) / len(articles) * 1e3
+    }
+
+
+def benchmark_subject_selection(num_sentences=200, repeat=3):
+    """
+    Time the subject selection in `transforms.get_subject_tokens`.
+
+    A long paragraph that mentions the subject in every sentence is 
+    parsed once with the large model, then the original pairwise
+    selection is timed against the current one. Parsing isn't timed.
+
+    Args:
+        num_sentences (int): The number of sentences in the paragraph.
+        repeat (int): The number of times to repeat each timing.
+
+    Returns:
+        Dict[str, float]: The cost of each implementation per paragraph
+            in milliseconds.
+
+    """
+    target_name = 'Prince Zuko'
+    sentences = [
+        'Zuko chased the Avatar across the world, and he never gave up.',
+        'Zuko and Iroh traveled to Ba Sing Se where he worked in a tea shop.',
+        'After Azula struck, Zuko said that he would teach Aang firebending.',
+    ]
+    paragraph = ' '.join(sentences[i % len(sentences)] for i in range(num_sentences))
+    parsed = transforms.get_large_model()(paragraph)
+
+    def run(func):
+        return lambda: func(parsed, target_name)
+
+    return {
+        'pairwise_ms': _time(run(_select_subject_tokens_pairwise), repeat) * 1e3,
+        'linear_ms': _time(run(transforms._select_subject_tokens), repeat) * 1e3
+    }
+
+
+def benchmark_phrase_rendering(num_sentences=200, repeat=3):
+    """
+    Time the rendering of extracted phrases in `extract_phrases_about_subject`.
+
+    The original renders each phrase by calling `tokens_to_str` twice,
+    which this compares with `transforms.extracted_phrase_to_strs`.
+    Parsing and phrase extraction aren't timed.
+
+    Args:
+        num_sentences (int): The number of sentences to extract phrases 
+            from.
+        repeat (int): The number of times to repeat each timing.
+
+    Returns:
+        Dict[str, float]: The per phrase cost of each implementation in
+            microseconds.
+
+    """
+    target_name = 'Prince Zuko'
+    sentences = [
+        'Zuko chased the "Avatar" across the world, and he never gave up;',
+        'Zuko and Iroh traveled to Ba Sing Se, where he worked in a tea shop for 3 years.',
+        "Zuko didn't know that Azula's plan would take the Earth Kingdom's capital.",
+    ]
+    paragraph = ' '.join(sentences[i % len(sentences)] for i in range(num_sentences))
+    parsed = transforms.get_large_model()(paragraph)
+    extracted = [transforms.extract_phrase(token, target_name) 
+                 for token in transforms._select_subject_tokens(parsed, target_name)]
+
+    def run_original():
+        for tokens in extracted:
+            # The original mutated its input, so give it a copy.
+            tokens = list(tokens)
+            _tokens_to_str_original(tokens, spaces_before_punct=True, lower_case=True, 
+                                    remove_numbers=True)
+            _tokens_to_str_original(tokens, remove_punct=True, convert_to_lemmas=True, 
+                                    remove_stop_words=True, lower_case=True, remove_numbers=True)
+
+    def run_single_pass():
+        for tokens in extracted:
+            transforms.extracted_phrase_to_strs(tokens)
+
+    return {
+        'original_us_per_phrase': _time(run_original, repeat) / len(extracted) * 1e6,
+        'single_pass_us_per_phrase': _time(run_single_pass, repeat) / len(extracted) * 1e6
+    }
+
+
+def run_benchmark_suite(stages=None, num_pages=2000, num_articles=200, workers=1, seed=0):
+    """
+    Time the main stages of the pipeline on synthetic data.
+
+    A synthetic multistream dump of `num_pages` pages and 
+    `num_articles` character articles are generated in a temporary
+    directory, and `wikipedia.DUMP_PATH` points at the dump while the 
+    stages run. The parse cache is turned off so that stages that parse
+    are timed parsing. Stages that need a spacy model that isn't 
+    installed are skipped.
+
+    Each stage is run twice: once to time it and once under 
+    `tracemalloc` to find the peak memory it allocates. The peak only
+    counts memory allocated through Python in this process, so it 
+    leaves out worker processes.
+
+    Args:
+        stages (Iterable[str]): The names of the stages to run, from 
+            `BENCHMARK_STAGES`. Defaults to all of them.
+        num_pages (int): The number of pages in the synthetic dump.
+        num_articles (int): The number of synthetic articles.
+        workers (int): The number of workers used by stages that take
+            them.
+        seed (int): The random seed of the synthetic data.
+
+    Returns:
+        Dict[str, dict]: The stats of each stage: the `seconds` it took, 
+            the number of `items` and `bytes` it processed, 
+            `items_per_sec`, `mb_per_sec`, and `peak_mb`. Skipped stages
+            have a `skipped` key with the reason instead.
+
+    """
+    if stages is None:
+        stages = BENCHMARK_STAGES
+    with tempfile.TemporaryDirectory() as dir_path:
+        dump_path = os.path.join(dir_path, 'synthetic-pages-articles-multistream.xml.bz2')
+        context = {
+            'num_pages': num_pages,
+            'dump_size': fixtures.make_synthetic_dump(dump_path, num_pages, seed=seed),
+            'articles': fixtures.make_synthetic_articles(num_articles, seed=seed),
+            'workers': workers
+        }
+        context['de_wikied'] = {name: wikipedia.de_wiki(article) 
+                                for name, article in context['articles'].items()}
+        
+        old_dump_path = wikipedia.DUMP_PATH
+        old_progress_hook = checkpoints._progress_hook
+        wikipedia.DUMP_PATH = dump_path
+        checkpoints.set_progress_hook(None)
+        parse_cache_enabled = parse_cache.set_enabled(False)
+        try:
+            return {stage: _run_stage(BENCHMARK_STAGES[stage], context) for stage in stages}
+        finally:
+            wikipedia.DUMP_PATH = old_dump_path
+            checkpoints.set_progress_hook(old_progress_hook)
+            parse_cache.set_enabled(parse_cache_enabled)
+
+
+def _run_stage(stage, context):
+    """Time a stage of the benchmark suite and measure its peak memory."""
+    setup, stage = stage
+    try:
+        if setup is not None:
+            setup(context)
+        start = time.perf_counter()
+        items, num_bytes = stage(context)
+        seconds = time.perf_counter() - start
+    except OSError as e:
+        # Spacy raises an OSError when a model isn't installed.
+        return {'skipped': str(e)}
+
+    tracemalloc.start()
+    try:
+        stage(context)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    
+    return {
+        'seconds': seconds,
+        'items': items,
+        'bytes': num_bytes,
+        'items_per_sec': items / seconds if seconds > 0 else 0.0,
+        'mb_per_sec': num_bytes / 2 ** 20 / seconds if seconds > 0 else 0.0,
+        'peak_mb': peak / 2 ** 20
+    }
+
+
+def _run_article_iterator(context):
+    num_articles = num_bytes = 0
+    for article in wikipedia.get_article_iterator(workers=context['workers']):
+        num_articles += 1
+        num_bytes += len(article)
+    return num_articles, num_bytes
+
+
+def _run_pages_with_category(context):
+    wikipedia.get_pages_with_category(['Fictional characters'], title_black_list=['^Talk:'])
+    return context['num_pages'], context['dump_size']
+
+
+def _run_de_wiki(context):
+    articles = context['articles'].values()
+    for article in articles:
+        wikipedia.de_wiki(article, remove_section_names=True)
+    return len(articles), sum(map(len, articles))
+
+
+def _run_black_list_removal(context):
+    texts = context['de_wikied'].values()
+    for text in texts:
+        transforms.remove_black_listed_words(text)
+    return len(texts), sum(map(len, texts))
+
+
+def _run_subject_tokens(context):
+    paragraphs = _get_subject_paragraphs(context)
+    for name, paragraph in paragraphs:
+        transforms.get_subject_tokens(paragraph, name)
+    return len(paragraphs), sum(len(paragraph) for _, paragraph in paragraphs)
+
+
+def _extract_phrases(context):
+    context['phrases'] = [
+        transforms.extract_phrase(token, name) 
+        for name, paragraph in _get_subject_paragraphs(context)
+        for token in transforms.get_subject_tokens(paragraph, name)
+    ]
+
+
+def _run_tokens_to_str(context):
+    for tokens in context['phrases']:
+        transforms.tokens_to_str(tokens, spaces_before_punct=True, lower_case=True, 
+                                 remove_numbers=True)
+    return len(context['phrases']), 0
+
+
+def _run_doc2vec_training(context):
+    articles = _get_training_articles(context)
+    models.train_doc2vec_model(articles, epochs=5, workers=context['workers'])
+    return len(articles), sum(map(len, articles.values()))
+
+
+def _run_lda_training(context):
+    articles = _get_training_articles(context)
+    models.train_lda_model(articles, passes=2, workers=context['workers'])
+    return len(articles), sum(map(len, articles.values()))
+
+
+def _run_out_of_core_lda_training(context):
+    articles = _get_training_articles(context)
+    models.train_lda_model(articles, passes=2, workers=context['workers'], out_of_core=True, 
+                           no_below=2)
+    return len(articles), sum(map(len, articles.values()))
+
+
+def _get_subject_paragraphs(context):
+    """Return (name, paragraph) pairs of the synthetic articles."""
+    return [(name, paragraph) for name, text in context['de_wikied'].items() 
+            for paragraph in text.split('\n\n') if paragraph]
+
+
+def _get_training_articles(context):
+    """Return the synthetic articles lower cased and split on white space."""
+    return {name: ' '.join(text.lower().split()) for name, text in context['de_wikied'].items()}
+
+
+# The stages of `run_benchmark_suite`, as (setup, stage) pairs. Only the
+# stage is timed.
+BENCHMARK_STAGES = {
+    'get_article_iterator': (None, _run_article_iterator),
+    'get_pages_with_category': (None, _run_pages_with_category),
+    'de_wiki': (None, _run_de_wiki),
+    'remove_black_listed_words': (None, _run_black_list_removal),
+    'get_subject_tokens': (None, _run_subject_tokens),
+    'tokens_to_str': (_extract_phrases, _run_tokens_to_str),
+    'train_doc2vec_model': (None, _run_doc2vec_training),
+    'train_lda_model': (None, _run_lda_training),
+    'train_lda_model_out_of_core': (None, _run_out_of_core_lda_training),
+}
+
+
+def benchmark_import_time(modules=None, repeat=3):
+    """
+    Time importing each `hwtf` module in a fresh interpreter.
+
+    Each import is timed with `python -X importtime`, which reports the
+    cumulative time spent importing a module and its dependencies.
+
+    Args:
+        modules (Iterable[str]): The modules to import. Defaults to 
+            `IMPORT_TIME_BUDGETS_MS`.
+        repeat (int): The number of times to repeat each timing.
+
+    Returns:
+        Dict[str, float]: The import time of each module in milliseconds.
+
+    """
+    if modules is None:
+        modules = IMPORT_TIME_BUDGETS_MS
+    timings = {}
+    for module in modules:
+        runs = []
+        for _ in range(repeat):
+            result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                    capture_output=True, text=True, check=True)
+            for line in result.stderr.splitlines():
+                fields = line.split('|')
+                if len(fields) == 3 and fields[2].strip() == module:
+                    runs.append(int(fields[1]) / 1e3)
+        timings[module] = min(runs)
+    return timings
+
+
+def check_import_time(budgets=None, repeat=3):
+    """
+    Check that `hwtf` modules import quickly and without heavy dependencies.
+
+    Args:
+        budgets (Dict[str, float]): The most milliseconds each module 
+            may take to import. Defaults to `IMPORT_TIME_BUDGETS_MS`.
+        repeat (int): The number of times to repeat each timing.
+
+    Returns:
+        Dict[str, str]: A dictionary mapping each module that's over 
+            budget or imports a module in `DEFERRED_IMPORTS` to a 
+            description of the problem.
+
+    """
+    if budgets is None:
+        budgets = IMPORT_TIME_BUDGETS_MS
+    problems = {}
+    timings = benchmark_import_time(budgets, repeat=repeat)
+    for module, budget in budgets.items():
+        code = (f'import sys, json, {module}; '
+                f'print(json.dumps([m for m in {list(DEFERRED_IMPORTS)!r} if m in sys.modules]))')
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        imported = json.loads(result.stdout)
+        if imported:
+            problems[module] = f"imports {', '.join(imported)}"
+        elif timings[module] > budget:
+            problems[module] = f'took {timings[module]:.1f} ms, over the {budget} ms budget'
+    return problems
+
+
+# The packages that `hwtf` modules should only import when they're used.
+DEFERRED_IMPORTS = ('spacy', 'sklearn', 'gensim', 'lxml', 'joblib')
+
+# Generous import time budgets. Modules that use numpy throughout import 
+# it eagerly, which accounts for most of their budget.
+IMPORT_TIME_BUDGETS_MS = {
+    'hwtf.utils': 50,
+    'hwtf.checkpoints': 50,
+    'hwtf.store': 50,
+    'hwtf.parse_cache': 100,
+    'hwtf.transforms': 100,
+    'hwtf.wikipedia': 150,
+    'hwtf.data': 150,
+    'hwtf.models': 100,
+    'hwtf.neighbors': 400,
+    'hwtf.clustering': 400,
+    'hwtf.inference': 500,
+}
+
+
+def _de_wiki_regex(text, remove_section_names=False, template_passes=3):
+    """
+    The original `wikipedia.de_wiki`.
+
+    `template_passes` is the number of times the template pattern is
+    applied, 3 in the original. With None it is applied until nothing
+    changes, which is what `wikipedia.de_wiki` matches exactly.
+
+    """
+    flags = re.MULTILINE | re.DOTALL | re.IGNORECASE
+    text = re.sub(r'\<ref.*?\</ref\>', '', text, flags=flags)
+    passes = 0
+    while template_passes is None or passes < template_passes:
+        text, num_removed = re.subn(r'{{[^{]+?}}', '', text, flags=flags)
+        passes += 1
+        if not num_removed:
+            break
+
+    patterns_to_remove = [
+        r'<!--.*?-->',  # These are Comments in Wikitext.
+        r'\[\[File:.+?(?=\n)',
+        r'{\|.*?\|}',
+        r'<\w+>.*?</\w+>',
+        r'={2,10} ((See also)|(Notes)|(Sources)|(References)|(Bibliography)) ={2,10}.*',
+    ]
+
+    for pattern in patterns_to_remove:
+        text = re.sub(pattern, '', text, flags=flags)
+
+    if remove_section_names:
+        text = re.sub(r'={2,}.*?={2,}', '', text)
+
+    patterns_to_sub = [
+        (r'\[\[([^|]+?)\]\]', r'\1'),
+        (r'\[\[(.+?)\|(.+?)\]\]', r'\2'),
+        (r"'''(.+?)'''", r'\1'),
+        (r"''(.+?)''", r"\1"),
+        (r"<nowiki>(.+?)</nowiki>", r"\1"),
+        (r'\n+', r'\n\n'),
+        (r'  ', ' '),
+        (r'&nbsp;', ' ')
+    ]
+
+    for pattern, replacement in patterns_to_sub:
+        text = re.sub(pattern, replacement, text)
+
+    return text.strip()
+
+
+# Hand written Wikitext covering the markup that de_wiki handles.
+DE_WIKI_REGRESSION_CORPUS = {
+    'infobox': (
+        "{{Infobox character\n| name = Zuko\n| image = {{nihongo|'''Prince Zuko'''|祖寇|Zǔ Kòu}}\n"
+        "| first = [[The Boy in the Iceberg]]\n}}\n'''Zuko''' is a fictional character in "
+        "[[Nickelodeon]]'s ''[[Avatar: The Last Airbender]]''.<ref>{{cite web|url=http://x.com"
+        "|title=Zuko}}</ref> He is voiced by [[Dante Basco]].{{citation needed|date=May 2018}}\n"
+    ),
+    'sections': (
+        "Intro text.\n\n== Appearances ==\n=== In ''Avatar'' ===\nZuko is the [[Fire Nation|"
+        "prince]] of the Fire Nation.<ref name=\"a\" /> He was [[banishment|banished]] by his "
+        "father.<ref name=\"b\">Episode 12.</ref>\n\n==== Season 1 ====\nMore text&nbsp;here."
+        "\n\n== References ==\n{{reflist}}\n[[Category:Fictional princes]]\n"
+    ),
+    'files_and_tables': (
+        "[[File:Zuko.png|thumb|Zuko as he appears in [[Book One: Water]]]]\nZuko hunts the "
+        "Avatar.\n{| class=\"wikitable\"\n|-\n! Season !! Episodes\n|-\n| 1 || 20\n|}\n"
+        "[[Image:Scar.jpg|thumb|right|His [[scar]] and [[Iroh|uncle]]]]\nHe returns home.\n"
+    ),
+    'comments_and_tags': (
+        "<!-- Please don't change this without discussion. -->Zuko<small>(ズコ)</small> "
+        "is the son of [[Ozai]].<br />His sister is [[Azula]].<!-- multi\nline -->\n\n\n"
+        "He is often called the <nowiki>Prince</nowiki>.\n== See also ==\n* [[Iroh]]\n"
+    ),
+    'nested_links': (
+        "'''''Zuko''''' is a [[character (arts)|character]] who [[redemption|redeems]] "
+        "himself.<ref>[[Bryan Konietzko|Konietzko]], p. 4.</ref> [[Aang]] and [[Katara]] "
+        "trust him in [[The Western Air Temple]].\n"
+    ),
+}
+
+
+def _remove_black_listed_words_loop(text, words=None):
+    """
+    The original `transforms.remove_black_listed_words`.
+
+    `words` are the terms to remove, longest first, and default to the 
+    black list.
+
+    """
+    if words is None:
+        words = transforms._word_black_list
+    for pattern in words:
+        pattern = r'\b' + pattern + r'\b'
+        text = re.sub(pattern, '', text, flags=re.IGNORECASE)
+    text = re.sub(r'\s{2,}', ' ', text)
+    text = text.strip()
+    return text
+
+
+def _select_subject_tokens_pairwise(parsed, target_name):
+    """The original subject selection in `transforms.get_subject_tokens`."""
+    is_subject = []
+    subjects_of_interest = []
+    for token in parsed:
+        token_is_subject = ('nsubj' in token.dep_ 
+                            and token.pos_ == 'PROPN' 
+                            and token.text.lower() in target_name.lower())
+        token_is_subj_pron = (token.pos_ == 'PRON' and is_subject and is_subject[-1])
+        if token_is_subject or token_is_subj_pron:
+            is_subject.append(True)
+            subjects_of_interest.append(token)
+        else:
+            is_subject.append(False)
+    
+    output = []
+    for token in subjects_of_interest:
+        for other_token in subjects_of_interest:
+            if token != other_token and other_token.head.is_ancestor(token):
+                break
+        else:
+            output.append(token)
+    
+    return output
+
+
+def _tokens_to_str_original(tokens, spaces_before_punct=False, cap_first_word=True, 
+                             add_period=True, convert_to_lemmas=False, remove_stop_words=False, 
+                             remove_punct=False, lower_case=False, remove_numbers=False):    
+    """The original `transforms.tokens_to_str`."""
+    
+    if add_period and not remove_punct:
+        if isinstance(tokens[-1], str) or not tokens[-1].is_punct:
+            tokens.append('.')
+        elif tokens[-1].is_punct:
+            if tokens[-1].text in ',:;':
+                tokens.pop()
+                tokens.append('.')    
+    
+    strings = []
+    for i, token in enumerate(tokens):
+        is_first_word = i == 0
+        
+        # TODO: Most of these, especially skip_space, can be simplified
+        # by looking at the stings and not the tokens. Much of the
+        # complexity is dealing with the fact that (1) the inputs can
+        # either either strings or spacy tokens.
+        cur_not_string = not isinstance(token, str)
+        last_two_not_str = i >= 1 and cur_not_string and not isinstance(tokens[i - 1], str)
+        last_three_not_str = i >= 2 and last_two_not_str and not isinstance(tokens[i - 2], str)
+        is_hyphen = cur_not_string and token.text == '-'
+        is_word_after_hyphen = last_two_not_str and not token.is_punct and tokens[i - 1].text == '-'    
+        cur_is_punct = ((cur_not_string and (token.is_punct or token.dep_ == 'case' or token.text == "n't")) 
+                        or not cur_not_string and token in ('.'))
+        is_open_quote = cur_not_string and token.text == '"' and sum(1 for s in strings if s == '"') % 2 == 0
+        last_is_open_quote = strings and strings[-1] == '"' and sum(1 for s in strings if s == '"') % 2 != 0
+        skip_space = is_first_word or ((is_hyphen or is_word_after_hyphen) and not remove_punct)
+        
+        if remove_stop_words and cur_not_string and token.is_stop:
+            continue
+            
+        if remove_numbers and cur_not_string and token.pos_ == 'NUM':
+            continue
+            
+        if remove_punct and cur_not_string and token.is_punct:
+            continue
+        
+        if not spaces_before_punct:
+            skip_space = True if cur_is_punct and not spaces_before_punct else skip_space
+            skip_space = False if is_open_quote else skip_space
+            skip_space = True if last_is_open_quote else skip_space
+        
+        if not isinstance(token, str):
+            if not convert_to_lemmas:
+                token = token.text
+            else:
+                token = token.lemma_
+        
+        token = token.strip()
+        if not token:
+            continue
+        
+        if not skip_space:
+            strings.append(' ')
+            
+        if cap_first_word and not lower_case and is_first_word and '<' not in token:
+            token = token.capitalize()
+            
+        if lower_case and '<' not in token:
+            token = token.lower()
+            
+        strings.append(token)
+    
+    # TODO the strip here shouldn't be needed, but some of them are starting with 
+    # with blanks in lemmatized version. It's probably the space being added after 
+    # `if not skip_space:`
+    return ''.join(strings).strip()
+
+
+def _matches_patterns_loop(patterns, text, flags=re.IGNORECASE):
+    """The original `utils.matches_patterns`."""
+    for pattern in patterns:
+        match = re.search(pattern, text, flags=flags)
+        if match is not None:
+            return True
+    return False
+
+
+def _time(func, repeat=3):
+    """Return the fastest wall time of `repeat` calls to `func`."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
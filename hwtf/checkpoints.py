@@ -0,0 +1,232 @@
+"""
+This module contains checkpointing and progress reporting for the long
+running stages of the pipeline.
+
+A `Checkpoint` saves a stage's results in numbered shard files under
+`utils.data_dir_path` as they're produced, so that a stage that dies
+part way through can resume from its last completed shard. A `Progress`
+tracks a stage's throughput and passes it to a progress hook, which is
+any callable that takes a stats dict. The default hook prints.
+
+"""
+
+import os
+import shutil
+import time
+from . import utils
+
+
+CHECKPOINT_DIR_NAME = 'checkpoints'
+
+
+#
+# CHECKPOINTS
+#
+
+
+class Checkpoint:
+    """
+    The results of a stage, saved incrementally in shard files.
+
+    Results are added as (key, value) pairs and saved every
+    `shard_size` results, along with an optional state object that
+    describes how far the stage has gotten (e.g. the number of input
+    items consumed). When a checkpoint with the same name is opened
+    again, the saved results and the last saved state are loaded.
+
+    Args:
+        name (str): The name of the checkpoint directory. This should
+            identify both the stage and any options that change its
+            output.
+        shard_size (int): The number of results per shard.
+        resume (bool): Whether to load existing shards. If false, any
+            existing shards are deleted.
+
+    Attributes:
+        results (Dict[Any, Any]): The results loaded from the shards
+            plus the results added since.
+        state (Any): The state saved with the last shard, or None.
+
+    """
+
+    def __init__(self, name, shard_size=1000, resume=True):
+        if '/' in name:
+            raise ValueError('`name` should be a directory name, not a path.')
+        self.dir_path = os.path.join(utils.data_dir_path, CHECKPOINT_DIR_NAME, name)
+        self.shard_size = shard_size
+        self.results = {}
+        self.state = None
+        self._pending = []
+        self._num_shards = 0
+
+        if not resume:
+            self.delete()
+        os.makedirs(self.dir_path, exist_ok=True)
+
+        import joblib
+        shard_names = sorted(n for n in os.listdir(self.dir_path) if n.endswith('.pickle'))
+        for shard_name in shard_names:
+            shard = joblib.load(os.path.join(self.dir_path, shard_name))
+            self.results.update(shard['results'])
+            self.state = shard['state']
+        self._num_shards = len(shard_names)
+
+    def __contains__(self, key):
+        return key in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+    def add(self, key, value, state=None):
+        """Add a result, saving a shard if `shard_size` results are pending."""
+        self.add_many([(key, value)], state=state)
+
+    def add_many(self, items, state=None):
+        """
+        Add (key, value) pairs, then save a shard if `shard_size` results
+        are pending.
+
+        Unlike calling `add` for each pair, no shard is saved until all
+        of them have been added, so `state` only has to describe the
+        stage's progress once they all are.
+
+        """
+        for key, value in items:
+            self.results[key] = value
+            self._pending.append((key, value))
+        if len(self._pending) >= self.shard_size:
+            self.save(state)
+
+    def save(self, state=None):
+        """Save the pending results and `state` as a new shard."""
+        self.state = state
+        self._num_shards += 1
+        os.makedirs(self.dir_path, exist_ok=True)
+        path = os.path.join(self.dir_path, f'{self._num_shards:06d}.pickle')
+        # Write to a temporary file first so that a crash mid write
+        # doesn't leave a corrupt shard behind.
+        import joblib
+        temp_path = path + '.tmp'
+        joblib.dump({'results': self._pending, 'state': state}, temp_path)
+        os.replace(temp_path, path)
+        self._pending = []
+
+    def delete(self):
+        """Delete the checkpoint's shards."""
+        if os.path.isdir(self.dir_path):
+            shutil.rmtree(self.dir_path)
+        self._num_shards = 0
+
+
+#
+# PROGRESS REPORTING
+#
+
+
+def print_progress(stats):
+    """The default progress hook, which prints a line of stats."""
+    line = f"{stats['stage']}: {stats['items']}"
+    if stats['total'] is not None:
+        line += f"/{stats['total']}"
+    line += f" items, {stats['items_per_sec']:.1f} items/s"
+    line += f", {stats['bytes_per_sec'] / 2 ** 20:.2f} MB/s"
+    if stats['eta'] is not None:
+        line += f", ETA {_format_seconds(stats['eta'])}"
+    if stats['last'] is not None:
+        line += f", Last: {stats['last']}"
+    print(line)
+
+
+def set_progress_hook(hook):
+    """Set the progress hook used when a stage isn't given one. None silences progress."""
+    global _progress_hook
+    _progress_hook = hook
+
+
+_progress_hook = print_progress
+
+
+class Progress:
+    """
+    Track the throughput of a stage and report it to a progress hook.
+
+    The hook is called with a dict containing the `stage` name, the
+    number of `items` and `bytes` processed, the `total` number of
+    items (or None), the `elapsed` seconds, `items_per_sec`,
+    `bytes_per_sec`, the `eta` in seconds (None if the total isn't
+    known), the `last` item's name, and whether the stage is `done`.
+
+    Args:
+        stage (str): The name of the stage.
+        total (int): The total number of items, if known.
+        hook (Callable[[dict], Any]): The progress hook. Defaults to
+            the hook set with `set_progress_hook`.
+        interval (float): The minimum number of seconds between reports.
+        initial (int): The number of items already processed, e.g. by
+            an earlier run that's being resumed. These count towards
+            the ETA, but not the rates.
+
+    """
+
+    def __init__(self, stage, total=None, hook=None, interval=10, initial=0):
+        self.stage = stage
+        self.total = total
+        self.hook = hook if hook is not None else _progress_hook
+        self.interval = interval
+        self.initial = initial
+        self.items = 0
+        self.bytes = 0
+        self.last = None
+        self.start_time = time.monotonic()
+        self.last_report_time = self.start_time
+
+    def update(self, items=1, num_bytes=0, last=None):
+        """Record processed items and report if `interval` has passed."""
+        self.items += items
+        self.bytes += num_bytes
+        if last is not None:
+            self.last = last
+        if self.hook is None:
+            return
+        now = time.monotonic()
+        if now - self.last_report_time >= self.interval:
+            self.last_report_time = now
+            self.hook(self.get_stats(now))
+
+    def finish(self):
+        """Report the final stats."""
+        if self.hook is not None:
+            stats = self.get_stats()
+            stats['done'] = True
+            self.hook(stats)
+
+    def get_stats(self, now=None):
+        """Return the current stats dict."""
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self.start_time
+        items_per_sec = self.items / elapsed if elapsed > 0 else 0.0
+        bytes_per_sec = self.bytes / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total is not None and items_per_sec > 0:
+            remaining = self.total - self.initial - self.items
+            eta = max(remaining, 0) / items_per_sec
+        return {
+            'stage': self.stage,
+            'items': self.initial + self.items,
+            'bytes': self.bytes,
+            'total': self.total,
+            'elapsed': elapsed,
+            'items_per_sec': items_per_sec,
+            'bytes_per_sec': bytes_per_sec,
+            'eta': eta,
+            'last': self.last,
+            'done': False
+        }
+
+
+def _format_seconds(seconds):
+    """Format a number of seconds as H:MM:SS."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}'
@@ -0,0 +1,180 @@
+"""
+This module contains functions used to cluster character vectors.
+
+Clustering uses mini-batch k-means, which fits on small random batches
+of the vectors rather than the full matrix on each iteration. To pick
+the number of clusters, `sweep_cluster_counts` fits a model per count.
+The counts are split into contiguous runs that are fit in parallel, and
+within a run each model is warm started from the centers of the one
+before it, plus one new center, so it converges in far fewer steps than
+a fit from scratch.
+
+"""
+
+import collections
+import hashlib
+import os
+import numpy as np
+from . import utils
+
+
+ClusterResult = collections.namedtuple('ClusterResult', ['model', 'labels', 'inertia'])
+
+
+def sweep_cluster_counts(vectors, cluster_counts=range(5, 51), batch_size=4096, max_iter=100,
+                         workers=None, random_state=0, save_name=None):
+    """
+    Fit a mini-batch k-means model for each number of clusters.
+
+    Args:
+        vectors (numpy.ndarray): The vectors to cluster, e.g. from
+            `neighbors.VectorIndex.vectors` or `get_X_y` in the
+            clustering notebook.
+        cluster_counts (Iterable[int]): The numbers of clusters to try.
+        batch_size (int): The number of vectors per mini-batch.
+        max_iter (int): The maximum number of passes over the vectors.
+        workers (int): The number of processes to fit runs of counts in.
+            Defaults to the number of cores.
+        random_state (int): The seed used by every fit.
+        save_name (str): If given, the results are cached in this file
+            in the data directory with `utils.save_data`. Results in the
+            cache for the same vectors are reused, and only the missing
+            counts are fit.
+
+    Returns:
+        Dict[int, ClusterResult]: The fitted model, the cluster label of
+            each vector, and the inertia for each number of clusters.
+
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    cluster_counts = sorted(set(cluster_counts))
+    fingerprint = _get_fingerprint(vectors)
+    results = {}
+    if save_name is not None and os.path.isfile(os.path.join(utils.data_dir_path, save_name)):
+        cached = utils.load_data(save_name)
+        if cached['fingerprint'] == fingerprint:
+            results = cached['results']
+
+    missing = [n for n in cluster_counts if n not in results]
+    if missing:
+        if workers is None:
+            workers = os.cpu_count()
+        runs = np.array_split(missing, min(workers, len(missing)))
+        tasks = [(vectors, [int(n) for n in run], batch_size, max_iter, random_state) for run in runs]
+        if workers > 1 and len(tasks) > 1:
+            run_results = utils.imap_in_order(_fit_run, tasks, len(tasks))
+        else:
+            run_results = map(_fit_run, tasks)
+        for run_result in run_results:
+            results.update(run_result)
+        if save_name is not None:
+            utils.save_data({'fingerprint': fingerprint, 'results': results}, save_name)
+
+    return {n: results[n] for n in cluster_counts}
+
+
+def fit_clusters(vectors, num_clusters, init='k-means++', batch_size=4096, max_iter=100,
+                 random_state=0):
+    """
+    Fit a single mini-batch k-means model.
+
+    Args:
+        vectors (numpy.ndarray): The vectors to cluster.
+        num_clusters (int): The number of clusters.
+        init (Union[str, numpy.ndarray]): The initial centers or the
+            name of a `MiniBatchKMeans` initialization method.
+
+    Returns:
+        ClusterResult: The fitted model, labels, and inertia.
+
+    """
+    from sklearn.cluster import MiniBatchKMeans
+    n_init = 1 if isinstance(init, np.ndarray) else 3
+    model = MiniBatchKMeans(n_clusters=num_clusters, init=init, n_init=n_init, batch_size=batch_size,
+                            max_iter=max_iter, random_state=random_state)
+    labels = model.fit_predict(vectors)
+    return ClusterResult(model, labels, model.inertia_)
+
+
+def get_closest_to_center(cluster_centers, points, names, num=5):
+    """
+    Return the names of the points closest to each cluster center.
+
+    Args:
+        cluster_centers (numpy.ndarray): A matrix with a row per center.
+        points (numpy.ndarray): A matrix with a row per point.
+        names (Sequence[str]): The name of each point.
+        num (int): The number of names per center.
+
+    Returns:
+        List[numpy.ndarray]: The names closest to each center, closest
+            first.
+
+    """
+    names = np.asarray(names)
+    points = np.asarray(points)
+    num = min(num, len(points))
+    if num == 0:
+        return [names[:0] for _ in cluster_centers]
+    # The squared distances, without the norms of the centers, which
+    # don't change the order within a row.
+    distances = (points ** 2).sum(axis=1) - 2 * (cluster_centers @ points.T)
+    closest = np.argpartition(distances, num - 1, axis=1)[:, :num]
+    order = np.argsort(np.take_along_axis(distances, closest, axis=1), axis=1)
+    closest = np.take_along_axis(closest, order, axis=1)
+    return [names[row] for row in closest]
+
+
+def _fit_run(task):
+    """Fit a run of increasing cluster counts, warm starting each from the last."""
+    vectors, cluster_counts, batch_size, max_iter, random_state = task
+    rng = np.random.RandomState(random_state)
+    results = {}
+    previous = None
+    for num_clusters in cluster_counts:
+        if previous is None:
+            init = 'k-means++'
+        else:
+            init = _add_centers(vectors, previous.model.cluster_centers_, num_clusters, rng)
+        previous = fit_clusters(vectors, num_clusters, init=init, batch_size=batch_size,
+                                max_iter=max_iter, random_state=random_state)
+        results[num_clusters] = previous
+    return results
+
+
+def _add_centers(vectors, centers, num_clusters, rng, sample_size=100000):
+    """
+    Return `centers` plus new centers picked as in greedy k-means++.
+
+    For each new center, a few candidate vectors are sampled with
+    probability proportional to their squared distance from the closest
+    existing center, and the one that lowers the total of those
+    distances the most is kept. Only a sample of the vectors is
+    considered, to keep this cheap.
+
+    """
+    if len(vectors) > sample_size:
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    norms = (vectors ** 2).sum(axis=1)
+    distances = norms[:, None] - 2 * (vectors @ centers.T) + (centers ** 2).sum(axis=1)
+    closest = np.maximum(distances.min(axis=1), 0)
+    centers = list(centers)
+    num_trials = 2 + int(np.log(num_clusters))
+    while len(centers) < num_clusters:
+        total = closest.sum()
+        if total > 0:
+            candidates = rng.choice(len(vectors), num_trials, p=closest / total)
+        else:
+            candidates = rng.randint(len(vectors), size=num_trials)
+        distances = norms[:, None] - 2 * (vectors @ vectors[candidates].T) + norms[candidates]
+        new_closest = np.minimum(closest[:, None], np.maximum(distances, 0))
+        best = new_closest.sum(axis=0).argmin()
+        centers.append(vectors[candidates[best]])
+        closest = new_closest[:, best]
+    return np.asarray(centers, dtype=vectors.dtype)
+
+
+def _get_fingerprint(vectors):
+    """Return a hash that identifies a matrix of vectors."""
+    digest = hashlib.sha1(np.ascontiguousarray(vectors).view(np.uint8)).hexdigest()
+    return vectors.shape, digest
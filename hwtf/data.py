@@ -8,84 +8,350 @@ Todo:
 
 """
 
+import functools
+import hashlib
+import itertools
+import os
+import re
+from . import checkpoints
+from . import instrumentation
+from . import parse_cache
+from . import store
 from . import wikipedia
 from . import utils
 from . import transforms
 
 
 CHAR_ARTICLES_FILE_NAME = 'character_bios.pickle'
+CHAR_ARTICLES_RECORDS_FILE_NAME = 'character_bios.records'
 
+_MOVIE_QUERY = {
+    'category_patterns': [
+        r'Films.+',
+    ],
+    'limit': 125000
+}
 
-def get_character_extracts(limit=None, remove_black_listed=True):
-    """Return a dict of article extracts ready for training."""
-    name_to_article = utils.load_data(CHAR_ARTICLES_FILE_NAME)
-    tokenized_articles, lemmatized_articles = wikipedia.convert_articles(name_to_article, limit=limit)
+
+def get_character_extracts(limit=None, remove_black_listed=True, batch_size=1000, n_process=1):
+    """Return dicts of tokenized and lemmatized article extracts ready for training."""
+    name_to_article = dict(iter_saved_character_articles(limit=limit))
+    tokenized_articles, lemmatized_articles = wikipedia.extract_phrases_about_subject(
+        name_to_article, 
+        batch_size=batch_size,
+        n_process=n_process,
+        checkpoint_name=_get_checkpoint_name('character_extracts', name_to_article)
+    )
     
-    def join_and_filter(name_to_article):    
-        output = {}
-        for name, sents in name_to_article.items():
-            text = ' '.join(sents)
-            if remove_black_listed:
-                text = transforms.remove_black_listed(text)
-            output[name] = text
-        return output
-        
-    tokenized_articles = join_and_filter(tokenized_articles)
-    lemmatized_articles = join_and_filter(lemmatized_articles)
+    if remove_black_listed:
+        tokenized_articles = transforms.remove_black_listed_words_from_articles(tokenized_articles)
+        lemmatized_articles = transforms.remove_black_listed_words_from_articles(lemmatized_articles)
     
     return tokenized_articles, lemmatized_articles
 
 
-def get_character_cleaned_articles(remove_section_names=True, remove_ents=False, lemmatize=False, 
-                           tokenize=True, limit=None, remove_black_listed=False):
-    """Return a dict of articles ready for training."""                       
-    name_to_article = utils.load_data(CHAR_ARTICLES_FILE_NAME)
-    output = {}
-    for name, article in name_to_article.items():
-        text = wikipedia.de_wiki(article, remove_section_names=remove_section_names)
+def iter_character_extracts(limit=None, remove_black_listed=True, lemmatized=True, 
+                            batch_size=1000, n_process=1):
+    """
+    Lazily yield (name, extract) records ready for training.
+    
+    This is the streaming version of `get_character_extracts`. Only one
+    version of the extracts is yielded, the lemmatized one by default.
+    
+    """
+    name_article_pairs = iter_saved_character_articles(limit=limit)
+    phrases = wikipedia.iter_phrases_about_subject(name_article_pairs, batch_size=batch_size, 
+                                                   n_process=n_process)
+    for name, tokenized_text, lemmatized_text in phrases:
+        text = lemmatized_text if lemmatized else tokenized_text
         if remove_black_listed:
             text = transforms.remove_black_listed(text)
-        if remove_ents:
-            text = transforms.remove_ents(text)
-        elif lemmatize:
-            text = transforms.to_lemmas(text)
-        elif tokenize:
-            text = transforms.to_tokens(text)
-        output[name] = text
-        if limit is not None and len(output) >= limit:
-            break
-    return output
+        yield name, text
+
+
+def get_character_cleaned_articles(remove_section_names=True, remove_ents=False, lemmatize=False, 
+                           tokenize=True, limit=None, remove_black_listed=False, 
+                           resume=True, progress_hook=None, batch_size=1000, n_process=1,
+                           workers=1, chunk_size=64):
+    """
+    Return a dict of articles ready for training.
+    
+    The cleaned articles are checkpointed as they're produced, so an 
+    interrupted call with the same options and input articles resumes
+    where it left off unless `resume` is false. `progress_hook` is passed to 
+    `checkpoints.Progress`. Lemmatizing and tokenizing run over the 
+    whole corpus with `nlp.pipe`, using `batch_size` and `n_process`.
+    
+    If `workers` is greater than one, the whole cleaning pipeline 
+    (de-wikiing included) instead runs in a pool of that many processes,
+    each of which loads its spacy model once and cleans `chunk_size` 
+    articles per task. The output is the same either way.
+    
+    """                       
+    name_to_article = dict(iter_saved_character_articles(limit=limit))
+    names = list(name_to_article)
+    
+    checkpoint_name = _get_checkpoint_name(
+        'character_cleaned_articles', 
+        name_to_article, 
+        options=(remove_section_names, remove_ents, lemmatize, tokenize, remove_black_listed)
+    )
+    checkpoint = checkpoints.Checkpoint(checkpoint_name, resume=resume)
+    progress = checkpoints.Progress('Articles cleaned', total=len(names), 
+                                    hook=progress_hook, initial=sum(name in checkpoint for name in names))
+    
+    remaining = ((name, name_to_article[name]) for name in names if name not in checkpoint)
+    clean_options = {
+        'remove_section_names': remove_section_names, 
+        'remove_ents': remove_ents, 
+        'lemmatize': lemmatize, 
+        'tokenize': tokenize, 
+        'remove_black_listed': remove_black_listed
+    }
+    if workers > 1:
+        cleaned = _clean_articles_in_pool(remaining, clean_options, workers, chunk_size)
+    else:
+        cleaned = clean_articles(remaining, batch_size=batch_size, n_process=n_process, 
+                                  **clean_options)
+    for name, text in cleaned:
+        checkpoint.add(name, text)
+        progress.update(num_bytes=len(name_to_article[name]), last=name)
+    
+    progress.finish()
+    checkpoint.delete()
+    return {name: checkpoint.results[name] for name in names}
+
+
+def iter_character_cleaned_articles(remove_section_names=True, remove_ents=False, lemmatize=False, 
+                                    tokenize=True, limit=None, remove_black_listed=False, 
+                                    batch_size=1000, n_process=1, workers=1, chunk_size=64):
+    """
+    Lazily yield (name, text) records ready for training.
+    
+    This is the streaming version of `get_character_cleaned_articles`,
+    without the checkpoints. Only `limit` articles are read from disk.
+    
+    """
+    clean_options = {
+        'remove_section_names': remove_section_names, 
+        'remove_ents': remove_ents, 
+        'lemmatize': lemmatize, 
+        'tokenize': tokenize, 
+        'remove_black_listed': remove_black_listed
+    }
+    articles = iter_saved_character_articles(limit=limit)
+    if workers > 1:
+        return _clean_articles_in_pool(articles, clean_options, workers, chunk_size)
+    return clean_articles(articles, batch_size=batch_size, n_process=n_process, **clean_options)
+
+
+def clean_articles(name_text_pairs, remove_section_names=True, remove_ents=False, lemmatize=False, 
+                   tokenize=True, remove_black_listed=False, batch_size=1000, n_process=1):
+    """
+    Lazily clean (name, wikitext) pairs the way `get_character_cleaned_articles` does.
+    
+    This can also be used to prepare new articles for trained models.
+    The whole pipeline is timed as a `data.clean_articles` stage, with 
+    the steps inside it as nested stages (see `instrumentation`).
+    
+    """
+    def get_de_wikied_articles():
+        for name, article in name_text_pairs:
+            text = wikipedia.de_wiki(article, remove_section_names=remove_section_names)
+            if remove_black_listed:
+                text = transforms.remove_black_listed(text)
+            yield name, text
+    
+    de_wikied = get_de_wikied_articles()
+    if remove_ents:
+        cleaned = ((name, transforms.remove_entities_and_prop_nouns(text)) for name, text in de_wikied)
+    elif lemmatize:
+        cleaned = transforms.iter_lemmas(de_wikied, batch_size=batch_size, n_process=n_process)
+    elif tokenize:
+        cleaned = transforms.iter_tokens(de_wikied, batch_size=batch_size, n_process=n_process)
+    else:
+        cleaned = de_wikied
+    return instrumentation.time_iterator('data.clean_articles', cleaned, _get_text_size)
+
+
+def init_cleaning_worker(clean_options):
+    """Prepare a worker process to run `clean_articles` with `clean_options`."""
+    parse_cache.init_worker()
+    # Load the spacy model once, before the first chunk. Missing options
+    # have the defaults of `clean_articles`.
+    if clean_options.get('remove_ents', False):
+        transforms.get_large_model()
+    elif clean_options.get('lemmatize', False) or clean_options.get('tokenize', True):
+        transforms.get_minimal_model()
+
+
+def iter_saved_character_articles(limit=None):
+    """
+    Lazily yield the saved (name, article) records of the character articles.
+    
+    The articles are read from the `raw` column of the article store
+    created by `save_character_articles_to_store` or the record stream
+    created by `save_character_articles_as_records` if either exists, 
+    in which case only the first `limit` articles are read. Otherwise 
+    the whole pickled dict has to be loaded first.
+    
+    """
+    store_path = os.path.join(utils.data_dir_path, store.ARTICLE_STORE_FILE_NAME)
+    if os.path.isfile(store_path):
+        with store.ArticleStore() as article_store:
+            if 'raw' in article_store.get_columns():
+                yield from article_store.iter_articles(('raw',), limit=limit)
+                return
+    
+    records_path = os.path.join(utils.data_dir_path, CHAR_ARTICLES_RECORDS_FILE_NAME)
+    if os.path.isfile(records_path):
+        yield from utils.iter_records(CHAR_ARTICLES_RECORDS_FILE_NAME, limit=limit)
+        return
+    name_to_article = utils.load_data(CHAR_ARTICLES_FILE_NAME)
+    yield from itertools.islice(name_to_article.items(), limit)
+
+
+def save_character_articles_to_store():
+    """
+    Save the pickled character articles to the `raw` column of the article store.
+    
+    The store is archived first if it already exists.
+    
+    """
+    name_to_article = utils.load_data(CHAR_ARTICLES_FILE_NAME)
+    with store.ArticleStore() as article_store:
+        if len(article_store):
+            article_store.archive()
+        return article_store.put('raw', name_to_article)
+
+
+def save_character_articles_as_records():
+    """Save the pickled character articles as a record stream for `iter_saved_character_articles`."""
+    name_to_article = utils.load_data(CHAR_ARTICLES_FILE_NAME)
+    return utils.save_records(name_to_article.items(), CHAR_ARTICLES_RECORDS_FILE_NAME)
 
 
 def get_character_articles():
     """Get a dict of raw character related articles from the Wikipedia dump."""
-    title_black_list = utils.load_values('character_article_title_black_list.csv')
-    
-    patterns = [
-        r'.+characters in.+',
-        r'.*characters introduced in',
-        r'Characters in.+'
-    ]
-    
-    title_to_page_raw = get_pages_with_category(
-        patterns, 
-        title_black_list=title_black_list, 
-        limit=125000
-    )
+    title_to_page_raw = wikipedia.get_pages_with_categories(
+        {'characters': _get_character_query()},
+        checkpoint_name='character_articles'
+    )['characters']
+    return _remove_character_collections(title_to_page_raw)
+
+
+def get_movie_articles():
+    """Get a dict of raw film summaries from the Wikipedia dump."""
+    return wikipedia.get_pages_with_categories(
+        {'movies': _MOVIE_QUERY},
+        checkpoint_name='movie_articles'
+    )['movies']
+
+
+def iter_character_articles(limit=None):
+    """
+    Lazily yield the raw (title, article) records of character articles from the dump.
+    
+    This is the streaming version of `get_character_articles`. The scan
+    of the dump stops after `limit` articles, which defaults to the 
+    limit of the character query.
+    
+    """
+    query = _get_character_query()
+    if limit is not None:
+        query['limit'] = limit
+    # Collections are removed after the query's limit is applied, as in
+    # `get_character_articles`.
+    for _, title, article, _ in wikipedia.iter_pages_with_categories({'characters': query}):
+        if not _is_character_collection(article):
+            yield title, article
+
+
+def get_character_and_movie_articles():
+    """
+    Get the raw character and film articles in a single pass over the dump.
+    
+    Returns:
+        Tuple[Dict[str, str], Dict[str, str]]: The same dicts returned by
+            `get_character_articles` and `get_movie_articles`.
     
+    """
+    results = wikipedia.get_pages_with_categories({
+        'characters': _get_character_query(),
+        'movies': _MOVIE_QUERY
+    }, checkpoint_name='character_and_movie_articles')
+    return _remove_character_collections(results['characters']), results['movies']
+
+
+def _get_character_query():
+    """Return the `get_pages_with_categories` query for character articles."""
+    return {
+        'category_patterns': [
+            r'.+characters in.+',
+            r'.*characters introduced in',
+            r'Characters in.+'
+        ],
+        'title_black_list': utils.load_values('character_article_title_black_list.csv'),
+        'limit': 125000
+    }
+
+
+def _remove_character_collections(title_to_page_raw):
+    """Remove articles that are really about a collection of characters."""
     title_to_page = {}
     for name, article in title_to_page_raw.items():
-        # Check to see if article is really about a collection of characters.
-        match = re.search('==.*(Characters|Cast).*==', article, re.IGNORECASE)
-        if not match:
+        if not _is_character_collection(article):
             title_to_page[name] = article
     
     return title_to_page
 
 
-def get_movie_articles():
-    """Get a dict of raw film summaries from the Wikipedia dump."""
-    patterns = [
-        r'Films.+',
-    ] 
-    return get_pages_with_category(patterns, limit=125000)
+def _is_character_collection(article):
+    """Return true if the article is really about a collection of characters."""
+    match = re.search('==.*(Characters|Cast).*==', article, re.IGNORECASE)
+    return match is not None
+
+
+def _clean_articles_in_pool(name_text_pairs, clean_options, workers, chunk_size):
+    """Yield the results of `clean_articles` computed in chunks by a pool of workers."""
+    pairs = iter(name_text_pairs)
+    chunks = iter(lambda: list(itertools.islice(pairs, chunk_size)), [])
+    tasks = ((chunk, clean_options) for chunk in chunks)
+    # The workers send back the docs they parse for the parse cache.
+    clean_chunk = functools.partial(parse_cache.run_in_worker, _clean_article_chunk)
+    results = utils.imap_in_order(clean_chunk, tasks, workers, 
+                                  initializer=init_cleaning_worker, initargs=(clean_options,))
+    # The workers' stages aren't recorded here, only the time spent 
+    # waiting on them.
+    cleaned = itertools.chain.from_iterable(parse_cache.store_worker_results(results))
+    yield from instrumentation.time_iterator('data.clean_articles', cleaned, _get_text_size)
+
+
+def _clean_article_chunk(task):
+    """Clean a chunk of (name, text) pairs in a worker process."""
+    chunk, clean_options = task
+    return list(clean_articles(chunk, batch_size=len(chunk), **clean_options))
+
+
+def _get_text_size(pair):
+    """Return the length of the text in a (name, text) pair, for instrumentation."""
+    return len(pair[1])
+
+
+def _get_checkpoint_name(stage, name_to_article, options=()):
+    """
+    Return the name of a checkpoint for a stage run on `name_to_article`.
+    
+    The name includes the stage's options and a hash of the names and 
+    texts of the input articles, so a checkpoint is never resumed with 
+    different input, e.g. a different `limit` or a re-scraped article.
+    
+    """
+    digest = hashlib.sha1()
+    for name, text in name_to_article.items():
+        for value in (name, text):
+            encoded = value.encode('utf-8')
+            digest.update(len(encoded).to_bytes(8, 'little'))
+            digest.update(encoded)
+    parts = [stage] + [str(int(option)) for option in options] + [digest.hexdigest()[:16]]
+    return '-'.join(parts)
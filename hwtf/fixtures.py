@@ -0,0 +1,208 @@
+"""
+This module contains generators of synthetic Wikipedia data.
+
+The articles are random, but they use the markup the pipeline has to
+handle (infoboxes and other nested templates, refs, links, files,
+tables, comments, sections, and categories), so they can stand in for
+the real dump in benchmarks. Everything is seeded, so the same
+arguments always produce the same data.
+
+"""
+
+import bz2
+import os
+import random
+from xml.sax.saxutils import escape
+
+
+_WORDS = (
+    'the a Zuko fire nation prince banished his father Ozai sister Azula uncle Iroh honor '
+    'Avatar Aang series episode season he she was is and of to in'
+).split()
+_SHOWS = ('Avatar', 'Futurama', 'Star Wars', 'Harry Potter', 'Buffy', 'Rick and Morty')
+_DUMP_HEADER = (
+    '<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" xml:lang="en">\n'
+    '  <siteinfo>\n    <sitename>Wikipedia</sitename>\n  </siteinfo>\n'
+)
+
+
+def make_synthetic_articles(num_articles=100, seed=0):
+    """
+    Return a dict mapping names to random character articles in Wikitext.
+
+    Articles vary in length from a couple of paragraphs to a dozen or
+    so sections, and each one mentions its name in the first sentence
+    and belongs to a "Fictional characters" category.
+
+    """
+    rng = random.Random(seed)
+    name_to_article = {}
+    for i in range(num_articles):
+        name = f'{_get_words(rng, 1).capitalize()} {i}'
+        name_to_article[name] = _get_article(rng, name)
+    return name_to_article
+
+
+def make_synthetic_dump(path, num_pages=1000, character_fraction=0.3, pages_per_stream=100,
+                        seed=0):
+    """
+    Write a synthetic multistream dump and its index.
+
+    Like the real multistream dumps, the dump is a series of bz2
+    streams of `pages_per_stream` pages each, and the index next to it
+    (`...-index.txt.bz2` if `path` ends with `.xml.bz2`) lists the
+    stream offset of each page. Some pages are redirects or aren't in
+    the main namespace, and only `character_fraction` of the rest are
+    character articles. The others are short articles without a
+    character category.
+
+    Args:
+        path (str): The path of the dump to write.
+        num_pages (int): The number of pages.
+        character_fraction (float): The fraction of pages that are
+            character articles.
+        pages_per_stream (int): The number of pages per bz2 stream.
+        seed (int): The random seed.
+
+    Returns:
+        int: The size of the dump in bytes.
+
+    """
+    rng = random.Random(seed)
+    index_lines = []
+    with open(path, 'wb') as f:
+        f.write(bz2.compress(_DUMP_HEADER.encode('utf-8')))
+        for start in range(0, num_pages, pages_per_stream):
+            offset = f.tell()
+            pages = []
+            for page_id in range(start, min(start + pages_per_stream, num_pages)):
+                title, page = _get_page(rng, page_id, character_fraction)
+                pages.append(page)
+                index_lines.append(f'{offset}:{page_id}:{title}\n')
+            if start + pages_per_stream >= num_pages:
+                pages.append('</mediawiki>\n')
+            f.write(bz2.compress(''.join(pages).encode('utf-8')))
+        size = f.tell()
+
+    root, extension = os.path.splitext(path)
+    if extension == '.bz2':
+        root, extension = os.path.splitext(root)
+    with bz2.open(root + '-index.txt.bz2', 'wt', encoding='utf-8') as f:
+        f.writelines(index_lines)
+    return size
+
+
+def _get_page(rng, page_id, character_fraction):
+    """Return the title and XML of a random page."""
+    kind = rng.random()
+    redirect = ''
+    ns = 0
+    if kind < 0.05:
+        title = f'Talk:{_get_words(rng, 2)} {page_id}'
+        ns = 1
+        text = _get_sentence(rng)
+    elif kind < 0.15:
+        title = f'{_get_words(rng, 2).capitalize()} {page_id}'
+        redirect = f'    <redirect title="{escape(_get_words(rng, 2))}" />\n'
+        text = f'#REDIRECT [[{_get_words(rng, 2)}]]'
+    elif rng.random() < character_fraction:
+        title = f'{_get_words(rng, 1).capitalize()} {page_id}'
+        text = _get_article(rng, title)
+    else:
+        title = f'{_get_words(rng, 2).capitalize()} {page_id}'
+        text = _get_sentence(rng) + '\n[[Category:' + _get_words(rng, 2) + ']]\n'
+    page = (
+        f'  <page>\n    <title>{escape(title)}</title>\n    <ns>{ns}</ns>\n    <id>{page_id}</id>\n'
+        f'{redirect}    <revision>\n      <id>{page_id}</id>\n'
+        f'      <text xml:space="preserve">{escape(text)}</text>\n    </revision>\n  </page>\n'
+    )
+    return title, page
+
+
+def _get_article(rng, name):
+    """Return a random character article about `name`."""
+    out = [
+        f'{{{{Infobox character\n| name = {name}\n| image = {_get_template(rng)}\n'
+        f'| first = {_get_link(rng)}\n}}}}\n',
+        f"'''{name}''' is a {_get_sentence(rng)}\n"
+    ]
+    for _ in range(rng.randint(1, 12)):
+        level = '=' * rng.choice((2, 2, 3, 4))
+        out.append(f'\n{level} {_get_words(rng, 2).capitalize()} {level}\n')
+        if rng.random() < 0.3:
+            out.append(f'[[File:{name}.png|thumb|{_get_words(rng, 3)} {_get_link(rng)}]]\n')
+        if rng.random() < 0.2:
+            out.append(f'{{| class="wikitable"\n|-\n| {_get_words(rng, 2)} || {_get_link(rng)}\n|}}\n')
+        for _ in range(rng.randint(1, 4)):
+            sentences = (_get_sentence(rng) for _ in range(rng.randint(1, 5)))
+            out.append(' '.join(sentences) + '\n\n')
+    if rng.random() < 0.8:
+        heading = rng.choice(('See also', 'References', 'Notes', 'Bibliography'))
+        out.append(f'\n== {heading} ==\n{{{{reflist}}}}\n* {_get_link(rng)}\n')
+    out.append(f'[[Category:Fictional characters in {rng.choice(_SHOWS)}]]\n')
+    return ''.join(out)
+
+
+def _get_sentence(rng):
+    """Return a random sentence with inline markup."""
+    parts = []
+    for _ in range(rng.randint(3, 12)):
+        kind = rng.random()
+        if kind < 0.55:
+            parts.append(_get_words(rng, rng.randint(1, 4)))
+        elif kind < 0.7:
+            parts.append(_get_link(rng))
+        elif kind < 0.78:
+            parts.append(_get_ref(rng))
+        elif kind < 0.82:
+            parts.append(_get_template(rng))
+        elif kind < 0.87:
+            parts.append(f"'''{_get_words(rng, 2)}'''")
+        elif kind < 0.91:
+            parts.append(f"''{_get_words(rng, 2)}''")
+        elif kind < 0.93:
+            parts.append(f'<!-- {_get_words(rng, 3)} -->')
+        elif kind < 0.95:
+            parts.append('&nbsp;')
+        elif kind < 0.97:
+            parts.append(f'<small>{_get_words(rng, 2)}</small>')
+        else:
+            parts.append('<br />')
+    return ' '.join(parts) + '.'
+
+
+def _get_link(rng):
+    kind = rng.random()
+    if kind < 0.5:
+        return f'[[{_get_words(rng, 2)}]]'
+    if kind < 0.8:
+        return f'[[{_get_words(rng, 2)}|{_get_words(rng, 1)}]]'
+    if kind < 0.85:
+        return f'[[{_get_words(rng, 1)} ({_get_words(rng, 1)})|]]'
+    return f"[[{_get_words(rng, 1)}|''{_get_words(rng, 2)}'']]"
+
+
+def _get_template(rng, depth=0):
+    if depth < 1 and rng.random() < 0.3:
+        inner = _get_template(rng, depth + 1)
+        return f'{{{{{_get_words(rng, 1)}|{inner}|x={_get_words(rng, 2)}}}}}'
+    return '{{' + rng.choice((
+        f'cite web|url=http://example.com|title={_get_words(rng, 3)}',
+        'c.|lk=no|1100',
+        "nihongo|'''Prince Zuko'''|祖寇|Zǔ Kòu",
+        f'Main|{_get_words(rng, 2)}',
+        'citation needed|date=May 2018',
+    )) + '}}'
+
+
+def _get_ref(rng):
+    kind = rng.random()
+    if kind < 0.4:
+        return f'<ref>{_get_template(rng)}</ref>'
+    if kind < 0.7:
+        return f'<ref name="{_get_words(rng, 1)}">{_get_words(rng, 4)}</ref>'
+    return f'<ref name="{_get_words(rng, 1)}" />'
+
+
+def _get_words(rng, num_words):
+    return ' '.join(rng.choice(_WORDS) for _ in range(num_words))
@@ -0,0 +1,183 @@
+"""
+This module contains functions used to embed new articles with trained models.
+
+New articles go through the same steps as the training articles: they
+are de-wikied and cleaned with `data.clean_articles`, and then either
+inferred with a doc2vec model or mapped to topic distributions with an
+lda model from `models.train_lda_model`. Batches can be split into
+chunks and processed by a pool of workers, each of which loads the
+spacy and trained models once.
+
+Starting the pool is expensive, since every worker loads a spacy model
+and is sent a copy of the trained model, so it's kept open between
+calls with the same model, cleaning options, and number of workers.
+It's replaced when these change, and can be shut down with
+`close_worker_pool`, which should also be called after changing a
+model in place, since the workers keep the copy they were sent. Small
+batches are usually fastest in process, which is the default.
+
+Models can be passed as objects or as the file names they were saved
+under with `utils.save_data`. Loaded models are cached, so repeated
+calls don't reload them.
+
+"""
+
+import functools
+import itertools
+import numpy as np
+from . import data
+from . import models
+from . import parse_cache
+from . import utils
+
+
+_model_cache = {}
+# The state of a worker process, set by `_init_worker`.
+_worker_state = {}
+# The pool kept open by `_get_worker_pool`, as a (key, model, pool) tuple.
+_worker_pool = None
+
+
+def load_model(file_name):
+    """Return a model saved with `utils.save_data`, loading it only once."""
+    if file_name not in _model_cache:
+        _model_cache[file_name] = utils.load_data(file_name)
+    return _model_cache[file_name]
+
+
+def close_worker_pool():
+    """Shut down the pool of workers kept open between calls, if any."""
+    global _worker_pool
+    if _worker_pool is not None:
+        _, _, pool = _worker_pool
+        _worker_pool = None
+        pool.terminate()
+        pool.join()
+
+
+def infer_doc2vec_vectors(name_to_wikitext, model, clean_options=None, epochs=None,
+                          workers=1, chunk_size=64):
+    """
+    Return doc2vec vectors for new articles.
+
+    Args:
+        name_to_wikitext (Union[dict, Iterable[Tuple[str, str]]]): The
+            raw wikitext of the articles.
+        model (Union[gensim.models.Doc2Vec, str]): A trained model or
+            the file name it was saved under.
+        clean_options (dict): Keyword arguments of `data.clean_articles`.
+            These should match the options the training articles were
+            cleaned with.
+        epochs (int): The number of inference epochs. Defaults to the
+            number of training epochs.
+        workers (int): The number of worker processes. If this is
+            greater than one, the articles are processed by a pool of
+            workers that's kept open for later calls. Only worth it
+            for large batches.
+        chunk_size (int): The number of articles per worker task.
+
+    Returns:
+        Tuple[List[str], numpy.ndarray]: The names of the articles and a
+            matrix with a vector per article.
+
+    """
+    return _infer(name_to_wikitext, 'doc2vec', model, clean_options, {'epochs': epochs},
+                  workers, chunk_size)
+
+
+def infer_lda_topics(name_to_wikitext, lda_output, clean_options=None, workers=1, chunk_size=64):
+    """
+    Return lda topic distributions for new articles.
+
+    Args:
+        name_to_wikitext (Union[dict, Iterable[Tuple[str, str]]]): The
+            raw wikitext of the articles.
+        lda_output (Union[tuple, str]): The output of
+            `models.train_lda_model` or the file name it was saved under.
+        clean_options (dict): As in `infer_doc2vec_vectors`.
+        workers (int): As in `infer_doc2vec_vectors`.
+        chunk_size (int): The number of articles per worker task.
+
+    Returns:
+        Tuple[List[str], numpy.ndarray]: The names of the articles and a
+            matrix with a row of topic probabilities per article.
+
+    """
+    return _infer(name_to_wikitext, 'lda', lda_output, clean_options, {}, workers, chunk_size)
+
+
+def _infer(name_to_wikitext, kind, model, clean_options, infer_options, workers, chunk_size):
+    """Clean and infer articles in chunks, in this process or a pool of workers."""
+    if isinstance(model, str):
+        model = load_model(model)
+    if clean_options is None:
+        clean_options = {}
+    if isinstance(name_to_wikitext, dict):
+        name_to_wikitext = name_to_wikitext.items()
+
+    pairs = iter(name_to_wikitext)
+    chunks = iter(lambda: list(itertools.islice(pairs, chunk_size)), [])
+    tasks = ((chunk, kind, clean_options, infer_options) for chunk in chunks)
+    if workers > 1:
+        pool = _get_worker_pool(model, clean_options, workers)
+        infer_chunk = functools.partial(parse_cache.run_in_worker, _infer_chunk)
+        results = utils.imap_in_order(infer_chunk, tasks, workers, pool=pool)
+        results = parse_cache.store_worker_results(results)
+    else:
+        results = (_infer_chunk(task, model) for task in tasks)
+
+    names = []
+    vectors = []
+    for chunk_names, chunk_vectors in results:
+        names.extend(chunk_names)
+        vectors.append(chunk_vectors)
+    if not vectors:
+        return names, np.zeros((0, _get_vector_size(kind, model)), dtype=np.float32)
+    return names, np.vstack(vectors)
+
+
+def _get_worker_pool(model, clean_options, workers):
+    """Return a pool of workers set up by `_init_worker`, reusing the open one if it matches."""
+    global _worker_pool
+    import multiprocessing
+    key = (workers, tuple(sorted(clean_options.items())))
+    if _worker_pool is not None:
+        pool_key, pool_model, pool = _worker_pool
+        # The workers have a copy of the model, so it has to be the same object.
+        if pool_key == key and pool_model is model:
+            return pool
+        close_worker_pool()
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(model, clean_options))
+    _worker_pool = (key, model, pool)
+    return pool
+
+
+def _init_worker(model, clean_options):
+    """Prepare a worker process to run `_infer_chunk`."""
+    data.init_cleaning_worker(clean_options)
+    _worker_state['model'] = model
+
+
+def _infer_chunk(task, model=None):
+    """Clean and infer a chunk of (name, wikitext) pairs, by default with the worker's model."""
+    chunk, kind, clean_options, infer_options = task
+    if model is None:
+        model = _worker_state['model']
+    cleaned = list(data.clean_articles(chunk, batch_size=len(chunk), **clean_options))
+    if kind == 'lda':
+        return models.get_lda_topic_vectors(model, cleaned, chunksize=len(chunk))
+
+    epochs = infer_options['epochs']
+    names = []
+    vectors = np.zeros((len(cleaned), model.vector_size), dtype=np.float32)
+    for i, (name, text) in enumerate(cleaned):
+        names.append(name)
+        vectors[i] = model.infer_vector(text.split(' '), epochs=epochs)
+    return names, vectors
+
+
+def _get_vector_size(kind, model):
+    """Return the length of the vectors a model infers."""
+    if kind == 'lda':
+        return model[0].num_topics
+    return model.vector_size
@@ -0,0 +1,404 @@
+"""
+This module contains timers, counters, and a sampling profiler for the
+hot paths of the pipeline.
+
+Instrumentation is off by default, in which case a timer is a shared
+no-op object and `time_iterator` returns its iterable untouched, so the
+instrumented code runs at full speed. Turn it on with `enable`, or by
+setting the HWTF_INSTRUMENTATION environment variable to 1.
+
+Each stage is identified by a dotted name, e.g. `wikipedia.de_wiki`,
+and records the number of calls (items, for iterators), the wall time,
+the self time, which leaves out the time spent in stages nested inside
+it, and the items and bytes it processed. Stages can be nested within
+a thread, e.g. a `spacy.parse` iterator whose input is de-wikied by a
+`wikipedia.de_wiki` timer, which is how the self times add up to the
+total without double counting. A timer shouldn't stay open across a
+`yield`; wrap the generator with `time_iterator` instead.
+
+The metrics are kept per process, so stages that run in worker pools
+are only recorded as the time the parent spent waiting on the pool.
+Profile with `workers=1` to see them broken down.
+
+"""
+
+import collections
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from . import utils
+
+
+METRICS_FILE_NAME = 'metrics.json'
+PROMETHEUS_FILE_NAME = 'metrics.prom'
+PROFILE_FILE_NAME = 'profile.folded'
+
+_enabled = os.environ.get('HWTF_INSTRUMENTATION', '') not in ('', '0')
+_lock = threading.Lock()
+# Maps stage names to [calls, seconds, self seconds, items, bytes].
+_stages = {}
+_counters = collections.Counter()
+_local = threading.local()
+_sampler = None
+
+
+#
+# RECORDING
+#
+
+
+def enable():
+    """Start recording metrics in this process."""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Stop recording metrics. Metrics that were recorded are kept."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    """Return whether metrics are being recorded."""
+    return _enabled
+
+
+def reset():
+    """Delete the recorded metrics."""
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+
+def timer(name, items=1, num_bytes=0):
+    """
+    Return a context manager that times a stage.
+
+    Args:
+        name (str): The name of the stage.
+        items (int): The number of items the stage processes. More can
+            be added with the timer's `add` method.
+        num_bytes (int): The number of bytes the stage processes.
+
+    Example:
+        with instrumentation.timer('data.load', items=0) as t:
+            for name, text in records:
+                t.add(num_bytes=len(text))
+
+    """
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name, items, num_bytes)
+
+
+def timed(name):
+    """Return a decorator that times each call of a function as a stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Timer(name, 1, 0):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def time_iterator(name, iterable, get_bytes=None):
+    """
+    Time the work done to produce each item of an iterable.
+
+    Only the time spent inside the iterable counts, not the time the
+    consumer spends between items, so this suits generator stages.
+    Whether the iterable is timed is decided when this is called.
+
+    Args:
+        name (str): The name of the stage.
+        iterable (Iterable): The iterable to time.
+        get_bytes (Callable[[Any], int]): Returns the number of bytes
+            in an item.
+
+    Returns:
+        Iterable: `iterable` if instrumentation is off, and otherwise a
+            generator that yields its items.
+
+    """
+    if not _enabled:
+        return iterable
+    return _iter_timed(name, iterable, get_bytes)
+
+
+def count(name, value=1):
+    """Add `value` to the counter `name`."""
+    if _enabled:
+        with _lock:
+            _counters[name] += value
+
+
+def get_metrics():
+    """
+    Return the recorded metrics.
+
+    Returns:
+        dict: A 'stages' dict that maps stage names to dicts of 'calls',
+            'seconds', 'self_seconds', 'items', and 'bytes', and a
+            'counters' dict that maps counter names to values.
+
+    """
+    with _lock:
+        stages = {
+            name: dict(zip(('calls', 'seconds', 'self_seconds', 'items', 'bytes'), stats))
+            for name, stats in sorted(_stages.items())
+        }
+        counters = dict(sorted(_counters.items()))
+    return {'stages': stages, 'counters': counters}
+
+
+def _iter_timed(name, iterable, get_bytes):
+    iterator = iter(iterable)
+    while True:
+        with _Timer(name, 1, 0) as item_timer:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                item_timer.items = 0
+                break
+            if get_bytes is not None:
+                item_timer.num_bytes = get_bytes(item)
+        yield item
+
+
+def _record(name, seconds, self_seconds, items, num_bytes):
+    with _lock:
+        stats = _stages.get(name)
+        if stats is None:
+            stats = _stages[name] = [0, 0.0, 0.0, 0, 0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] += self_seconds
+        stats[3] += items
+        stats[4] += num_bytes
+
+
+def _get_stack():
+    """Return this thread's stack of open timers."""
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+class _Timer:
+    """A timer for a single run of a stage."""
+
+    __slots__ = ('name', 'items', 'num_bytes', '_start', '_child_seconds')
+
+    def __init__(self, name, items, num_bytes):
+        self.name = name
+        self.items = items
+        self.num_bytes = num_bytes
+
+    def add(self, items=1, num_bytes=0):
+        """Add to the number of items and bytes processed."""
+        self.items += items
+        self.num_bytes += num_bytes
+
+    def __enter__(self):
+        _get_stack().append(self)
+        self._child_seconds = 0.0
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self._start
+        stack = _get_stack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        elif self in stack:
+            stack.remove(self)
+        if stack:
+            stack[-1]._child_seconds += seconds
+        _record(self.name, seconds, seconds - self._child_seconds, self.items, self.num_bytes)
+
+
+class _NullTimer:
+    """The timer used while instrumentation is off."""
+
+    __slots__ = ()
+
+    def add(self, items=1, num_bytes=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+#
+# EXPORT
+#
+
+
+def export_json(file_name=METRICS_FILE_NAME):
+    """Save the metrics as JSON in the data directory and return the path."""
+    path = os.path.join(utils.data_dir_path, file_name)
+    _write_atomically(path, json.dumps(get_metrics(), indent=2) + '\n')
+    return path
+
+
+def export_prometheus(file_name=PROMETHEUS_FILE_NAME):
+    """
+    Save the metrics in the Prometheus text format and return the path.
+
+    The file is replaced atomically, so it can be read by the node
+    exporter's textfile collector while the pipeline runs.
+
+    """
+    path = os.path.join(utils.data_dir_path, file_name)
+    _write_atomically(path, format_prometheus(get_metrics()))
+    return path
+
+
+def format_prometheus(metrics):
+    """Return the output of `get_metrics` in the Prometheus text format."""
+    lines = []
+    families = (
+        ('calls', 'hwtf_stage_calls_total', 'The number of times each stage ran.'),
+        ('seconds', 'hwtf_stage_seconds_total', 'The wall time of each stage.'),
+        ('self_seconds', 'hwtf_stage_self_seconds_total',
+         'The wall time of each stage, not counting the stages nested in it.'),
+        ('items', 'hwtf_stage_items_total', 'The number of items each stage processed.'),
+        ('bytes', 'hwtf_stage_bytes_total', 'The number of bytes each stage processed.'),
+    )
+    for key, metric_name, description in families:
+        lines.append(f'# HELP {metric_name} {description}')
+        lines.append(f'# TYPE {metric_name} counter')
+        for name, stats in metrics['stages'].items():
+            lines.append(f'{metric_name}{{stage="{_escape_label(name)}"}} {stats[key]!r}')
+    lines.append('# HELP hwtf_events_total The value of each counter.')
+    lines.append('# TYPE hwtf_events_total counter')
+    for name, value in metrics['counters'].items():
+        lines.append(f'hwtf_events_total{{name="{_escape_label(name)}"}} {value!r}')
+    return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _write_atomically(path, text):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+#
+# SAMPLING PROFILER
+#
+
+
+def start_profiler(interval=0.005):
+    """
+    Start sampling the stack of the calling thread.
+
+    A background thread records the calling thread's stack every
+    `interval` seconds. The profiler works whether or not
+    instrumentation is enabled, and only costs anything while it runs.
+
+    """
+    global _sampler
+    if _sampler is not None:
+        raise RuntimeError('The profiler is already running.')
+    _sampler = _Sampler(threading.get_ident(), interval)
+    _sampler.start()
+
+
+def stop_profiler():
+    """
+    Stop the profiler.
+
+    Returns:
+        collections.Counter: The number of samples of each stack, keyed
+            by the stack's functions, outermost first, joined with ';'.
+
+    """
+    global _sampler
+    if _sampler is None:
+        raise RuntimeError('The profiler is not running.')
+    sampler, _sampler = _sampler, None
+    sampler.stopped.set()
+    sampler.join()
+    return sampler.stacks
+
+
+def save_profile(stacks, file_name=PROFILE_FILE_NAME):
+    """
+    Save the output of `stop_profiler` in the data directory.
+
+    The file has a line per stack in the folded format read by
+    flamegraph.pl and speedscope. Returns the path.
+
+    """
+    path = os.path.join(utils.data_dir_path, file_name)
+    lines = [f'{stack} {samples}\n' for stack, samples in stacks.most_common()]
+    _write_atomically(path, ''.join(lines))
+    return path
+
+
+@contextlib.contextmanager
+def profile(file_name=PROFILE_FILE_NAME, interval=0.005):
+    """
+    Profile the body of a with statement and save it with `save_profile`.
+
+    Example:
+        with instrumentation.profile('de_wiki.folded'):
+            data.get_character_cleaned_articles(limit=1000)
+
+    """
+    start_profiler(interval)
+    try:
+        yield
+    finally:
+        save_profile(stop_profiler(), file_name)
+
+
+class _Sampler(threading.Thread):
+    """A thread that samples the stack of another thread."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='hwtf-profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            self.stacks[_fold_stack(frame)] += 1
+            del frame
+
+
+def _fold_stack(frame):
+    """Return the functions on a stack, outermost first, joined with ';'."""
+    names = []
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '?')
+        names.append(f'{module}.{frame.f_code.co_name}')
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
@@ -1,41 +1,352 @@
 """
 This module contains functions used to train the models used in the project.
 
+The trainers take either a dict mapping names to articles or an iterable
+of (name, article) pairs, such as the generators in `data`.
+
 """
 
+import functools
+import itertools
+import json
 import os
-from sklearn.feature_extraction.text import CountVectorizer
-from gensim.models import doc2vec, LdaMulticore, LdaModel
-from gensim import matutils
+import tempfile
+from . import instrumentation
 from . import utils
 
 
-def train_doc2vec_model(name_to_article, vector_size=75, window=10, epochs=100, save_name=None):
-    """Build, train, and return a gensim doc2vec model."""
-    train_corpus = []
-    for name, article in name_to_article.items():
-        words = article.split(' ')
-        tagged_doc = doc2vec.TaggedDocument(words, [name])
-        train_corpus.append(tagged_doc)
-    model = doc2vec.Doc2Vec(vector_size=vector_size, window=window, epochs=epochs, workers=6)
-    model.build_vocab(train_corpus)
-    model.train(train_corpus, total_examples=model.corpus_count, epochs=model.epochs)
+# Sklearn and gensim are slow to import, so they're imported by the 
+# functions that use them.
+
+# The training steps are timed as `models.*` stages (see 
+# `instrumentation`). Gensim trains in its own threads, so its time is
+# all self time of the stage that called it.
+
+# The most words gensim trains on per document.
+_MAX_DOC_WORDS = 10000
+
+
+def train_doc2vec_model(name_to_article, vector_size=75, window=10, epochs=100, save_name=None, 
+                        workers=None, corpus_file=False):
+    """
+    Build, train, and return a gensim doc2vec model.
+    
+    If `corpus_file` is true, the articles are written to a temporary 
+    corpus file and the model is trained with gensim's `corpus_file` 
+    mode (see `train_doc2vec_model_from_corpus`), which leaves out empty
+    articles. `workers` defaults to the number of cores.
+    
+    """
+    from gensim.models import doc2vec
+    if corpus_file:
+        with tempfile.TemporaryDirectory() as dir_path:
+            path = os.path.join(dir_path, 'corpus.txt')
+            names = _write_corpus_file(_get_pairs(name_to_article), path)
+            return _train_doc2vec_model_from_corpus_file(path, names, vector_size, window, 
+                                                         epochs, workers, save_name)
+    
+    if isinstance(name_to_article, dict):
+        train_corpus = []
+        for name, article in name_to_article.items():
+            words = article.split(' ')
+            tagged_doc = doc2vec.TaggedDocument(words, [name])
+            train_corpus.append(tagged_doc)
+        return _train_doc2vec_model(train_corpus, vector_size, window, epochs, workers, save_name)
+
+    # Doc2vec iterates over the corpus once per epoch, so spool a stream
+    # of articles to disk rather than collecting it in memory.
+    with tempfile.TemporaryDirectory() as dir_path:
+        train_corpus = _SpooledTaggedCorpus(name_to_article, dir_path)
+        return _train_doc2vec_model(train_corpus, vector_size, window, epochs, workers, save_name)
+
+
+def save_doc2vec_corpus(name_to_article, file_name):
+    """
+    Save articles as a doc2vec corpus file in the data directory.
+    
+    The corpus is in gensim's `LineSentence` format, with one article
+    per line, and the names of the articles are saved next to it in
+    `file_name + '.names'`. `name_to_article` can be a stream, such as
+    `data.iter_character_cleaned_articles()`, so the articles never
+    have to be in memory at once. Empty articles are left out.
+    
+    Returns:
+        int: The number of articles saved.
+    
+    """
+    path = os.path.join(utils.data_dir_path, file_name)
+    names = _write_corpus_file(_get_pairs(name_to_article), path)
+    with open(path + '.names', 'w', encoding='utf-8') as f:
+        for name in names:
+            f.write(json.dumps(name) + '\n')
+    return len(names)
+
+
+def train_doc2vec_model_from_corpus(file_name, vector_size=75, window=10, epochs=100, 
+                                    save_name=None, workers=None):
+    """
+    Build, train, and return a doc2vec model from a saved corpus file.
+    
+    The model is trained with gensim's `corpus_file` mode, which streams
+    the corpus from disk in each worker without holding the GIL, so 
+    memory use doesn't grow with the corpus and throughput scales with
+    `workers`, which defaults to the number of cores. The document 
+    vectors are keyed by article name, as in `train_doc2vec_model`.
+    
+    Args:
+        file_name (str): The name of a corpus saved with 
+            `save_doc2vec_corpus`.
+    
+    """
+    path = os.path.join(utils.data_dir_path, file_name)
+    with open(path + '.names', encoding='utf-8') as f:
+        names = [json.loads(line) for line in f]
+    return _train_doc2vec_model_from_corpus_file(path, names, vector_size, window, 
+                                                 epochs, workers, save_name)
+
+
+def _train_doc2vec_model(train_corpus, vector_size, window, epochs, workers, save_name):
+    """Train a doc2vec model on a (re-iterable) corpus of tagged documents."""
+    from gensim.models import doc2vec
+    if workers is None:
+        workers = os.cpu_count()
+    model = doc2vec.Doc2Vec(vector_size=vector_size, window=window, epochs=epochs, workers=workers)
+    with instrumentation.timer('models.doc2vec.build_vocab', items=0) as timer:
+        model.build_vocab(train_corpus)
+        timer.add(model.corpus_count)
+    with instrumentation.timer('models.doc2vec.train', items=model.corpus_count * model.epochs):
+        model.train(train_corpus, total_examples=model.corpus_count, epochs=model.epochs)
+    if save_name is not None:
+        utils.save_data(model, save_name)
+    return model
+
+
+def _train_doc2vec_model_from_corpus_file(path, names, vector_size, window, epochs, workers, save_name):
+    """Train a doc2vec model on a `LineSentence` file whose lines are the articles in `names`."""
+    from gensim.models import doc2vec
+    if workers is None:
+        workers = os.cpu_count()
+    model = doc2vec.Doc2Vec(vector_size=vector_size, window=window, epochs=epochs, workers=workers)
+    corpus_size = os.path.getsize(path)
+    with instrumentation.timer('models.doc2vec.build_vocab', items=0, 
+                               num_bytes=corpus_size) as timer:
+        model.build_vocab(corpus_file=path)
+        timer.add(model.corpus_count)
+    with instrumentation.timer('models.doc2vec.train', items=model.corpus_count * model.epochs,
+                               num_bytes=corpus_size * model.epochs):
+        model.train(corpus_file=path, total_examples=model.corpus_count, 
+                    total_words=model.corpus_total_words, epochs=model.epochs)
+    
+    # In corpus file mode each document is tagged with its line number,
+    # so rekey the document vectors by name.
+    model.dv.index_to_key = list(names)
+    model.dv.key_to_index = {name: i for i, name in enumerate(names)}
     if save_name is not None:
         utils.save_data(model, save_name)
     return model
+
+
+def _write_corpus_file(name_article_pairs, path):
+    """Write articles to a `LineSentence` file and return their names."""
+    names = []
+    with open(path, 'w', encoding='utf-8') as f:
+        for name, article in name_article_pairs:
+            # Gensim only trains on the first words of long documents, 
+            # and in corpus file mode it would split the rest into extra
+            # documents, and skip empty lines, either of which would 
+            # throw off the line numbers.
+            words = article.split()[:_MAX_DOC_WORDS]
+            if not words:
+                continue
+            names.append(name)
+            f.write(' '.join(words) + '\n')
+    return names
+
+
+def train_lda_model(name_to_article, num_topics=10, passes=10, workers=8, save_name=None, 
+                    out_of_core=False, no_below=5, no_above=0.5, keep_n=100000, chunksize=2000):
+    """
+    Build, train, and return a gensim lda model.
+    
+    By default the articles are vectorized in memory with a 
+    `CountVectorizer`, and the output is (model, count_vectorizer, names).
     
+    If `out_of_core` is true, the articles are instead spooled to disk
+    while a gensim `Dictionary` of their terms (see `get_lda_terms`) is 
+    built. Terms in fewer than `no_below` articles or more than the 
+    `no_above` fraction of them are dropped, and only the `keep_n` most
+    frequent are kept. The corpus is then serialized to a temporary 
+    `MmCorpus` that the model streams `chunksize` articles at a time, so
+    memory use is bounded by the dictionary and chunk size rather than 
+    the size of the corpus. The output is (model, dictionary, names).
+    
+    """
+    if out_of_core:
+        with tempfile.TemporaryDirectory() as dir_path:
+            model, dictionary, names = _train_lda_model_out_of_core(
+                name_to_article, num_topics, passes, workers, no_below, 
+                no_above, keep_n, chunksize, dir_path
+            )
+        output = model, dictionary, tuple(names)
+        if save_name is not None:
+            utils.save_data(output, save_name)
+        return output
+    
+    from sklearn.feature_extraction.text import CountVectorizer
+    from gensim.models import LdaMulticore
+    from gensim import matutils
+    
+    names = []
+
+    def get_articles():
+        for name, article in _get_pairs(name_to_article):
+            names.append(name)
+            yield article
 
-def train_lda_model(name_to_article, num_topics=10, passes=10, workers=8, save_name=None):
-    """Build, train, and return a gensim lda model."""
-    names, articles = tuple(zip(*name_to_article.items()))
+    # The vectorizer only needs a single pass over the articles.
     count_vectorizer = CountVectorizer(ngram_range=(1, 2))
-    counts = count_vectorizer.fit_transform(articles)
+    with instrumentation.timer('models.lda.vectorize', items=0) as timer:
+        counts = count_vectorizer.fit_transform(get_articles())
+        timer.add(len(names))
     counts = counts.transpose()
     corpus = matutils.Sparse2Corpus(counts)
     id2word = dict((v, k) for k, v in count_vectorizer.vocabulary_.items())
-    model = LdaMulticore(corpus=corpus, num_topics=num_topics, id2word=id2word, passes=passes, workers=workers)
-    output = model, count_vectorizer, names
+    with instrumentation.timer('models.lda.train', items=len(names) * passes):
+        model = LdaMulticore(corpus=corpus, num_topics=num_topics, id2word=id2word, passes=passes, 
+                             workers=workers)
+    output = model, count_vectorizer, tuple(names)
     if save_name is not None:
         utils.save_data(output, save_name)
     return output
+
+
+def get_lda_terms(article):
+    """
+    Return the terms of an article used by out-of-core lda models.
+    
+    These are the unigrams and bigrams a `CountVectorizer(ngram_range=(1, 2))`
+    would count, so `dictionary.doc2bow(get_lda_terms(article))` gives
+    the bag of words an out-of-core model expects.
+    
+    """
+    return _get_lda_analyzer()(article)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_lda_analyzer():
+    """Return the analyzer that splits articles into lda terms."""
+    from sklearn.feature_extraction.text import CountVectorizer
+    return CountVectorizer(ngram_range=(1, 2)).build_analyzer()
+
+
+def get_lda_topic_vectors(lda_output, name_to_article, chunksize=2000):
+    """
+    Return the topic distributions of articles under a trained lda model.
+    
+    Args:
+        lda_output (tuple): The output of `train_lda_model`, either 
+            (model, count_vectorizer, names) or (model, dictionary, names).
+        name_to_article (Union[dict, Iterable[Tuple[str, str]]]): The 
+            articles, prepared the same way as the training articles.
+        chunksize (int): The number of articles to infer at a time.
+    
+    Returns:
+        Tuple[List[str], numpy.ndarray]: The names of the articles and a
+            matrix with a row of topic probabilities per article.
+    
+    """
+    import numpy as np
+    model, featurizer = lda_output[:2]
+    names = []
+    chunks = []
+    pairs = iter(_get_pairs(name_to_article))
+    for chunk in iter(lambda: list(itertools.islice(pairs, chunksize)), []):
+        chunk_names, articles = zip(*chunk)
+        names.extend(chunk_names)
+        with instrumentation.timer('models.lda.inference', items=len(articles)):
+            gamma, _ = model.inference(_get_bows(featurizer, articles))
+        chunks.append(gamma / gamma.sum(axis=1, keepdims=True))
+    if not chunks:
+        return names, np.zeros((0, model.num_topics), dtype=np.float32)
+    return names, np.vstack(chunks).astype(np.float32)
+
+
+def _get_bows(featurizer, articles):
+    """Return the bags of words of articles under a `CountVectorizer` or `Dictionary`."""
+    from gensim import corpora, matutils
+    if isinstance(featurizer, corpora.Dictionary):
+        return [featurizer.doc2bow(get_lda_terms(article)) for article in articles]
+    counts = featurizer.transform(articles)
+    return list(matutils.Sparse2Corpus(counts, documents_columns=False))
+
+
+def _train_lda_model_out_of_core(name_to_article, num_topics, passes, workers, no_below, 
+                                 no_above, keep_n, chunksize, dir_path):
+    """Train an lda model on a dictionary and `MmCorpus` built in `dir_path`."""
+    from gensim import corpora
+    from gensim.models import LdaMulticore
+    dictionary = corpora.Dictionary()
+    
+    def get_pairs():
+        # Build the dictionary while the articles are being spooled.
+        for name, article in _get_pairs(name_to_article):
+            dictionary.add_documents([get_lda_terms(article)])
+            yield name, article
     
+    with instrumentation.timer('models.lda.vectorize', items=0) as timer:
+        articles = _SpooledCorpus(get_pairs(), dir_path)
+        dictionary.filter_extremes(no_below=no_below, no_above=no_above, keep_n=keep_n)
+        corpus_path = os.path.join(dir_path, 'corpus.mm')
+        corpora.MmCorpus.serialize(
+            corpus_path, (dictionary.doc2bow(get_lda_terms(article)) for article in articles)
+        )
+        timer.add(len(articles))
+    corpus = corpora.MmCorpus(corpus_path)
+    with instrumentation.timer('models.lda.train', items=len(articles) * passes):
+        model = LdaMulticore(corpus=corpus, num_topics=num_topics, id2word=dictionary, 
+                             passes=passes, workers=workers, chunksize=chunksize)
+    return model, dictionary, articles.names
+
+
+def _get_pairs(name_to_article):
+    """Return an iterable of (name, article) pairs from a dict or an iterable of pairs."""
+    if isinstance(name_to_article, dict):
+        return name_to_article.items()
+    return name_to_article
+
+
+class _SpooledCorpus:
+    """
+    A re-iterable corpus of articles backed by a temporary file.
+
+    The (name, article) pairs are written to disk one line at a time,
+    and each iteration reads the articles back. Only the names are kept
+    in memory.
+
+    """
+
+    def __init__(self, name_article_pairs, dir_path):
+        self.path = os.path.join(dir_path, 'corpus.txt')
+        self.names = []
+        with open(self.path, 'w', encoding='utf-8') as f:
+            for name, article in name_article_pairs:
+                self.names.append(name)
+                # JSON escapes any line breaks in the article.
+                f.write(json.dumps(article) + '\n')
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+
+class _SpooledTaggedCorpus(_SpooledCorpus):
+    """A spooled corpus that yields `doc2vec.TaggedDocument`s tagged with the names."""
+
+    def __iter__(self):
+        from gensim.models import doc2vec
+        for name, article in zip(self.names, super().__iter__()):
+            yield doc2vec.TaggedDocument(article.split(' '), [name])
@@ -0,0 +1,269 @@
+"""
+This module contains a nearest neighbor index over character vectors.
+
+A `VectorIndex` answers "which characters are most like X" by cosine
+similarity, for doc2vec document vectors or lda topic distributions.
+The vectors are normalized once when they're added, so a query is a
+single matrix product followed by a partial sort, and a batch of
+queries is a single matrix-matrix product.
+
+If `hnswlib` is installed, the index can also keep an HNSW graph over
+the vectors, which answers single queries in well under a millisecond
+at the size of the full corpus at the cost of exact results.
+
+"""
+
+import json
+import os
+import numpy as np
+from . import models
+from . import utils
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+class VectorIndex:
+    """
+    A cosine similarity index over named vectors.
+
+    Args:
+        names (Sequence[str]): The names of the vectors.
+        vectors (numpy.ndarray): A matrix with a row per name.
+        use_hnsw (bool): Whether to answer queries with an approximate
+            HNSW graph rather than exactly. Defaults to true if
+            `hnswlib` is installed.
+        ef (int): The size of the HNSW candidate list used by queries.
+            Larger values are slower but more accurate.
+
+    """
+
+    def __init__(self, names=(), vectors=None, use_hnsw=None, ef=100):
+        if use_hnsw is None:
+            use_hnsw = hnswlib is not None
+        if use_hnsw and hnswlib is None:
+            raise ImportError('hnswlib is required to use an HNSW index.')
+        self.use_hnsw = use_hnsw
+        self.ef = ef
+        self.names = []
+        self.name_to_id = {}
+        self._vectors = None
+        self._size = 0
+        self._hnsw = None
+        if vectors is not None:
+            self.add(names, vectors)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, name):
+        return name in self.name_to_id
+
+    @property
+    def vectors(self):
+        """The normalized vectors, with a row per name."""
+        if self._vectors is None:
+            return None
+        return self._vectors[:self._size]
+
+    @classmethod
+    def from_doc2vec(cls, model, **kwargs):
+        """Return an index over the document vectors of a doc2vec model."""
+        return cls(model.dv.index_to_key, model.dv.vectors, **kwargs)
+
+    @classmethod
+    def from_lda(cls, lda_output, name_to_article, **kwargs):
+        """
+        Return an index over the topic distributions of articles.
+
+        Args:
+            lda_output (tuple): The output of `models.train_lda_model`.
+            name_to_article (Union[dict, Iterable[Tuple[str, str]]]):
+                The articles, prepared like the training articles.
+
+        """
+        names, vectors = models.get_lda_topic_vectors(lda_output, name_to_article)
+        return cls(names, vectors, **kwargs)
+
+    def add(self, names, vectors):
+        """
+        Add named vectors to the index.
+
+        Names that are already in the index have their vectors replaced
+        in the exact index, but can't be replaced in an HNSW graph. A 
+        name that's repeated in `names` gets its last vector. Nothing 
+        is changed if an error is raised.
+
+        """
+        names = list(names)
+        vectors = _normalize(vectors)
+        if len(names) != len(vectors):
+            raise ValueError('There should be one name per vector.')
+        if self._vectors is not None and vectors.shape[1] != self._vectors.shape[1]:
+            raise ValueError('The vectors should all have the same length.')
+        
+        # Map each name to the row of its last vector.
+        name_to_row = {name: row for row, name in enumerate(names)}
+        replaced = [name for name in name_to_row if name in self.name_to_id]
+        if replaced and self._hnsw is not None:
+            raise ValueError(f'{replaced[0]!r} is already in the HNSW index.')
+        
+        if replaced:
+            # Copy memory mapped vectors before they're modified.
+            self._reserve(self._size, vectors.shape[1])
+            for name in replaced:
+                self._vectors[self.name_to_id[name]] = vectors[name_to_row[name]]
+        new_names = [name for name in name_to_row if name not in self.name_to_id]
+        if not new_names:
+            return
+
+        new_rows = vectors[[name_to_row[name] for name in new_names]]
+        new_ids = list(range(self._size, self._size + len(new_names)))
+        self._reserve(self._size + len(new_names), vectors.shape[1])
+        self._vectors[self._size:self._size + len(new_names)] = new_rows
+        self.names.extend(new_names)
+        self.name_to_id.update(zip(new_names, new_ids))
+        self._size += len(new_names)
+        if self.use_hnsw:
+            self._add_to_hnsw(new_rows, new_ids)
+
+    def get_vector(self, name):
+        """Return the normalized vector of `name`."""
+        return self._vectors[self.name_to_id[name]]
+
+    def query(self, vectors, k=10):
+        """
+        Return the `k` nearest neighbors of each query vector.
+
+        Args:
+            vectors (numpy.ndarray): A query vector or a matrix of them.
+            k (int): The number of neighbors per query.
+
+        Returns:
+            List[List[Tuple[str, float]]]: The (name, similarity) pairs
+                of each query's neighbors, most similar first. If a
+                single vector was passed, the list for that vector.
+
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        single = vectors.ndim == 1
+        ids, similarities = self._query(_normalize(np.atleast_2d(vectors)), k)
+        results = [
+            [(self.names[i], float(similarity)) for i, similarity in zip(row_ids, row_similarities)]
+            for row_ids, row_similarities in zip(ids, similarities)
+        ]
+        return results[0] if single else results
+
+    def most_similar(self, names, k=10):
+        """
+        Return the `k` nearest neighbors of indexed names, excluding themselves.
+
+        Args:
+            names (Union[str, Sequence[str]]): A name or a list of them.
+            k (int): The number of neighbors per name.
+
+        Returns:
+            List[List[Tuple[str, float]]]: As in `query`.
+
+        """
+        single = isinstance(names, str)
+        if single:
+            names = [names]
+        ids = [self.name_to_id[name] for name in names]
+        neighbor_ids, similarities = self._query(self._vectors[ids], k + 1)
+        results = []
+        for query_id, row_ids, row_similarities in zip(ids, neighbor_ids, similarities):
+            row = [(self.names[i], float(similarity))
+                   for i, similarity in zip(row_ids, row_similarities) if i != query_id]
+            results.append(row[:k])
+        return results[0] if single else results
+
+    def save(self, file_name):
+        """Save the index to a directory in the data directory."""
+        dir_path = os.path.join(utils.data_dir_path, file_name)
+        os.makedirs(dir_path, exist_ok=True)
+        np.save(os.path.join(dir_path, 'vectors.npy'), self.vectors)
+        with open(os.path.join(dir_path, 'names.json'), 'w', encoding='utf-8') as f:
+            json.dump(self.names, f)
+        if self._hnsw is not None:
+            self._hnsw.save_index(os.path.join(dir_path, 'hnsw.bin'))
+
+    @classmethod
+    def load(cls, file_name, use_hnsw=None, ef=100):
+        """
+        Load an index saved with `save`.
+
+        The vectors are memory mapped until more are added. A saved HNSW
+        graph is reused if there is one, and otherwise built if
+        `use_hnsw` is true.
+
+        """
+        dir_path = os.path.join(utils.data_dir_path, file_name)
+        with open(os.path.join(dir_path, 'names.json'), encoding='utf-8') as f:
+            names = json.load(f)
+        index = cls(use_hnsw=use_hnsw, ef=ef)
+        index.names = names
+        index.name_to_id = {name: i for i, name in enumerate(names)}
+        index._vectors = np.load(os.path.join(dir_path, 'vectors.npy'), mmap_mode='r')
+        index._size = len(names)
+
+        hnsw_path = os.path.join(dir_path, 'hnsw.bin')
+        if index.use_hnsw and os.path.isfile(hnsw_path):
+            index._hnsw = hnswlib.Index(space='ip', dim=index._vectors.shape[1])
+            index._hnsw.load_index(hnsw_path, max_elements=len(names))
+            index._hnsw.set_ef(ef)
+        elif index.use_hnsw and names:
+            index._add_to_hnsw(index.vectors, range(len(names)))
+        return index
+
+    def _reserve(self, size, dim):
+        """Make room for `size` vectors, growing the matrix geometrically."""
+        if self._vectors is not None and len(self._vectors) >= size and self._vectors.flags.writeable:
+            return
+        capacity = max(size, 2 * self._size)
+        vectors = np.empty((capacity, dim), dtype=np.float32)
+        if self._size:
+            vectors[:self._size] = self._vectors[:self._size]
+        self._vectors = vectors
+
+    def _add_to_hnsw(self, vectors, ids):
+        """Add normalized vectors to the HNSW graph, creating it if needed."""
+        if self._hnsw is None:
+            self._hnsw = hnswlib.Index(space='ip', dim=vectors.shape[1])
+            self._hnsw.init_index(max_elements=max(len(vectors), 1), ef_construction=200, M=16)
+            self._hnsw.set_ef(self.ef)
+        needed = self._hnsw.get_current_count() + len(vectors)
+        if needed > self._hnsw.get_max_elements():
+            self._hnsw.resize_index(max(needed, 2 * self._hnsw.get_max_elements()))
+        self._hnsw.add_items(vectors, np.asarray(ids))
+
+    def _query(self, vectors, k):
+        """Return the ids and similarities of the neighbors of normalized vectors."""
+        k = min(k, self._size)
+        if k == 0:
+            empty = np.zeros((len(vectors), 0))
+            return empty.astype(int), empty
+        if self._hnsw is not None:
+            # The HNSW graph needs a candidate list at least as long as k.
+            self._hnsw.set_ef(max(self.ef, k))
+            ids, distances = self._hnsw.knn_query(vectors, k=k)
+            return ids, 1 - distances
+
+        similarities = vectors @ self.vectors.T
+        if k < self._size:
+            ids = np.argpartition(similarities, self._size - k, axis=1)[:, -k:]
+        else:
+            ids = np.tile(np.arange(self._size), (len(vectors), 1))
+        top = np.take_along_axis(similarities, ids, axis=1)
+        order = np.argsort(-top, axis=1)
+        return np.take_along_axis(ids, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+
+def _normalize(vectors):
+    """Return a float32 copy of `vectors` with rows scaled to unit length."""
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
@@ -0,0 +1,415 @@
+"""
+This module contains an on-disk cache of parsed spacy documents.
+
+Parsing with the large spacy model is the slowest part of the pipeline,
+but the text being parsed rarely changes between runs. The cache keys
+each parsed text by the SHA-1 of its contents and stores the resulting
+`Doc` objects in `DocBin` shards under `utils.data_dir_path`. Each model
+(name, version, and enabled pipes) gets its own directory, so changing
+the model invalidates the cache.
+
+Shards are written in the order the documents are parsed, so rerunning
+a step over the same texts in the same order reads each shard once. A
+SQLite index maps keys to shards. When the shards take up more than
+`MAX_CACHE_BYTES`, the least recently used shards are deleted.
+
+The cache is not safe to write to from several processes at once, so
+worker processes should call `init_worker` first, which makes the cache
+read only in that process. The documents a worker parses are kept until
+its task is done and are then sent back to the parent to be cached: run
+the tasks with `functools.partial(run_in_worker, func)` and pass the
+results through `store_worker_results` in the parent. `pipe` with 
+`n_process` greater than one needs none of this, since spacy already 
+sends the documents back to the parent.
+
+"""
+
+import atexit
+import collections
+import hashlib
+import os
+import sqlite3
+import time
+from . import instrumentation
+from . import utils
+
+
+PARSE_CACHE_DIR_NAME = 'parse_cache'
+SHARD_SIZE = 1000
+MAX_CACHE_BYTES = 4 * 1024 ** 3
+# The number of deserialized shards to keep in memory per model.
+LOADED_SHARDS = 4
+
+# The token attributes that are saved. These cover everything the
+# transforms module reads that isn't a lexeme attribute.
+_DOC_BIN_ATTRS = ('ORTH', 'NORM', 'TAG', 'POS', 'LEMMA', 'HEAD', 'DEP', 'ENT_IOB', 'ENT_TYPE')
+_caches = {}
+_read_only = False
+_enabled = True
+
+
+def parse(nlp, text):
+    """
+    Parse `text` with `nlp`, using the cached `Doc` if there is one.
+
+    Args:
+        nlp (spacy.language.Language): The model to parse with.
+        text (str): The text to parse.
+
+    Returns:
+        spacy.tokens.Doc: The parsed text.
+
+    """
+    if not _enabled:
+        return _parse(nlp, text)
+    cache = _get_cache(nlp)
+    key = _get_key(text)
+    doc = cache.get(key)
+    if doc is None:
+        doc = _parse(nlp, text)
+        cache.put(key, doc)
+    else:
+        instrumentation.count('parse_cache.hits')
+    return doc
+
+
+def pipe(nlp, texts, as_tuples=False, batch_size=1000, n_process=1):
+    """
+    Parse `texts` with `nlp.pipe`, skipping texts that are cached.
+
+    Every text is still sent through `nlp.pipe` so that the output
+    stays in order without buffering, but cached texts are replaced
+    with empty strings, which are nearly free to parse.
+
+    Args:
+        nlp (spacy.language.Language): The model to parse with.
+        texts (Iterable[str]): The texts to parse, or (text, context)
+            tuples if `as_tuples` is true.
+        as_tuples (bool): Whether `texts` contains (text, context)
+            tuples as in `nlp.pipe`.
+        batch_size (int): The number of texts to parse per batch.
+        n_process (int): The number of processes to parse with.
+
+    Yields:
+        spacy.tokens.Doc: The parsed texts, or (doc, context) tuples if
+            `as_tuples` is true.
+
+    """
+    if not _enabled:
+        docs = nlp.pipe(texts, as_tuples=as_tuples, batch_size=batch_size, n_process=n_process)
+        get_bytes = (lambda item: len(item[0].text)) if as_tuples else (lambda doc: len(doc.text))
+        yield from instrumentation.time_iterator('spacy.parse', docs, get_bytes)
+        return
+    cache = _get_cache(nlp)
+    cached_docs = collections.deque()
+
+    def get_uncached_texts():
+        for item in texts:
+            text, context = item if as_tuples else (item, None)
+            key = _get_key(text)
+            doc = cache.get(key)
+            cached_docs.append(doc)
+            if doc is None:
+                yield text, (key, context)
+            else:
+                yield '', (key, context)
+
+    parsed_texts = nlp.pipe(get_uncached_texts(), as_tuples=True,
+                            batch_size=batch_size, n_process=n_process)
+    # Cached texts count as items of the stage, but add no bytes.
+    parsed_texts = instrumentation.time_iterator('spacy.parse', parsed_texts, 
+                                                 lambda item: len(item[0].text))
+    for doc, (key, context) in parsed_texts:
+        cached_doc = cached_docs.popleft()
+        if cached_doc is None:
+            cache.put(key, doc)
+        else:
+            doc = cached_doc
+            instrumentation.count('parse_cache.hits')
+        yield (doc, context) if as_tuples else doc
+
+
+def init_worker():
+    """
+    Prepare the cache for use in a worker process.
+
+    Connections inherited from a forked parent are dropped (not closed,
+    since the parent still uses them), and newly parsed documents are
+    no longer written to disk by this process. They're held until 
+    `run_in_worker` sends them to the parent.
+
+    """
+    global _read_only
+    _caches.clear()
+    _read_only = True
+
+
+def run_in_worker(func, task):
+    """
+    Return `func(task)` and the documents parsed in this process while computing it.
+
+    Workers set up by `init_worker` should run their tasks with
+    `functools.partial(run_in_worker, func)`, so that the parent can 
+    cache the documents with `store_worker_results`.
+
+    Returns:
+        Tuple[Any, list]: The result and the parsed documents, as 
+            (model directory name, keys, DocBin bytes) tuples.
+
+    """
+    result = func(task)
+    worker_docs = []
+    for dir_name, cache in _caches.items():
+        if cache.pending:
+            from spacy.tokens import DocBin
+            doc_bin = DocBin(attrs=_DOC_BIN_ATTRS, docs=cache.pending.values())
+            worker_docs.append((dir_name, list(cache.pending), doc_bin.to_bytes()))
+            cache.pending.clear()
+    return result, worker_docs
+
+
+def store_worker_results(results):
+    """
+    Yield the results of `run_in_worker` after caching their documents.
+
+    Args:
+        results (Iterable[Tuple[Any, list]]): The return values of 
+            `run_in_worker` in worker processes.
+
+    Yields:
+        The results of the workers' tasks.
+
+    """
+    for result, worker_docs in results:
+        for dir_name, keys, doc_bin_bytes in worker_docs:
+            if _enabled:
+                _get_cache_by_dir_name(dir_name).put_doc_bin(keys, doc_bin_bytes)
+        yield result
+
+
+def set_enabled(enabled=True):
+    """
+    Turn the cache on or off in this process, e.g. to time parsing.
+    
+    While the cache is off, every text is parsed and nothing is cached.
+    
+    Returns:
+        bool: Whether the cache was on before.
+    
+    """
+    global _enabled
+    was_enabled = _enabled
+    _enabled = enabled
+    return was_enabled
+
+
+def flush():
+    """Write the documents that haven't been saved yet to disk."""
+    for cache in _caches.values():
+        cache.flush()
+
+
+def clear(nlp=None):
+    """Delete the cached documents for `nlp`, or for all models."""
+    flush()
+    cache_dir_path = os.path.join(utils.data_dir_path, PARSE_CACHE_DIR_NAME)
+    if nlp is not None:
+        dir_paths = [os.path.join(cache_dir_path, _get_model_dir_name(nlp))]
+    elif os.path.isdir(cache_dir_path):
+        dir_paths = [os.path.join(cache_dir_path, name) for name in os.listdir(cache_dir_path)]
+    else:
+        dir_paths = []
+
+    for dir_path in dir_paths:
+        cache = _caches.pop(os.path.basename(dir_path), None)
+        if cache is not None:
+            cache.close()
+        if not os.path.isdir(dir_path):
+            continue
+        for file_name in os.listdir(dir_path):
+            os.remove(os.path.join(dir_path, file_name))
+        os.rmdir(dir_path)
+
+
+def _parse(nlp, text):
+    """Parse `text` with `nlp`, timed as a `spacy.parse` stage."""
+    with instrumentation.timer('spacy.parse', num_bytes=len(text)):
+        return nlp(text)
+
+
+def _get_cache(nlp):
+    """Return the cache for `nlp`, opening it if needed."""
+    cache = _get_cache_by_dir_name(_get_model_dir_name(nlp))
+    # Caches opened to store a worker's documents have no vocab yet.
+    if cache.vocab is None:
+        cache.vocab = nlp.vocab
+    return cache
+
+
+def _get_cache_by_dir_name(dir_name):
+    """Return the cache with the given directory name, opening it if needed."""
+    if dir_name not in _caches:
+        dir_path = os.path.join(utils.data_dir_path, PARSE_CACHE_DIR_NAME, dir_name)
+        _caches[dir_name] = _ParseCache(dir_path)
+    return _caches[dir_name]
+
+
+def _get_model_dir_name(nlp):
+    """Return a directory name that identifies the model and its pipes."""
+    meta = nlp.meta
+    pipes = '+'.join(nlp.pipe_names) or 'tokenizer'
+    return f"{meta.get('lang')}_{meta.get('name')}-{meta.get('version')}-{pipes}"
+
+
+def _get_key(text):
+    """Return the cache key of `text`."""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class _ParseCache:
+    """The cached documents of a single model."""
+
+    def __init__(self, dir_path, vocab=None):
+        self.dir_path = dir_path
+        self.vocab = vocab
+        os.makedirs(dir_path, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(dir_path, 'index.sqlite'))
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS docs '
+            '(key TEXT PRIMARY KEY, shard INTEGER, position INTEGER)'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS shards '
+            '(shard INTEGER PRIMARY KEY, size INTEGER, last_used REAL)'
+        )
+        self.conn.commit()
+        self.pending = collections.OrderedDict()
+        # Documents from worker processes, kept serialized.
+        self.pending_doc_bin = None
+        self.pending_doc_bin_keys = {}
+        self.loaded_shards = collections.OrderedDict()
+        self.shard_last_used = {}
+
+    def get(self, key):
+        """Return the cached document for `key`, or None."""
+        if key in self.pending:
+            return self.pending[key]
+        if key in self.pending_doc_bin_keys:
+            self.flush()
+        row = self.conn.execute(
+            'SELECT shard, position FROM docs WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        shard, position = row
+        docs = self._load_shard(shard)
+        if docs is None:
+            return None
+        self.shard_last_used[shard] = time.time()
+        return docs[position]
+
+    def put(self, key, doc):
+        """Add a document to the cache, or hold it for the parent in a worker."""
+        self.pending[key] = doc
+        if len(self.pending) + len(self.pending_doc_bin_keys) >= SHARD_SIZE:
+            self.flush()
+
+    def put_doc_bin(self, keys, doc_bin_bytes):
+        """Add the serialized documents from a worker process to the cache."""
+        from spacy.tokens import DocBin
+        doc_bin = DocBin().from_bytes(doc_bin_bytes)
+        if self.pending_doc_bin is None:
+            offset = 0
+            self.pending_doc_bin = doc_bin
+        else:
+            offset = len(self.pending_doc_bin)
+            self.pending_doc_bin.merge(doc_bin)
+        # Keys repeat if workers parsed the same text, in which case the
+        # last copy is used.
+        for i, key in enumerate(keys, offset):
+            self.pending_doc_bin_keys[key] = i
+        if len(self.pending) + len(self.pending_doc_bin_keys) >= SHARD_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Write the pending documents to a new shard and evict old shards."""
+        # Workers hold their documents until the parent takes them.
+        if _read_only:
+            return
+        if self.pending or self.pending_doc_bin is not None:
+            shard = self.conn.execute('SELECT COALESCE(MAX(shard), 0) + 1 FROM shards').fetchone()[0]
+            from spacy.tokens import DocBin
+            doc_bin = DocBin(attrs=_DOC_BIN_ATTRS, docs=self.pending.values())
+            key_positions = [(key, i) for i, key in enumerate(self.pending)]
+            if self.pending_doc_bin is not None:
+                doc_bin.merge(self.pending_doc_bin)
+                key_positions.extend((key, len(self.pending) + i) 
+                                     for key, i in self.pending_doc_bin_keys.items())
+            path = self._get_shard_path(shard)
+            with open(path, 'wb') as f:
+                f.write(doc_bin.to_bytes())
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO docs VALUES (?, ?, ?)',
+                    ((key, shard, i) for key, i in key_positions)
+                )
+                self.conn.execute(
+                    'INSERT INTO shards VALUES (?, ?, ?)',
+                    (shard, os.path.getsize(path), time.time())
+                )
+            self.pending.clear()
+            self.pending_doc_bin = None
+            self.pending_doc_bin_keys.clear()
+
+        with self.conn:
+            self.conn.executemany(
+                'UPDATE shards SET last_used = ? WHERE shard = ?',
+                ((last_used, shard) for shard, last_used in self.shard_last_used.items())
+            )
+        self.shard_last_used.clear()
+        self._evict()
+
+    def close(self):
+        """Close the index without flushing."""
+        self.conn.close()
+
+    def _load_shard(self, shard):
+        """Return the documents in a shard, keeping recent shards in memory."""
+        if shard in self.loaded_shards:
+            self.loaded_shards.move_to_end(shard)
+            return self.loaded_shards[shard]
+        path = self._get_shard_path(shard)
+        if not os.path.isfile(path):
+            return None
+        from spacy.tokens import DocBin
+        with open(path, 'rb') as f:
+            doc_bin = DocBin().from_bytes(f.read())
+        docs = list(doc_bin.get_docs(self.vocab))
+        self.loaded_shards[shard] = docs
+        if len(self.loaded_shards) > LOADED_SHARDS:
+            self.loaded_shards.popitem(last=False)
+        return docs
+
+    def _evict(self):
+        """Delete the least recently used shards until the cache fits."""
+        total_size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM shards').fetchone()[0]
+        if total_size <= MAX_CACHE_BYTES:
+            return
+        shards = self.conn.execute('SELECT shard, size FROM shards ORDER BY last_used').fetchall()
+        with self.conn:
+            for shard, size in shards:
+                if total_size <= MAX_CACHE_BYTES:
+                    break
+                self.conn.execute('DELETE FROM docs WHERE shard = ?', (shard,))
+                self.conn.execute('DELETE FROM shards WHERE shard = ?', (shard,))
+                self.loaded_shards.pop(shard, None)
+                path = self._get_shard_path(shard)
+                if os.path.isfile(path):
+                    os.remove(path)
+                total_size -= size
+
+    def _get_shard_path(self, shard):
+        return os.path.join(self.dir_path, f'{shard:06d}.spacy')
+
+
+atexit.register(flush)
@@ -0,0 +1,198 @@
+"""
+This module contains a columnar article store backed by SQLite.
+
+Unlike the pickled dicts saved with `utils.save_data`, the store doesn't
+have to be loaded in full before it can be used. Each version of the
+articles (raw, cleaned, tokenized, lemmatized, ...) is kept in its own
+table keyed by the article's id, so reading one column never touches
+the others, and adding articles or columns doesn't rewrite the file.
+The database is memory mapped, so reads come straight from the page
+cache rather than through read calls.
+
+"""
+
+import os
+import re
+import sqlite3
+from . import utils
+
+
+ARTICLE_STORE_FILE_NAME = 'articles.sqlite'
+
+_MMAP_SIZE = 2 ** 40
+_COLUMN_NAME_PATTERN = re.compile(r'^[a-z][a-z0-9_]*$')
+
+
+class ArticleStore:
+    """
+    A store of articles with a text column per version of the articles.
+
+    Articles are kept in the order they were first added. The usual 
+    columns are `raw`, `cleaned`, `tokenized`, and `lemmatized`, but any
+    name made of lower case letters, digits, and underscores can be 
+    used, e.g. for a differently cleaned version.
+
+    Args:
+        file_name (str): The name of the store in the data directory.
+
+    """
+
+    def __init__(self, file_name=ARTICLE_STORE_FILE_NAME):
+        self.file_name = file_name
+        self.path = os.path.join(utils.data_dir_path, file_name)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute(f'PRAGMA mmap_size = {_MMAP_SIZE}')
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS articles (id INTEGER PRIMARY KEY, name TEXT UNIQUE)'
+        )
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM articles').fetchone()[0]
+
+    def __contains__(self, name):
+        row = self.conn.execute('SELECT 1 FROM articles WHERE name = ?', (name,)).fetchone()
+        return row is not None
+
+    def close(self):
+        """Close the connection to the store."""
+        self.conn.close()
+
+    def get_columns(self):
+        """Return the names of the columns in the store."""
+        rows = self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'column_%'"
+        )
+        return [name[len('column_'):] for name, in rows]
+
+    def get_names(self):
+        """Return the names of the articles in the store."""
+        return [name for name, in self.conn.execute('SELECT name FROM articles ORDER BY id')]
+
+    def put(self, column, name_text_pairs):
+        """
+        Add or replace the `column` text of articles.
+
+        Articles that aren't in the store yet are appended.
+
+        Args:
+            column (str): The name of the column.
+            name_text_pairs (Iterable[Tuple[str, str]]): (name, text)
+                pairs, or a dict mapping names to text.
+
+        Returns:
+            int: The number of texts written.
+
+        """
+        table = self._get_table(column, create=True)
+        if isinstance(name_text_pairs, dict):
+            name_text_pairs = name_text_pairs.items()
+        num_written = 0
+        with self.conn:
+            for name, text in name_text_pairs:
+                self.conn.execute('INSERT OR IGNORE INTO articles (name) VALUES (?)', (name,))
+                self.conn.execute(
+                    f'INSERT OR REPLACE INTO {table} (id, text) '
+                    'SELECT id, ? FROM articles WHERE name = ?',
+                    (text, name)
+                )
+                num_written += 1
+        return num_written
+
+    def get(self, name, column='raw'):
+        """Return the `column` text of an article, or None if it's missing."""
+        table = self._get_table(column)
+        row = self.conn.execute(
+            f'SELECT {table}.text FROM articles JOIN {table} USING (id) WHERE articles.name = ?',
+            (name,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def iter_articles(self, columns=('raw',), names=None, limit=None):
+        """
+        Yield (name, text, ...) tuples with the texts of the given columns.
+
+        Only articles that have all of the columns are yielded.
+
+        Args:
+            columns (Sequence[str]): The columns to read.
+            names (Iterable[str]): The names of the articles to read.
+                Defaults to all of the articles, in the order they were
+                added.
+            limit (int): The maximum number of articles to yield.
+
+        Yields:
+            tuple: The name of each article followed by its texts.
+
+        """
+        tables = [self._get_table(column) for column in columns]
+        selected = ', '.join(f'{table}.text' for table in tables)
+        joins = ' '.join(f'JOIN {table} USING (id)' for table in tables)
+        query = f'SELECT articles.name, {selected} FROM articles {joins}'
+
+        if names is None:
+            query += ' ORDER BY articles.id'
+            if limit is not None:
+                query += f' LIMIT {int(limit)}'
+            yield from self.conn.execute(query)
+            return
+
+        query += ' WHERE articles.name = ?'
+        num_yielded = 0
+        for name in names:
+            if limit is not None and num_yielded >= limit:
+                return
+            row = self.conn.execute(query, (name,)).fetchone()
+            if row is not None:
+                num_yielded += 1
+                yield row
+
+    def get_articles(self, column='raw', names=None, limit=None):
+        """Return a dict mapping names to the `column` text of articles."""
+        return dict(self.iter_articles((column,), names=names, limit=limit))
+
+    def delete_column(self, column):
+        """Delete a column from the store."""
+        table = self._get_table(column)
+        with self.conn:
+            self.conn.execute(f'DROP TABLE {table}')
+
+    def archive(self):
+        """
+        Save a copy of the store to the archive folder.
+
+        The copy is versioned like the files moved by `utils.archive_data`,
+        but the store itself stays in place so it can keep growing.
+
+        Returns:
+            str: The path of the archived copy.
+
+        """
+        archive_path = utils.get_archive_path(self.file_name)
+        archive_conn = sqlite3.connect(archive_path)
+        try:
+            self.conn.backup(archive_conn)
+        finally:
+            archive_conn.close()
+        return archive_path
+
+    def _get_table(self, column, create=False):
+        """Return the name of the table holding `column`."""
+        if not _COLUMN_NAME_PATTERN.match(column):
+            raise ValueError(f'Invalid column name: {column!r}')
+        table = 'column_' + column
+        if create:
+            self.conn.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} '
+                '(id INTEGER PRIMARY KEY REFERENCES articles (id), text TEXT)'
+            )
+        elif column not in self.get_columns():
+            raise KeyError(f'The store has no {column!r} column.')
+        return table
@@ -4,14 +4,65 @@ This module contains text transformation functions.
 """
 
 
+import collections
+import functools
+import json
+import os
 import re
-import spacy
+from . import instrumentation
+from . import parse_cache
 from . import utils
 
 
-_word_black_list = sorted(utils.load_values('character_article_word_black_list.csv'), 
-                          key=lambda x: -len(x))
-_model_cache = {}
+# Spacy and the black list are loaded on first use, so importing this 
+# module is cheap. `_word_black_list` and `_word_black_list_patterns` 
+# are provided by the module's `__getattr__`.
+_model_cache = {}  # In least recently used order.
+
+_REGEX_SPECIAL_CHARS = set('.^$*+?{}[]\\|()')
+_MULTIPLE_SPACES = re.compile(r'\s{2,}')
+_ADJACENT_NON_WORD_CHARS = re.compile(r'\W\W')
+_NON_WORD_CHAR_AT_EDGE = re.compile(r'^\W|\W$')
+_ALLOWED_PUNCT = set('.?!,')
+_SUBJECT_TEXT_REMOVE_PATTERNS = [re.compile(p) for p in (r'\(.+?\)', r'\[.+?\]', r'#')]
+# The minimal model is only used for `_doc_to_tokens` and 
+# `_doc_to_lemmas`, which need nothing but the tokenizer. Its lemmatizer
+# needs the tagger's parts of speech, and without them it only lower 
+# cases the text (with warning W108), which `_doc_to_lemmas` does anyway.
+_MINIMAL_MODEL_EXCLUDED = ['tok2vec', 'tagger', 'parser', 'senter', 'attribute_ruler', 
+                           'lemmatizer', 'ner']
+
+# A rendering friendly version of the output of `extract_phrase`. Each
+# field is a list with an entry per token, and `flags` is a bit set of
+# the PHRASE_* flags below.
+Phrase = collections.namedtuple('Phrase', ['texts', 'lemmas', 'flags'])
+PHRASE_META = 1  # A str meta-token, e.g. <SUBJECT>.
+PHRASE_PUNCT = 2
+PHRASE_STOP = 4
+PHRASE_NUM = 8
+PHRASE_ATTACHED = 16  # Not preceded by a space, e.g. punctuation or n't.
+
+_RENDER_DEFAULTS = {
+    'spaces_before_punct': False,
+    'cap_first_word': True,
+    'convert_to_lemmas': False,
+    'remove_stop_words': False,
+    'remove_punct': False,
+    'lower_case': False,
+    'remove_numbers': False
+}
+TOKENIZED_PHRASE_OPTIONS = {
+    'spaces_before_punct': True,
+    'lower_case': True,
+    'remove_numbers': True
+}
+LEMMATIZED_PHRASE_OPTIONS = {
+    'remove_punct': True,
+    'convert_to_lemmas': True,
+    'remove_stop_words': True,
+    'lower_case': True,
+    'remove_numbers': True
+}
 
 
 #
@@ -19,6 +70,7 @@ _model_cache = {}
 #
 
 
+@instrumentation.timed('transforms.extract_phrase')
 def extract_phrase(subject_token, target_name):
     """
     Extract a list of tokens that are in the same clause as the target.
@@ -35,6 +87,7 @@ def extract_phrase(subject_token, target_name):
     """
     # Iterate over all tokens in the subtree, replacing some with
     # meta-tokens.
+    target_name = target_name.lower()
     selected_tokens = []
     for token in subject_token.head.subtree:
         # If the token is a space or newline, continue.
@@ -45,7 +98,7 @@ def extract_phrase(subject_token, target_name):
         if (token == subject_token 
                 or (subject_token == token.head 
                     and token.dep_ == 'compound' 
-                    and token.text.lower() in target_name.lower())
+                    and token.text.lower() in target_name)
                 or ('nsubj' in token.dep_ and token.pos_ == 'PRON')):
             selected_tokens.append('<SUBJECT>')
         elif token.ent_type_ and not token.is_punct:
@@ -118,19 +171,57 @@ def get_subject_tokens(text, target_name):
             of clauses about target_name.
     
     """
-    remove_patterns = [r'\(.+?\)', r'\[.+?\]', r'#']
-    for pattern in remove_patterns:
-        text = re.sub(pattern, '', text)
+    parsed = parse_cache.parse(get_large_model(), _clean_subject_text(text))
+    return _select_subject_tokens(parsed, target_name)
+
+
+def iter_subject_tokens(items, batch_size=1000, n_process=1):
+    """
+    Extract subject tokens for many texts using `nlp.pipe`.
     
-    nlp_model = get_large_model()
-    parsed = nlp_model(text)
+    This is the batched version of `get_subject_tokens`. The texts
+    are parsed in batches and, if `n_process` is greater than one, in
+    several processes, and the results are yielded in input order.
+    Texts that are in the parse cache aren't parsed again.
+    
+    Args:
+        items (Iterable[Tuple[str, str, Any]]): (text, target_name,
+            context) triples. The context is passed through untouched
+            so that callers can route the results.
+        batch_size (int): The number of texts to parse per batch.
+        n_process (int): The number of processes to parse with.
+    
+    Yields:
+        Tuple[List[spacy.tokens.token.Token], Any]: The subject tokens
+            of each text and its context.
     
+    """
+    nlp_model = get_large_model()
+    texts = ((_clean_subject_text(text), (target_name, context)) 
+             for text, target_name, context in items)
+    parsed_texts = parse_cache.pipe(nlp_model, texts, as_tuples=True, 
+                                    batch_size=batch_size, n_process=n_process)
+    for parsed, (target_name, context) in parsed_texts:
+        yield _select_subject_tokens(parsed, target_name), context
+
+
+def _clean_subject_text(text):
+    """Remove the parenthetical and bracketed asides from `text`."""
+    for pattern in _SUBJECT_TEXT_REMOVE_PATTERNS:
+        text = pattern.sub('', text)
+    return text
+
+
+@instrumentation.timed('transforms.select_subject_tokens')
+def _select_subject_tokens(parsed, target_name):
+    """Return the subject tokens about `target_name` in a parsed doc."""
+    target_name = target_name.lower()
     is_subject = []
     subjects_of_interest = []
     for token in parsed:
         token_is_subject = ('nsubj' in token.dep_ 
                             and token.pos_ == 'PROPN' 
-                            and token.text.lower() in target_name.lower())
+                            and token.text.lower() in target_name)
         token_is_subj_pron = (token.pos_ == 'PRON' and is_subject and is_subject[-1])
         if token_is_subject or token_is_subj_pron:
             is_subject.append(True)
@@ -138,90 +229,219 @@ def get_subject_tokens(text, target_name):
         else:
             is_subject.append(False)
     
-    # Keep the subjects with the highest level root.
+    # Keep the subjects with the highest level root, i.e. drop a subject
+    # if the head of any other subject is one of its ancestors. Rather 
+    # than compare every pair of subjects, count the subjects attached
+    # to each head and sum the counts along each subject's ancestors.
+    head_counts = collections.Counter(token.head.i for token in subjects_of_interest)
+    ancestor_counts = {}
     output = []
     for token in subjects_of_interest:
-        for other_token in subjects_of_interest:
-            if token != other_token and other_token.head.is_ancestor(token):
-                break
-        else:
+        count = _count_ancestor_heads(token, head_counts, ancestor_counts)
+        # The subject's own head is one of its ancestors unless it's
+        # the root, so don't count it.
+        if token.head.i != token.i:
+            count -= 1
+        if count == 0:
             output.append(token)
     
     return output
 
 
+def _count_ancestor_heads(token, head_counts, ancestor_counts):
+    """
+    Return the sum of `head_counts` over the ancestors of `token`.
+    
+    The sums are memoized in `ancestor_counts` by token index, so the
+    ancestors shared by many tokens are only walked once per doc.
+    
+    """
+    path = []
+    while token.i not in ancestor_counts:
+        if token.head.i == token.i:
+            ancestor_counts[token.i] = 0
+            break
+        path.append(token)
+        token = token.head
+    for token in reversed(path):
+        ancestor_counts[token.i] = ancestor_counts[token.head.i] + head_counts[token.head.i]
+    return ancestor_counts[path[0].i] if path else ancestor_counts[token.i]
+
+
+@instrumentation.timed('transforms.tokens_to_str')
 def tokens_to_str(tokens, spaces_before_punct=False, cap_first_word=True, 
                   add_period=True, convert_to_lemmas=False, remove_stop_words=False, 
                   remove_punct=False, lower_case=False, remove_numbers=False):    
-    """Convert a list of spacy tokens and str meta-tokens into a single sentence string."""
-    # TODO: This function is one big hack. Refractor or replace.
+    """
+    Convert a list of spacy tokens and str meta-tokens into a single sentence string.
     
+    This is a wrapper around `phrase_from_tokens` and `render_phrase`.
+    Unlike earlier versions, it doesn't modify `tokens`.
+    
+    """
+    phrase = phrase_from_tokens(tokens)
     if add_period and not remove_punct:
-        if isinstance(tokens[-1], str) or not tokens[-1].is_punct:
-            tokens.append('.')
-        elif tokens[-1].is_punct:
-            if tokens[-1].text in ',:;':
-                tokens.pop()
-                tokens.append('.')    
-    
-    strings = []
-    for i, token in enumerate(tokens):
+        phrase = add_phrase_period(phrase)
+    options = {
+        'spaces_before_punct': spaces_before_punct,
+        'cap_first_word': cap_first_word,
+        'convert_to_lemmas': convert_to_lemmas,
+        'remove_stop_words': remove_stop_words,
+        'remove_punct': remove_punct,
+        'lower_case': lower_case,
+        'remove_numbers': remove_numbers
+    }
+    return render_phrase(phrase, [options])[0]
+
+
+def phrase_from_tokens(tokens):
+    """
+    Convert a list of spacy tokens and str meta-tokens into a `Phrase`.
+    
+    A `Phrase` holds parallel lists of the text, lemma, and flags of
+    each entry, so that rendering it doesn't have to touch the spacy 
+    tokens. Meta-tokens have the `PHRASE_META` flag and are their own
+    lemma.
+    
+    """
+    texts = []
+    lemmas = []
+    flags = []
+    for token in tokens:
+        if isinstance(token, str):
+            texts.append(token)
+            lemmas.append(token)
+            # Note that this is a substring check, so the empty string
+            # counts as punctuation too.
+            flags.append(PHRASE_META | (PHRASE_ATTACHED if token in '.' else 0))
+            continue
+        token_flags = 0
+        if token.is_punct:
+            token_flags |= PHRASE_PUNCT | PHRASE_ATTACHED
+        if token.dep_ == 'case' or token.text == "n't":
+            token_flags |= PHRASE_ATTACHED
+        if token.is_stop:
+            token_flags |= PHRASE_STOP
+        if token.pos_ == 'NUM':
+            token_flags |= PHRASE_NUM
+        texts.append(token.text)
+        lemmas.append(token.lemma_)
+        flags.append(token_flags)
+    return Phrase(texts, lemmas, flags)
+
+
+def add_phrase_period(phrase):
+    """
+    Return a copy of `phrase` that ends with a period.
+    
+    A period meta-token is added unless the phrase already ends with
+    punctuation, in which case a trailing comma, colon, or semicolon 
+    is replaced with the period.
+    
+    """
+    texts, lemmas, flags = list(phrase.texts), list(phrase.lemmas), list(phrase.flags)
+    if flags[-1] & PHRASE_META or not flags[-1] & PHRASE_PUNCT:
+        pass
+    elif texts[-1] in ',:;':
+        del texts[-1], lemmas[-1], flags[-1]
+    else:
+        return Phrase(texts, lemmas, flags)
+    texts.append('.')
+    lemmas.append('.')
+    flags.append(PHRASE_META | PHRASE_ATTACHED)
+    return Phrase(texts, lemmas, flags)
+
+
+@instrumentation.timed('transforms.render_phrase')
+def render_phrase(phrase, option_sets):
+    """
+    Render a `Phrase` as one string per set of options, in a single pass.
+    
+    Args:
+        phrase (Phrase): The phrase to render.
+        option_sets (List[Dict[str, bool]]): Dicts with the 
+            `spaces_before_punct`, `cap_first_word`, `convert_to_lemmas`,
+            `remove_stop_words`, `remove_punct`, `lower_case`, and
+            `remove_numbers` options of `tokens_to_str`. Missing options
+            take the `tokens_to_str` defaults.
+    
+    Returns:
+        List[str]: The rendered string for each set of options.
+    
+    """
+    # TODO: This preserves the quirks of the original tokens_to_str,
+    # which was one big hack. Most of the space handling could be
+    # simplified by looking at the output strings instead.
+    texts, lemmas, flags = phrase
+    variants = []
+    for options in option_sets:
+        options = {**_RENDER_DEFAULTS, **options}
+        skip_flags = ((PHRASE_STOP if options['remove_stop_words'] else 0)
+                      | (PHRASE_NUM if options['remove_numbers'] else 0)
+                      | (PHRASE_PUNCT if options['remove_punct'] else 0))
+        # Each variant tracks its output strings and the number of 
+        # quotation marks in them.
+        variants.append((options, skip_flags, [], [0]))
+    
+    for i, token_flags in enumerate(flags):
+        is_meta = token_flags & PHRASE_META
         is_first_word = i == 0
+        text = texts[i]
+        follows_token = i >= 1 and not is_meta and not flags[i - 1] & PHRASE_META
+        is_hyphen = not is_meta and text == '-'
+        is_word_after_hyphen = (follows_token and not token_flags & PHRASE_PUNCT 
+                                and texts[i - 1] == '-')
+        is_quote = not is_meta and text == '"'
         
-        # TODO: Most of these, especially skip_space, can be simplified
-        # by looking at the stings and not the tokens. Much of the
-        # complexity is dealing with the fact that (1) the inputs can
-        # either either strings or spacy tokens.
-        cur_not_string = not isinstance(token, str)
-        last_two_not_str = i >= 1 and cur_not_string and not isinstance(tokens[i - 1], str)
-        last_three_not_str = i >= 2 and last_two_not_str and not isinstance(tokens[i - 2], str)
-        is_hyphen = cur_not_string and token.text == '-'
-        is_word_after_hyphen = last_two_not_str and not token.is_punct and tokens[i - 1].text == '-'    
-        cur_is_punct = ((cur_not_string and (token.is_punct or token.dep_ == 'case' or token.text == "n't")) 
-                        or not cur_not_string and token in ('.'))
-        is_open_quote = cur_not_string and token.text == '"' and sum(1 for s in strings if s == '"') % 2 == 0
-        last_is_open_quote = strings and strings[-1] == '"' and sum(1 for s in strings if s == '"') % 2 != 0
-        skip_space = is_first_word or ((is_hyphen or is_word_after_hyphen) and not remove_punct)
-        
-        if remove_stop_words and cur_not_string and token.is_stop:
-            continue
+        for options, skip_flags, strings, num_quotes in variants:
+            if not is_meta and token_flags & skip_flags:
+                continue
             
-        if remove_numbers and cur_not_string and token.pos_ == 'NUM':
-            continue
+            skip_space = is_first_word or ((is_hyphen or is_word_after_hyphen) 
+                                           and not options['remove_punct'])
+            if not options['spaces_before_punct']:
+                if token_flags & PHRASE_ATTACHED:
+                    skip_space = True
+                if is_quote and num_quotes[0] % 2 == 0:
+                    skip_space = False
+                if strings and strings[-1] == '"' and num_quotes[0] % 2 != 0:
+                    skip_space = True
             
-        if remove_punct and cur_not_string and token.is_punct:
-            continue
-        
-        if not spaces_before_punct:
-            skip_space = True if cur_is_punct and not spaces_before_punct else skip_space
-            skip_space = False if is_open_quote else skip_space
-            skip_space = True if last_is_open_quote else skip_space
-        
-        if not isinstance(token, str):
-            if not convert_to_lemmas:
-                token = token.text
-            else:
-                token = token.lemma_
-        
-        token = token.strip()
-        if not token:
-            continue
-        
-        if not skip_space:
-            strings.append(' ')
+            string = lemmas[i] if options['convert_to_lemmas'] else text
+            string = string.strip()
+            if not string:
+                continue
             
-        if cap_first_word and not lower_case and is_first_word and '<' not in token:
-            token = token.capitalize()
+            if not skip_space:
+                strings.append(' ')
             
-        if lower_case and '<' not in token:
-            token = token.lower()
+            if '<' not in string:
+                if options['lower_case']:
+                    string = string.lower()
+                elif options['cap_first_word'] and is_first_word:
+                    string = string.capitalize()
             
-        strings.append(token)
+            strings.append(string)
+            if string == '"':
+                num_quotes[0] += 1
+    
+    return [''.join(strings).strip() for _, _, strings, _ in variants]
+
+
+def extracted_phrase_to_strs(tokens):
+    """
+    Render the output of `extract_phrase` for `extract_phrases_about_subject`.
     
-    # TODO the strip here shouldn't be needed, but some of them are starting with 
-    # with blanks in lemmatized version. It's probably the space being added after 
-    # `if not skip_space:`
-    return ''.join(strings).strip()  
+    Returns:
+        Tuple[str, str]: The tokenized version, which is lower case but 
+            keeps punctuation and stop words, and the lemmatized version,
+            which drops them. Both end in a period.
+    
+    """
+    phrase = add_phrase_period(phrase_from_tokens(tokens))
+    tokenized, lemmatized = render_phrase(phrase, [TOKENIZED_PHRASE_OPTIONS, 
+                                                   LEMMATIZED_PHRASE_OPTIONS])
+    return tokenized, lemmatized
 
 
 def filter_subtree(head, rules):
@@ -250,9 +470,8 @@ def filter_subtree(head, rules):
 
 def remove_entities_and_prop_nouns(text):
     """Remove named entities and proper nouns from the input text."""
-    nlp_model = get_large_model()
     output = []
-    for token in nlp_model(text):
+    for token in parse_cache.parse(get_large_model(), text):
         if (token.pos_ == 'PROPN' 
                 or token.lemma_ == '-PRON-'
                 or token.text == "'s"
@@ -264,16 +483,135 @@ def remove_entities_and_prop_nouns(text):
     return ' '.join(output)
 
 
+@instrumentation.timed('transforms.remove_black_listed_words')
 def remove_black_listed_words(text):
-    """Black listed terms from the input text."""
-    for pattern in _word_black_list:
-        pattern = r'\b' + pattern + r'\b'
-        text = re.sub(pattern, '', text, flags=re.IGNORECASE)
-    text = re.sub(r'\s{2,}', ' ', text)
+    """
+    Remove black listed terms from the input text.
+    
+    The terms are matched by a few regexes (usually just one) built once
+    by `_compile_word_list`, which remove the same text as removing each
+    term in turn, longest first.
+    
+    """
+    for pattern in _get_word_black_list_patterns():
+        text = pattern.sub('', text)
+    text = _MULTIPLE_SPACES.sub(' ', text)
     text = text.strip()
     return text
 
 
+remove_black_listed = remove_black_listed_words
+
+
+def remove_black_listed_words_from_articles(name_to_article):
+    """Return a copy of `name_to_article` with black listed terms removed."""
+    return {name: remove_black_listed_words(text) for name, text in name_to_article.items()}
+
+
+def _compile_word_list(words):
+    """
+    Compile a list of terms, longest first, into case insensitive regexes.
+    
+    Substituting the regexes in order removes the same text as removing
+    each term as a whole word in turn. Runs of terms are merged into a
+    trie (e.g. `main(?: character)?`), so the regex engine doesn't have 
+    to try each term at every position. A run is only broken where the
+    earlier terms have to be removed first: by a term that can overlap
+    the end of one in the run, e.g. `deal breaker` after `big deal`, or
+    whose matches can depend on removing one, e.g. `a--b` in `a-x-b`.
+    Terms that contain regex syntax get a regex of their own.
+    
+    Returns:
+        List[re.Pattern]: The regexes.
+    
+    """
+    patterns = []
+    run = []
+    for word in words:
+        is_literal = not _REGEX_SPECIAL_CHARS & set(word)
+        if (is_literal and not _depends_on_removal(word, run)
+                and not any(_words_overlap(word, other) for other in run)):
+            run.append(word)
+            continue
+        if run:
+            patterns.append(_compile_trie(run))
+        if is_literal:
+            run = [word]
+        else:
+            run = []
+            patterns.append(re.compile(rf'\b{word}\b', flags=re.IGNORECASE))
+    if run:
+        patterns.append(_compile_trie(run))
+    return patterns
+
+
+def _compile_trie(words):
+    """Compile plain terms into a regex that matches the longest as a whole word."""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word.lower():
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return re.compile(rf'\b{_trie_to_pattern(trie)}\b', flags=re.IGNORECASE)
+
+
+def _depends_on_removal(word, words):
+    """
+    Return whether removing `words` first can change where `word` matches.
+    
+    A removed term is a whole word, so the characters left on either 
+    side of it are both non-word characters, and the characters that
+    become its neighbours are word characters, unless a term starts or
+    ends with a non-word character.
+    
+    """
+    return (_ADJACENT_NON_WORD_CHARS.search(word) is not None
+            or any(_NON_WORD_CHAR_AT_EDGE.search(term) for term in [word, *words]))
+
+
+def _words_overlap(word, other):
+    """Return whether the end of either term can be the start of the other."""
+    word, other = word.lower(), other.lower()
+    return any(word.endswith(other[:i]) or other.endswith(word[:i]) 
+               for i in range(1, min(len(word), len(other))))
+
+
+def _trie_to_pattern(node):
+    """Convert a trie of characters into a regex that prefers longer matches."""
+    alternatives = [re.escape(char) + _trie_to_pattern(child) 
+                    for char, child in sorted(node.items()) if char]
+    if not alternatives:
+        return ''
+    if len(alternatives) == 1 and '' not in node:
+        return alternatives[0]
+    pattern = '(?:' + '|'.join(alternatives) + ')'
+    # The optional group is greedy, so the longer terms are tried first.
+    return pattern + '?' if '' in node else pattern
+
+
+@functools.lru_cache(maxsize=None)
+def _get_word_black_list():
+    """Return the black listed terms, longest first, loading them only once."""
+    words = utils.load_values('character_article_word_black_list.csv')
+    return sorted(words, key=lambda x: -len(x))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_word_black_list_patterns():
+    """Return the compiled regexes of the black listed terms."""
+    return _compile_word_list(_get_word_black_list())
+
+
+def __getattr__(name):
+    # Load the black list when it's first accessed as an attribute.
+    if name == '_word_black_list':
+        return _get_word_black_list()
+    if name == '_word_black_list_patterns':
+        return _get_word_black_list_patterns()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 #
 # SIMPLE NLP
 #
@@ -284,36 +622,93 @@ def to_lemmas(text):
     # TODO: Option to leave hypens in tact?
     # TODO: Some of this stuff should be optional.
     # TODO: Change name to lemmatize.
-    # TODO: This should share code with tokenize.
-    nlp_model = get_minimal_model()
+    return _doc_to_lemmas(parse_cache.parse(get_minimal_model(), text.lower()))
+
+
+def to_tokens(text):
+    """Convert words in `text` to a string of tokens."""
+    return _doc_to_tokens(parse_cache.parse(get_minimal_model(), text))
+
+
+def iter_lemmas(name_text_pairs, batch_size=1000, n_process=1):
+    """
+    Convert a corpus to strings of lemmas using `nlp.pipe`.
+    
+    Args:
+        name_text_pairs (Iterable[Tuple[str, str]]): (name, text) pairs.
+        batch_size (int): The number of texts to parse per batch.
+        n_process (int): The number of processes to parse with.
+    
+    Yields:
+        Tuple[str, str]: The name and `to_lemmas` output of each text,
+            in input order.
+    
+    """
+    texts = ((text.lower(), name) for name, text in name_text_pairs)
+    docs = parse_cache.pipe(get_minimal_model(), texts, as_tuples=True, 
+                            batch_size=batch_size, n_process=n_process)
+    for doc, name in docs:
+        yield name, _doc_to_lemmas(doc)
+
+
+def iter_tokens(name_text_pairs, batch_size=1000, n_process=1):
+    """
+    Convert a corpus to strings of tokens using `nlp.pipe`.
+    
+    Args:
+        name_text_pairs (Iterable[Tuple[str, str]]): (name, text) pairs.
+        batch_size (int): The number of texts to parse per batch.
+        n_process (int): The number of processes to parse with.
+    
+    Yields:
+        Tuple[str, str]: The name and `to_tokens` output of each text,
+            in input order.
+    
+    """
+    texts = ((text, name) for name, text in name_text_pairs)
+    docs = parse_cache.pipe(get_minimal_model(), texts, as_tuples=True, 
+                            batch_size=batch_size, n_process=n_process)
+    for doc, name in docs:
+        yield name, _doc_to_tokens(doc)
+
+
+@instrumentation.timed('transforms.doc_to_lemmas')
+def _doc_to_lemmas(doc):
+    """
+    Return the lemmas of the plain words in `doc` as a string.
+    
+    Tokens without a lemma, e.g. from the minimal model, which has no
+    lemmatizer, are lower cased instead.
+    
+    """
     lemmas = []
-    text = text.lower()
-    for token in nlp_model(text):
-        if (token.is_ascii 
+    for token in doc:
+        if (_is_short_ascii(token, max_length=14)
                 and not token.is_punct 
                 and not token.is_stop 
                 and not token.is_digit
-                and token.text.strip() 
-                and len(token.text) < 15):
-            lemmas.append(token.lemma_.strip())
+                and token.text.strip()):
+            lemmas.append((token.lemma_ or token.lower_).strip())
     return ' '.join(lemmas)
 
 
-def to_tokens(text):
-    """Convert words in `text` to a string of tokens."""
+@instrumentation.timed('transforms.doc_to_tokens')
+def _doc_to_tokens(doc):
+    """Return the words and basic punctuation in `doc` as a string."""
     tokens = []
-    allowed_punct = set('.?!,')
-    nlp_model = get_minimal_model()
-    for token in nlp_model(text):
-        if ((token.is_punct and token.text not in allowed_punct)
-                or len(token.text) > 15
-                or not token.is_ascii
-                or token.text == ' '):
-            continue
-        tokens.append(token.text)
+    for token in doc:
+        if (_is_short_ascii(token, max_length=15)
+                and not (token.is_punct and token.text not in _ALLOWED_PUNCT)
+                and token.text != ' '):
+            tokens.append(token.text)
     return ' '.join(tokens)
 
 
+def _is_short_ascii(token, max_length):
+    """Return true if the token is ASCII and at most `max_length` long."""
+    return token.is_ascii and len(token.text) <= max_length
+
+
 def get_polarity(text):
     """Get average pos/neg polarity of a string."""
     from textblob import TextBlob
@@ -324,27 +719,220 @@ def get_polarity(text):
 #
 # NLP MODEL MANAGMENT
 #
+# The models are loaded on first use and kept in `_model_cache` until 
+# they're released or evicted to fit `_model_memory_budget`. The word
+# vectors of a model are saved to a .npy file in the data directory the
+# first time it's loaded, and every later load memory maps that file 
+# instead of reading the vectors into memory. So all of the processes 
+# using a model, forked or spawned, share a single copy of its vectors
+# in the page cache.
+#
+
+
+VECTORS_DIR_NAME = 'spacy_vectors'
+
+_model_configs = {
+    'minimal': {'name': 'en_core_web_sm', 'exclude': _MINIMAL_MODEL_EXCLUDED},
+    'large': {'name': 'en_core_web_lg', 'exclude': []},
+}
+_model_sizes = {}
+_model_memory_budget = None
 
 
 def get_minimal_model():
-    """Return a spacy model without parsing, tagging, or ner."""
-    if 'minimal' not in _model_cache:
-        _model_cache['minimal'] = spacy.load(
-            'en_core_web_sm', 
-            disable=['parser', 'tagger', 'ner']
-        )
-    return _model_cache['minimal']
+    """Return a spacy model that only tokenizes."""
+    return get_model('minimal')
 
 
 def get_large_model():
     """Return the large spacy model everything turned on."""
-    if 'large' not in _model_cache:
-        nlp = spacy.load('en_core_web_lg')
+    return get_model('large')
+
+
+def get_model(kind):
+    """
+    Return the 'minimal' or 'large' spacy model, loading it if needed.
+    
+    Loading a model may evict the least recently used other models to
+    keep within the budget set with `set_model_memory_budget`.
+    
+    """
+    if kind in _model_cache:
+        # Keep the cache in least recently used order.
+        _model_cache[kind] = _model_cache.pop(kind)
+        return _model_cache[kind]
+    
+    nlp = _load_model(_model_configs[kind])
+    if kind == 'large':
         # Due to a bug, this language model doesn't contain
         # stop words, so we fix that here.
         for word in nlp.Defaults.stop_words:
             lex = nlp.vocab[word]
             lex.is_stop = True
-        _model_cache['large'] = nlp
+    _model_sizes[kind] = _get_model_size(nlp)
+    _model_cache[kind] = nlp
+    _evict_models(keep=kind)
+    return nlp
+
+
+def configure_model(kind, name=None, exclude=None):
+    """
+    Change the spacy package or components used for a kind of model.
     
-    return _model_cache['large']
+    A loaded model of that kind is released, so the next call to 
+    `get_model` loads the new configuration.
+    
+    Args:
+        kind (str): 'minimal' or 'large'.
+        name (str): The name of the spacy package to load.
+        exclude (List[str]): The names of the pipeline components not 
+            to load.
+    
+    """
+    config = dict(_model_configs.get(kind, {}))
+    if name is not None:
+        config['name'] = name
+    if exclude is not None:
+        config['exclude'] = list(exclude)
+    _model_configs[kind] = config
+    release_model(kind)
+
+
+def preload_models(kinds=('minimal', 'large'), warm_up=True):
+    """
+    Load models ahead of time, e.g. before forking worker processes.
+    
+    If `warm_up` is true, each model also parses a short text, which 
+    initializes state spacy otherwise sets up on the first call, and 
+    reads its memory mapped vectors into the page cache.
+    
+    """
+    for kind in kinds:
+        nlp = get_model(kind)
+        if warm_up:
+            nlp('This is a short text to warm up the model.')
+            vectors = nlp.vocab.vectors.data
+            if len(vectors):
+                # Touch one value per page.
+                step = max(4096 // vectors.itemsize // vectors.shape[1], 1)
+                vectors[::step].sum()
+
+
+def set_model_memory_budget(max_bytes):
+    """
+    Limit the memory used by loaded models in this process.
+    
+    When loading a model would exceed the budget, the least recently 
+    used other models are released. Memory mapped vectors are shared 
+    with other processes, so they don't count towards the budget. None
+    removes the limit.
+    
+    """
+    global _model_memory_budget
+    _model_memory_budget = max_bytes
+    _evict_models()
+
+
+def release_model(kind):
+    """Remove a model from the cache so that it can be freed."""
+    _model_cache.pop(kind, None)
+    _model_sizes.pop(kind, None)
+
+
+def _load_model(config):
+    """Load a spacy model with its vectors memory mapped."""
+    import spacy
+    name = config['name']
+    vectors_path = _get_vectors_path(name)
+    shared = all(os.path.isfile(vectors_path + suffix) for suffix in ('', '.keys.npy', '.json'))
+    exclude = list(config['exclude']) + (['vectors'] if shared else [])
+    nlp = spacy.load(name, exclude=exclude)
+    # Newer versions of spacy load components that are disabled by 
+    # default anyway, so remove them to save memory and keep `nlp.pipe`
+    # from shipping them to worker processes.
+    for pipe_name in list(getattr(nlp, 'disabled', [])):
+        nlp.remove_pipe(pipe_name)
+    
+    if not shared:
+        if not _save_vectors(nlp.vocab.vectors, vectors_path):
+            return nlp
+    nlp.vocab.vectors = _load_vectors(vectors_path)
+    return nlp
+
+
+def _get_vectors_path(name):
+    """Return the path of the shared vectors of a spacy package or model directory."""
+    import spacy
+    if os.path.isdir(name):
+        meta = spacy.util.get_model_meta(name)
+        name, version = f"{meta['lang']}_{meta['name']}", meta['version']
+    else:
+        version = spacy.util.get_package_version(name)
+    return os.path.join(utils.data_dir_path, VECTORS_DIR_NAME, f'{name}-{version}.npy')
+
+
+def _save_vectors(vectors, path):
+    """Save a model's vectors to be memory mapped, returning false if they can't be."""
+    import numpy as np
+    if not len(vectors.data) or getattr(vectors, 'mode', 'default') != 'default':
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    keys, rows = zip(*vectors.key2row.items()) if vectors.key2row else ((), ())
+    # Several processes may load the model at once, so each writes to 
+    # its own temporary files.
+    temp_path = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(temp_path, np.asarray(vectors.data))
+    np.save(temp_path + '.keys.npy', np.array([keys, rows], dtype=np.uint64))
+    with open(temp_path + '.json', 'w', encoding='utf-8') as f:
+        json.dump({'name': vectors.name, 'mode': vectors.mode, 'attr': vectors.attr}, f)
+    os.replace(temp_path + '.json', path + '.json')
+    os.replace(temp_path + '.keys.npy', path + '.keys.npy')
+    os.replace(temp_path, path)
+    return True
+
+
+def _load_vectors(path):
+    """Return spacy vectors backed by a memory mapped file saved by `_save_vectors`."""
+    import numpy as np
+    from spacy.vectors import Vectors
+    data = np.load(path, mmap_mode='r')
+    keys, rows = np.load(path + '.keys.npy')
+    with open(path + '.json', encoding='utf-8') as f:
+        settings = json.load(f)
+    vectors = Vectors(data=data, **settings)
+    for key, row in zip(keys.tolist(), rows.tolist()):
+        vectors.add(key, row=row)
+    return vectors
+
+
+def _get_model_size(nlp):
+    """
+    Estimate the memory a model uses that isn't shared with other processes.
+    
+    This is the size of the loaded components' files on disk, which is 
+    close to the size of their weights, plus the size of the vectors if
+    they aren't memory mapped.
+    
+    """
+    import numpy as np
+    size = 0
+    if nlp.path is not None:
+        for pipe_name in nlp.pipe_names:
+            for dir_path, _, file_names in os.walk(os.path.join(nlp.path, pipe_name)):
+                size += sum(os.path.getsize(os.path.join(dir_path, file_name)) 
+                            for file_name in file_names)
+    vectors = nlp.vocab.vectors.data
+    if not isinstance(vectors, np.memmap):
+        size += vectors.nbytes
+    return size
+
+
+def _evict_models(keep=None):
+    """Release the least recently used models until the loaded models fit the budget."""
+    if _model_memory_budget is None:
+        return
+    for kind in list(_model_cache):
+        if sum(_model_sizes.get(k, 0) for k in _model_cache) <= _model_memory_budget:
+            return
+        if kind != keep:
+            release_model(kind)
@@ -3,10 +3,13 @@ This module contains utilities used by other modules or notebooks.
 
 """
 
+import collections
+import functools
+import gzip
 import os
+import pickle
 from glob import glob
 import re
-import joblib
 
 
 data_dir_path = os.path.join(os.path.dirname(__file__), 'data')
@@ -15,13 +18,79 @@ archived_data_dir_path = os.path.join(data_dir_path, 'archived')
 
 def matches_patterns(patterns, text, flags=re.IGNORECASE):
     """Return true if the matches any of the given patterns."""
-    # TODO: This would probably be more efficient if you
-    # joined all these patterns together and did a single searc.
-    for pattern in patterns:
-        match = re.search(pattern, text, flags=flags)
-        if match is not None:
-            return True
-    return False
+    return compile_patterns(patterns, flags=flags).search(text) is not None
+
+
+def compile_patterns(patterns, flags=re.IGNORECASE, prefix='', suffix=''):
+    """
+    Compile a list of patterns into a single regex that matches any of them.
+    
+    The compiled regexes are cached, so calling this repeatedly with the 
+    same patterns is cheap. Note that the patterns are joined into one 
+    alternation, so they can't use numbered back references.
+    
+    Args:
+        patterns (List[str]): The patterns to combine.
+        flags (int): The flags used to compile the regex.
+        prefix (str): An optional pattern that has to precede all of 
+            the patterns. Pulling a shared literal prefix out of the 
+            alternation lets the regex engine skip ahead to it.
+        suffix (str): An optional pattern that has to follow all of
+            the patterns.
+    
+    Returns:
+        re.Pattern: The compiled regex.
+    
+    """
+    return _compile_patterns(tuple(patterns), flags, prefix, suffix)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_patterns(patterns, flags, prefix, suffix):
+    """Compile and cache the combined regex for `compile_patterns`."""
+    if not patterns:
+        # An empty alternation would match everything.
+        return re.compile(r'(?!)')
+    alternation = '|'.join(f'(?:{pattern})' for pattern in patterns)
+    return re.compile(f'{prefix}(?:{alternation}){suffix}', flags=flags)
+
+
+def imap_in_order(func, tasks, workers, initializer=None, initargs=(), pool=None):
+    """
+    Yield `func(task)` for each task, computed by a pool of workers.
+    
+    The results are yielded in the order of the tasks. Only a few tasks
+    are kept in flight per worker so that a slow consumer doesn't cause
+    the results to pile up in memory.
+    
+    Args:
+        func (Callable): A picklable function of one task.
+        tasks (Iterable): The tasks. These are consumed lazily.
+        workers (int): The number of worker processes.
+        initializer (Callable): An optional function each worker calls
+            when it starts, e.g. to load a model.
+        initargs (tuple): The arguments to `initializer`.
+        pool (multiprocessing.pool.Pool): An existing pool of `workers`
+            processes to use instead of starting one, in which case 
+            `initializer` and `initargs` are ignored. It's left open.
+    
+    """
+    if pool is not None:
+        yield from _imap_in_order(pool, func, tasks, workers)
+        return
+    import multiprocessing
+    with multiprocessing.Pool(workers, initializer=initializer, initargs=initargs) as pool:
+        yield from _imap_in_order(pool, func, tasks, workers)
+
+
+def _imap_in_order(pool, func, tasks, workers):
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= 2 * workers:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
 
 def load_values(file_name):
@@ -45,6 +114,7 @@ def load_values(file_name):
          
 def load_data(file_name):
     """Load a pickled file from the local data directory."""
+    import joblib
     load_path = os.path.join(data_dir_path, file_name)
     data = joblib.load(load_path)
     return data
@@ -52,11 +122,55 @@ def load_data(file_name):
 
 def save_data(data, file_name, compress=3):
     """Pickle data and save it in the local data directory."""
+    import joblib
     path = os.path.join(data_dir_path, file_name)
     archive_data(file_name)
     joblib.dump(data, path, compress=compress)
 
 
+def save_records(records, file_name):
+    """
+    Save an iterable of records to a record stream in the data directory.
+    
+    Unlike `save_data`, the records are pickled one at a time into a 
+    gzipped file, so they never all have to be in memory, and 
+    `iter_records` can read back the first few without reading the 
+    rest. An existing file with the same name is archived.
+    
+    Args:
+        records (Iterable[Any]): The records to save, typically (name,
+            text) tuples.
+        file_name (str): The name of the file in the data directory.
+    
+    Returns:
+        int: The number of records saved.
+    
+    """
+    path = os.path.join(data_dir_path, file_name)
+    temp_path = path + '.tmp'
+    num_records = 0
+    with gzip.open(temp_path, 'wb', compresslevel=3) as f:
+        for record in records:
+            pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            num_records += 1
+    archive_data(file_name)
+    os.replace(temp_path, path)
+    return num_records
+
+
+def iter_records(file_name, limit=None):
+    """Yield the records in a record stream saved with `save_records`."""
+    path = os.path.join(data_dir_path, file_name)
+    with gzip.open(path, 'rb') as f:
+        num_records = 0
+        while limit is None or num_records < limit:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+            num_records += 1
+
+
 def archive_data(file_name):
     """Move a file in the data folder to the archive folder if the file exists."""
     if '/' in file_name:
@@ -69,6 +183,14 @@ def archive_data(file_name):
     if not os.path.isfile(old_path):
         return
     
+    os.rename(old_path, get_archive_path(file_name))
+
+
+def get_archive_path(file_name):
+    """Return the path of the next archived version of a file in the data folder."""
+    if '/' in file_name:
+        raise ValueError('`file_name` should be a file name, not a path.')
+    
     # If there's already a file with this name (sans version number)
     # in the folder, then use that file's name to extract the current
     # version number. Otherwise go with the default of 0.
@@ -82,10 +204,8 @@ def archive_data(file_name):
         last_version_str = re.search(pattern, last_version).group(0)
         last_version_num = int(last_version_str)
     
-    # Create a new file name with the incremented version number
-    # and move it to the archive.
+    # Create a new file name with the incremented version number.
     new_version_num = last_version_num + 1
     new_version_str = f'{new_version_num:0>3g}'
     new_file_name = just_name + '_' + new_version_str + extension
-    new_path = os.path.join(archived_data_dir_path, new_file_name)
-    os.rename(old_path, new_path)
+    return os.path.join(archived_data_dir_path, new_file_name)
@@ -1,16 +1,135 @@
+from . import checkpoints
+from . import instrumentation
 from . import utils
-from bs4 import BeautifulSoup
 import bz2
+import collections
+import functools
+import hashlib
+import io
+import itertools
+import json
 import re
 import os
-import joblib
+import sqlite3
 from . import transforms
 
 
-DUMP_PATH = '/Users/nbeshouri/Downloads/enwiki-20180520-pages-articles.xml.bz2'
+# The dump can be set with the HWTF_DUMP_PATH environment variable, or 
+# by assigning to `DUMP_PATH` (e.g. to point at a synthetic dump made 
+# with `fixtures.make_synthetic_dump`).
+DUMP_PATH = os.environ.get(
+    'HWTF_DUMP_PATH', '/Users/nbeshouri/Downloads/enwiki-20180520-pages-articles.xml.bz2'
+)
 
- 
-def get_article_iterator():
+# Multistream dumps (enwiki-*-pages-articles-multistream.xml.bz2) are
+# a concatenation of independent bz2 streams of ~100 pages each. They
+# ship with an index of stream offsets, but if it's missing we can
+# find the stream boundaries by scanning for bz2 stream headers.
+_STREAM_HEADER_PATTERN = re.compile(rb'BZh[1-9]1AY&SY')
+_STREAMS_PER_CHUNK = 20
+_SCAN_BLOCK_SIZE = 2 ** 24
+_MULTISTREAM_PROBE_SIZE = 2 ** 24
+
+PageRecord = collections.namedtuple('PageRecord', ['title', 'ns', 'redirect', 'text'])
+
+DUMP_INDEX_FILE_NAME = 'dump_index.sqlite'
+_CATEGORY_LINK_PATTERN = re.compile(r'\[\[Category:([^\]\n]*)\]\]')
+
+
+def get_article_iterator(workers=None):
+    """
+    Return a generator that yields the raw XML for each article.
+    
+    If `DUMP_PATH` is a multistream dump, its streams are decompressed
+    and split into pages by a pool of worker processes. Otherwise the
+    dump is read line by line on a single core. In both cases the 
+    articles are yielded in dump order.
+    
+    Args:
+        workers (int): The number of worker processes to use. Defaults
+            to the number of cores. Pass 1 to force a single core read.
+    
+    Yields:
+        str: The raw XML of a single <page> node.
+    
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    
+    offsets = get_stream_offsets() if workers > 1 else []
+    if len(offsets) < 2:
+        articles = _get_serial_article_iterator()
+    else:
+        chunks = _get_stream_chunks(offsets)
+        articles = itertools.chain.from_iterable(
+            utils.imap_in_order(_read_chunk_articles, chunks, workers)
+        )
+    yield from instrumentation.time_iterator('wikipedia.read_pages', articles, len)
+
+
+def get_stream_offsets():
+    """
+    Return the sorted byte offsets of the bz2 streams in the dump.
+    
+    The offsets are read from the multistream index if it sits next to
+    the dump (enwiki-*-multistream-index.txt.bz2). Otherwise they're
+    found by scanning the dump for stream headers. A dump that isn't
+    a multistream dump only contains a single stream at offset 0, 
+    which is assumed if no second stream starts within the first 
+    `_MULTISTREAM_PROBE_SIZE` bytes. The offsets are cached per dump
+    path and size.
+    
+    """
+    offsets = _get_stream_offsets(os.path.abspath(DUMP_PATH), os.path.getsize(DUMP_PATH))
+    return list(offsets)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_stream_offsets(dump_path, dump_size):
+    """Return the stream offsets of the dump at `dump_path` as a tuple."""
+    index_path = _get_index_path(dump_path)
+    if os.path.isfile(index_path):
+        offsets = set()
+        with bz2.open(index_path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                # Each line has the format offset:page_id:title.
+                offsets.add(int(line.split(':', 1)[0]))
+        return tuple(sorted(offsets))
+    
+    offsets = []
+    overlap = 9  # The header pattern is 10 bytes long.
+    with open(dump_path, 'rb') as f:
+        block_start = 0
+        tail = b''
+        while True:
+            block = f.read(_SCAN_BLOCK_SIZE)
+            if not block:
+                break
+            data = tail + block
+            data_start = block_start - len(tail)
+            for match in _STREAM_HEADER_PATTERN.finditer(data):
+                offset = data_start + match.start()
+                if not offsets or offset > offsets[-1]:
+                    offsets.append(offset)
+            tail = data[-overlap:]
+            block_start += len(block)
+            # The streams of a multistream dump are well under a MB 
+            # each, so a dump without a second stream near the start
+            # is a single stream dump.
+            if len(offsets) < 2 and block_start >= _MULTISTREAM_PROBE_SIZE:
+                break
+    return tuple(offsets)
+
+
+def _get_index_path(dump_path=None):
+    """Return the path where the dump's multistream index would be."""
+    root, extension = os.path.splitext(dump_path or DUMP_PATH)
+    if extension == '.bz2':
+        root, extension = os.path.splitext(root)
+    return root + '-index.txt.bz2'
+
+
+def _get_serial_article_iterator():
     """Return a generator that yields the raw XML for each article."""
     with bz2.open(DUMP_PATH, 'rt', encoding='utf-8') as f:
         article_lines = None
@@ -29,7 +148,150 @@ def get_article_iterator():
             if '</page>' in line:            
                 yield ''.join(article_lines)
                 article_lines = None
-                
+
+
+def _get_stream_chunks(offsets):
+    """
+    Group the streams into chunks of (path, stream offsets, end offset).
+    
+    The chunks are large enough to amortize the cost of shipping the 
+    work to (and the pages back from) the worker processes.
+    
+    """
+    offsets = offsets + [os.path.getsize(DUMP_PATH)]
+    chunks = []
+    for i in range(0, len(offsets) - 1, _STREAMS_PER_CHUNK):
+        stream_offsets = offsets[i:i + _STREAMS_PER_CHUNK]
+        end = offsets[min(i + _STREAMS_PER_CHUNK, len(offsets) - 1)]
+        chunks.append((DUMP_PATH, stream_offsets, end))
+    return chunks
+
+
+def _read_stream_bytes(path, start, end):
+    """Read the compressed bytes between `start` and `end`."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+def _read_chunk_articles(chunk):
+    """Decompress a chunk of streams and return its articles."""
+    path, stream_offsets, end = chunk
+    compressed = _read_stream_bytes(path, stream_offsets[0], end)
+    # bz2.decompress handles concatenated streams.
+    data = bz2.decompress(compressed)
+    return [data[s:e].decode('utf-8') for s, e in _split_pages(data)]
+
+
+def _split_pages(data):
+    """
+    Yield the (start, end) offsets of each <page> node in `data`.
+    
+    The offsets are expanded to whole lines so that the articles match
+    the ones produced by the line by line reader.
+    
+    """
+    start = data.find(b'<page>')
+    while start != -1:
+        end = data.find(b'</page>', start)
+        if end == -1:
+            break
+        line_start = data.rfind(b'\n', 0, start) + 1
+        line_end = data.find(b'\n', end)
+        line_end = len(data) if line_end == -1 else line_end + 1
+        yield line_start, line_end
+        start = data.find(b'<page>', line_end)
+
+
+
+def get_page_record_iterator(workers=None):
+    """
+    Return a generator that yields a `PageRecord` for each article.
+    
+    The records are parsed straight from the decompressed dump with 
+    lxml's iterparse, and each <page> node is cleared once its record 
+    has been created, so memory use stays flat. Like 
+    `get_article_iterator`, multistream dumps are decompressed and 
+    parsed by a pool of worker processes.
+    
+    Args:
+        workers (int): The number of worker processes to use. Defaults
+            to the number of cores. Pass 1 to force a single core read.
+    
+    Yields:
+        PageRecord: The title, namespace, redirect flag, and Wikitext 
+            of a single page.
+    
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    
+    offsets = get_stream_offsets() if workers > 1 else []
+    if len(offsets) < 2:
+        with bz2.open(DUMP_PATH, 'rb') as f:
+            records = _iter_page_records(f)
+            yield from instrumentation.time_iterator('wikipedia.read_records', records, 
+                                                     _get_record_size)
+        return
+    
+    chunks = _get_stream_chunks(offsets)
+    records = itertools.chain.from_iterable(
+        utils.imap_in_order(_read_chunk_records, chunks, workers)
+    )
+    yield from instrumentation.time_iterator('wikipedia.read_records', records, _get_record_size)
+
+
+def _get_record_size(record):
+    """Return the length of a `PageRecord`'s text, for instrumentation."""
+    return len(record.text)
+
+
+def _read_chunk_records(chunk):
+    """Decompress a chunk of streams and return its page records."""
+    path, stream_offsets, end = chunk
+    data = bz2.decompress(_read_stream_bytes(path, stream_offsets[0], end))
+    
+    # The first and last streams contain the dump's opening and 
+    # closing tags, so only parse the span that holds whole pages, 
+    # wrapped in a root node.
+    start = data.find(b'<page>')
+    end = data.rfind(b'</page>')
+    if start == -1 or end == -1:
+        return []
+    end += len(b'</page>')
+    source = io.BytesIO(b''.join([b'<pages>', data[start:end], b'</pages>']))
+    return list(_iter_page_records(source))
+
+
+def _iter_page_records(source):
+    """Yield a `PageRecord` for each <page> node in an XML file object."""
+    from lxml import etree
+    pages = etree.iterparse(source, events=('end',), tag='{*}page', huge_tree=True)
+    for _, page in pages:
+        yield _page_to_record(page)
+        # Free the page and any siblings that came before it.
+        page.clear()
+        while page.getprevious() is not None:
+            del page.getparent()[0]
+
+
+def _parse_page(raw_page):
+    """Return a `PageRecord` for the raw XML bytes of a single page."""
+    from lxml import etree
+    parser = etree.XMLParser(huge_tree=True)
+    return _page_to_record(etree.fromstring(raw_page, parser))
+
+
+def _page_to_record(page):
+    """Create a `PageRecord` from a parsed <page> element."""
+    # The namespace of the tags depends on whether the page was parsed
+    # as part of the whole dump, hence the {*} wildcards.
+    return PageRecord(
+        title=page.findtext('{*}title'),
+        ns=int(page.findtext('{*}ns', default=0)),
+        redirect=page.find('{*}redirect') is not None,
+        text=page.findtext('{*}revision/{*}text', default='') 
+    )                
 
 def get_pages_with_category(category_patterns, title_black_list=None, limit=None):
     """
@@ -48,7 +310,176 @@ def get_pages_with_category(category_patterns, title_black_list=None, limit=None
             text. Note that this text is still in Wikitext markup.
     
     """
+    query = {
+        'category_patterns': category_patterns, 
+        'title_black_list': title_black_list, 
+        'limit': limit
+    }
+    return get_pages_with_categories({'pages': query})['pages']
+
+
+def get_pages_with_categories(queries, checkpoint_name=None, resume=True, progress_hook=None):
+    """
+    Run several category queries in a single pass over the dump.
+    
+    Args:
+        queries (Dict[str, dict]): A dictionary mapping query names to 
+            dicts with a `category_patterns` key and optional 
+            `title_black_list` and `limit` keys. These have the same
+            meaning as the arguments to `get_pages_with_category`.
+        checkpoint_name (str): If given, the pages found are saved to a
+            `checkpoints.Checkpoint` as the scan goes, and a scan that
+            was interrupted picks up where the last checkpoint left 
+            off. The checkpoint is named after this and a hash of the
+            queries and the dump's path and size, so a scan is never
+            resumed from one with different inputs. It's deleted once 
+            the scan finishes.
+        resume (bool): Whether to resume from an existing checkpoint.
+        progress_hook (Callable[[dict], Any]): The progress hook. See
+            `checkpoints.Progress`.
+        
+    Returns:
+        Dict[str, Dict[str, str]]: A dictionary mapping each query name
+            to a dictionary mapping from article titles to article text.
+            The pass over the dump ends as soon as every query has
+            reached its limit.
+    
+    """
+    results = {name: {} for name in queries}
+    checkpoint = None
+    pages_scanned = 0
+    if checkpoint_name is not None:
+        checkpoint = checkpoints.Checkpoint(_get_scan_checkpoint_name(checkpoint_name, queries), 
+                                            resume=resume)
+        for (name, title), text in checkpoint.results.items():
+            results[name][title] = text
+        pages_scanned = checkpoint.state or 0
+    
+    matches = iter_pages_with_categories(
+        queries, 
+        start=pages_scanned, 
+        counts={name: len(title_to_page) for name, title_to_page in results.items()},
+        progress_hook=progress_hook
+    )
+    # A page that matches several queries is yielded once per query, so
+    # its matches are checkpointed together. Otherwise a shard could be
+    # saved between them, and a resumed scan would skip the page.
+    for pages_scanned, page_matches in itertools.groupby(matches, key=lambda match: match[3]):
+        page_results = [((name, title), text) for name, title, text, _ in page_matches]
+        for (name, title), text in page_results:
+            results[name][title] = text
+        if checkpoint is not None:
+            checkpoint.add_many(page_results, state=pages_scanned)
+    
+    if checkpoint is not None:
+        checkpoint.delete()
+            
+    return results
+
+
+def iter_pages_with_categories(queries, start=0, counts=None, progress_hook=None):
+    """
+    Lazily run several category queries in a single pass over the dump.
+    
+    Args:
+        queries (Dict[str, dict]): The queries. See 
+            `get_pages_with_categories`.
+        start (int): The number of pages at the start of the dump to 
+            skip, e.g. because an earlier scan already matched them.
+        counts (Dict[str, int]): The number of pages each query has 
+            already matched. These count towards the query limits.
+        progress_hook (Callable[[dict], Any]): The progress hook. See
+            `checkpoints.Progress`.
+    
+    Yields:
+        Tuple[str, str, str, int]: The query name, title, and text of
+            each matching page, and the number of pages scanned so far.
+            A page that matches several queries is yielded once per
+            query. The scan ends as soon as every query has reached its
+            limit.
+    
+    """
+    # Convert each query to a (black list, category matcher, limit) tuple.
+    query_specs = {}
+    for name, query in queries.items():
+        query_specs[name] = (
+            utils.compile_patterns(_get_title_black_list(query.get('title_black_list'))),
+            _get_category_matcher(query['category_patterns']),
+            query.get('limit')
+        )
+    
+    counts = dict(counts or {})
+    for name in queries:
+        counts.setdefault(name, 0)
+    unfilled = [name for name in queries 
+                if query_specs[name][2] is None or counts[name] < query_specs[name][2]]
+    if not unfilled:
+        return
+    
+    progress = checkpoints.Progress('Pages scanned', hook=progress_hook, initial=start)
+    pages_scanned = start
+    
+    # The pages before `start` still have to be read, but they aren't 
+    # matched again.
+    records = itertools.islice(get_page_record_iterator(), start, None)
+    
+    for title, _, redirect, text in records:
+        pages_scanned += 1
+        progress.update(num_bytes=len(text), last=title)
+        
+        # Continue if article is a redirect.
+        if redirect:
+            continue
+        
+        for name in list(unfilled):
+            black_list, category_matcher, limit = query_specs[name]
+        
+            # Continue if the title is black listed.    
+            if black_list.search(title):
+                continue
+            
+            # Continue if the article doesn't match any category patterns.
+            if not category_matcher.search(text):
+                continue
+            
+            counts[name] += 1
+            if limit is not None and counts[name] == limit:
+                unfilled.remove(name)
+            
+            yield name, title, text, pages_scanned
+        
+        if not unfilled:
+            break
+    
+    progress.finish()
+
+
+def _get_scan_checkpoint_name(checkpoint_name, queries):
+    """
+    Return `checkpoint_name` followed by a hash of a scan's inputs.
+    
+    These are the queries, with their full title black lists, and the
+    path and size of the dump.
     
+    """
+    key = {
+        'queries': {
+            name: {
+                'category_patterns': list(query['category_patterns']),
+                'title_black_list': _get_title_black_list(query.get('title_black_list')),
+                'limit': query.get('limit')
+            }
+            for name, query in queries.items()
+        },
+        'dump_path': os.path.abspath(DUMP_PATH),
+        'dump_size': os.path.getsize(DUMP_PATH)
+    }
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    return f'{checkpoint_name}-{digest[:16]}'
+
+
+def _get_title_black_list(title_black_list=None):
+    """Return the default title black list extended with `title_black_list`."""
     black_list = [
         '(disabiguation)', 
         'List of', 
@@ -61,89 +492,467 @@ def get_pages_with_category(category_patterns, title_black_list=None, limit=None
     if title_black_list is not None:
         black_list += title_black_list
     
-    category_patterns = [r'\[Category:' + pattern + r'\]' for pattern in category_patterns]
+    return black_list
+
+
+def _get_category_matcher(category_patterns):
+    """Return a compiled regex that matches links to the given categories."""
+    return utils.compile_patterns(category_patterns, prefix=r'\[Category:', suffix=r'\]')
+
+
+#
+# DUMP INDEX
+#
+
+
+def build_dump_index(file_name=DUMP_INDEX_FILE_NAME, workers=None, progress_hook=None):
+    """
+    Index the title, location, and categories of every page in the dump.
     
-    # Collect all non-black listed non-redirect articles.
-    title_to_page = {}
+    This is a one time full pass over the dump that saves an SQLite 
+    database to the data directory. Once it exists, category queries 
+    can be run with `get_pages_with_category_from_index` which only
+    decompresses the streams that hold matching pages. It requires a
+    multistream dump because the rest can't be randomly accessed.
     
-    for raw_article in get_article_iterator():
-        title = re.search(r'<title>(.+)</title>', raw_article).group(1)
-        
-        # Continue if the title is black listed.    
-        if utils.matches_patterns(black_list, title):
-            continue
-                
-        # Continue if article is a redirect.
-        if '<redirect>' in raw_article:
-            continue
+    Args:
+        file_name (str): The name of the index in the data directory.
+        workers (int): The number of worker processes to use. Defaults
+            to the number of cores.
+        progress_hook (Callable[[dict], Any]): The progress hook. See
+            `checkpoints.Progress`.
+    
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    
+    offsets = get_stream_offsets()
+    if len(offsets) < 2:
+        raise ValueError('`DUMP_PATH` must point at a multistream dump.')
+    
+    path = os.path.join(utils.data_dir_path, file_name)
+    utils.archive_data(file_name)
+    
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute(
+            'CREATE TABLE pages (title TEXT, redirect INTEGER, stream_offset INTEGER, '
+            'stream_size INTEGER, page_start INTEGER, page_end INTEGER, categories TEXT)'
+        )
+        conn.executemany('INSERT INTO meta VALUES (?, ?)', [
+            ('dump_path', DUMP_PATH), 
+            ('dump_size', str(os.path.getsize(DUMP_PATH)))
+        ])
         
-        # Continue if the article doesn't match any category patterns.
-        if not utils.matches_patterns(category_patterns, raw_article):
-            continue
+        chunks = _get_stream_chunks(offsets)
+        if workers > 1:
+            results = utils.imap_in_order(_index_chunk, chunks, workers)
+        else:
+            results = map(_index_chunk, chunks)
         
-        # Use bs4 to extract the article's text from the XML.                 
-        soup = BeautifulSoup(raw_article, 'lxml')
-        text_node = soup.find('text')
-        article_text = text_node.get_text()
-        title_to_page[title] = article_text
+        # Progress is counted in chunks since their number is known up 
+        # front, with the compressed bytes as the byte count.
+        progress = checkpoints.Progress('Dump chunks indexed', total=len(chunks), 
+                                        hook=progress_hook)
+        num_pages = 0
+        for (_, stream_offsets, end), rows in zip(chunks, results):
+            conn.executemany('INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            num_pages += len(rows)
+            progress.update(num_bytes=end - stream_offsets[0], last=f'{num_pages} pages')
+        conn.commit()
+        progress.finish()
+    finally:
+        conn.close()
 
-        if len(title_to_page) % 100 == 0:
-            print('Articles found:', len(title_to_page), 'Last title:', title)
+
+def get_pages_with_category_from_index(category_patterns, title_black_list=None, 
+                                       limit=None, file_name=DUMP_INDEX_FILE_NAME):
+    """
+    Get a dict of articles whose categories match the supplied patterns.
+    
+    This is the same as `get_pages_with_category` except that the 
+    titles and categories are matched against the index created by
+    `build_dump_index` and only the streams that contain matching 
+    articles are decompressed. Note that the patterns are matched
+    against each category link separately.
+    
+    Args:
+        category_patterns (List[str]): A list of patterns used to select
+            articles. Only articles with these patterns will be returned.
+        title_black_list (List[str]): An optional list of patterns used 
+            to exclude articles based on their title.
+        limit (int): An optional limit on the number of articles 
+            to return.
+        file_name (str): The name of the index in the data directory.
+        
+    Returns:
+        Dict[str, str]: A dictionary mapping from article titles article
+            text. Note that this text is still in Wikitext markup.
+    
+    """
+    black_list = utils.compile_patterns(_get_title_black_list(title_black_list))
+    category_matcher = _get_category_matcher(category_patterns)
+    
+    path = os.path.join(utils.data_dir_path, file_name)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f'No dump index at {path}, run `build_dump_index` first.')
+    
+    conn = sqlite3.connect(path)
+    try:
+        meta = dict(conn.execute('SELECT key, value FROM meta'))
+        if meta['dump_path'] != DUMP_PATH or int(meta['dump_size']) != os.path.getsize(DUMP_PATH):
+            raise ValueError('The dump index was built from a different dump.')
+        
+        rows = conn.execute(
+            'SELECT title, stream_offset, stream_size, page_start, page_end, categories '
+            'FROM pages WHERE redirect = 0 AND categories != \'\' ORDER BY rowid'
+        )
+        
+        # Find the locations of the matching pages (in dump order).
+        matches = []
+        for title, stream_offset, stream_size, page_start, page_end, categories in rows:
+            if black_list.search(title):
+                continue
+            category_links = '\n'.join(f'[Category:{c}]' for c in categories.split('\n'))
+            if not category_matcher.search(category_links):
+                continue
+            matches.append((title, stream_offset, stream_size, page_start, page_end))
+            if limit is not None and len(matches) == limit:
+                break
+    finally:
+        conn.close()
+    
+    # Decompress each stream that holds a match once.
+    title_to_page = {}
+    last_stream_offset = None
+    for title, stream_offset, stream_size, page_start, page_end in matches:
+        if stream_offset != last_stream_offset:
+            compressed = _read_stream_bytes(DUMP_PATH, stream_offset, stream_offset + stream_size)
+            data = bz2.decompress(compressed)
+            last_stream_offset = stream_offset
+        title_to_page[title] = _parse_page(data[page_start:page_end]).text
         
-        if limit is not None and len(title_to_page) == limit:
-            break
-            
     return title_to_page
 
 
+def _index_chunk(chunk):
+    """Return the index rows for the pages in a chunk of streams."""
+    path, stream_offsets, end = chunk
+    start = stream_offsets[0]
+    compressed = _read_stream_bytes(path, start, end)
+    rows = []
+    stream_ends = stream_offsets[1:] + [end]
+    for stream_offset, stream_end in zip(stream_offsets, stream_ends):
+        data = bz2.decompress(compressed[stream_offset - start:stream_end - start])
+        for page_start, page_end in _split_pages(data):
+            title, _, redirect, text = _parse_page(data[page_start:page_end])
+            categories = '\n'.join(_CATEGORY_LINK_PATTERN.findall(text))
+            rows.append((title, redirect, stream_offset, stream_end - stream_offset, 
+                         page_start, page_end, categories))
+    return rows
+
+
+#
+# WIKITEXT STRIPPING
+#
+
+
+# de_wiki applies the same passes as the original regexes, in the same
+# order, since removing one kind of markup can bring together the 
+# pieces of another. But each pass is a single left to right scan that
+# stops as soon as no later match is possible, where `re.sub` would 
+# retry the pattern at every later position, so each pass takes linear
+# time even when a construct is never closed.
+_REF_OPEN = re.compile(r'<ref', re.IGNORECASE)
+_REF_CLOSE = re.compile(r'</ref>', re.IGNORECASE)
+_COMMENT_OPEN = re.compile(r'<!--')
+_COMMENT_CLOSE = re.compile(r'-->')
+_FILE_OPEN = re.compile(r'\[\[File:', re.IGNORECASE)
+_LINE_END = re.compile(r'\n')
+_BRACE = re.compile(r'[{}]')
+_TABLE_OPEN = re.compile(r'\{\|')
+_TABLE_CLOSE = re.compile(r'\|\}')
+_TAG_OPEN = re.compile(r'<\w+>')
+_TAG_CLOSE = re.compile(r'</\w+>')
+# The patterns below spell ={2,10} and ={2,} as == followed by more =,
+# so that the regex engine can skip ahead to the next ==.
+_TRAILING_SECTION = re.compile(
+    r'==={0,8} ((See also)|(Notes)|(Sources)|(References)|(Bibliography)) ={2,10}', 
+    re.IGNORECASE
+)
+_SECTION_NAME = re.compile(r'==+.*?==+')
+_DE_WIKI_SUBS = [
+    (re.compile(r"'''(.+?)'''"), r'\1'),
+    (re.compile(r"''(.+?)''"), r"\1"),
+    (re.compile(r"<nowiki>(.+?)</nowiki>"), r"\1"), 
+    # The same as \n+, but faster.
+    (re.compile(r'\n\n+|\n'), '\n\n'),
+    (re.compile(r'  '), ' '),
+    (re.compile(r'&nbsp;'), ' ')
+]
+
+
 def de_wiki(text, remove_section_names=False):
-    """Remove most of the Wikitext meta-text."""
+    """
+    Remove most of the Wikitext meta-text.
+    
+    Refs, templates (including nested ones), comments, file links, 
+    tables, and HTML-like tags are removed, links are replaced by their 
+    text, and everything after the See also, Notes, Sources, 
+    References, or Bibliography sections is dropped. 
+    
+    The output is the same as the original regex passes (kept as 
+    `benchmarks._de_wiki_regex`) with one exception: templates are 
+    removed however deeply they're nested, where the original repeated
+    its template pass three times and so left the outer levels of 
+    templates nested more than three deep, e.g. `{{a|{{b|{{c|{{d}}}}}}}}`
+    became `{{a|}}`. Templates that only form once the ones inside them
+    are removed count as a level, e.g. the `{{ b}}` left by `{{{a}}{ b}}`.
+    
+    Args:
+        text (str): An article's Wikitext.
+        remove_section_names (bool): Whether to also remove the 
+            section headings.
+    
+    Returns:
+        str: The remaining text.
+    
+    """
     # TODO: The casting section shouldn't be dumped if its the main section.
     # TODO: Some of the {{...}} elements contain content e.g.
     # {{c.|lk=no|1100}} and {{nihongo|'''Prince Zuko'''|祖寇|Zǔ Kòu}}.
+    with instrumentation.timer('wikipedia.de_wiki', num_bytes=len(text)):
+        text = _remove_spans(text, _REF_OPEN, _REF_CLOSE)
+        text = _remove_templates(text)
+        text = _remove_spans(text, _COMMENT_OPEN, _COMMENT_CLOSE)
+        # File links run up to (but not including) the end of the line.
+        text = _remove_spans(text, _FILE_OPEN, _LINE_END, min_length=1, keep_closer=True)
+        text = _remove_spans(text, _TABLE_OPEN, _TABLE_CLOSE)
+        text = _remove_spans(text, _TAG_OPEN, _TAG_CLOSE)
+        
+        # Drop everything after the trailing sections.
+        trailing_section = _TRAILING_SECTION.search(text)
+        if trailing_section is not None:
+            text = text[:trailing_section.start()]
+        
+        if remove_section_names:
+            text = _SECTION_NAME.sub('', text)
+        
+        text = _replace_unpiped_links(text)
+        text = _replace_piped_links(text)
+        
+        with instrumentation.timer('wikipedia.de_wiki.subs', num_bytes=len(text)):
+            for pattern, replacement in _DE_WIKI_SUBS:
+                text = pattern.sub(replacement, text)
+
+    return text.strip()
+
+
+def _remove_spans(text, opener, closer, min_length=0, keep_closer=False):
+    """
+    Remove each span from an `opener` match to the next `closer` match.
     
-    patterns_to_remove = [
-        r'\<ref.*?\</ref\>', 
-        r'{{[^{]+?}}', 
-        r'{{[^{]+?}}',  # HACK: Repeat pattern for nested versions that sometimes appear.
-        r'{{[^{]+?}}',
-        r'<!--.*?-->',  # These are Comments in Wikitext.
-        r'\[\[File:.+?(?=\n)',
-        r'{\|.*?\|}',
-        r'<\w+>.*?</\w+>',
-        r'={2,10} ((See also)|(Notes)|(Sources)|(References)|(Bibliography)) ={2,10}.*',
-    ]
+    This is `re.sub(opener + '.{min_length,}?' + closer, '', text)` with
+    DOTALL, except that the closer is kept if `keep_closer` is true (as
+    if it were a lookahead).
+    
+    """
+    output = []
+    pos = 0
+    while True:
+        start = opener.search(text, pos)
+        if start is None:
+            break
+        end = closer.search(text, start.end() + min_length)
+        # If this opener is never closed, no later one is either.
+        if end is None:
+            break
+        output.append(text[pos:start.start()])
+        pos = end.start() if keep_closer else end.end()
+    output.append(text[pos:])
+    return ''.join(output)
 
-    for pattern in patterns_to_remove:
-        text = re.sub(pattern, '', text, flags=(re.MULTILINE | re.DOTALL | re.IGNORECASE))
-    
-    if remove_section_names:
-        text = re.sub(r'={2,}.*?={2,}', '', text)
-    
-    patterns_to_sub = [
-        (r'\[\[([^|]+?)\]\]', r'\1'),
-        (r'\[\[(.+?)\|(.+?)\]\]', r'\2'), 
-        (r"'''(.+?)'''", r'\1'),
-        (r"''(.+?)''", r"\1"),
-        (r"<nowiki>(.+?)</nowiki>", r"\1"), 
-        (r'\n+', r'\n\n'),
-        (r'  ', ' '),
-        (r'&nbsp;', ' ')
-    ]
 
-    for pattern, replacement in patterns_to_sub:
-        text = re.sub(pattern, replacement, text)
+def _remove_templates(text):
+    """
+    Remove {{templates}}, however deeply they're nested.
+    
+    This gives the same result as repeating `re.sub(r'{{[^{]+?}}', '', text)`
+    until nothing changes. Templates are rarely nested deeply, so like 
+    the original, up to three passes remove the innermost templates, 
+    and only if that isn't enough is the rest removed by a scan that 
+    tracks the nesting.
+    
+    """
+    for _ in range(3):
+        text, removed = _remove_innermost_templates(text)
+        if not removed:
+            return text
+    return _remove_nested_templates(text)
+
 
-    return text.strip()        
+def _remove_innermost_templates(text):
+    """
+    Remove the templates that don't contain braces.
+    
+    This is `re.sub(r'{{[^{]+?}}', '', text)`.
+    
+    Returns:
+        Tuple[str, bool]: The text and whether anything was removed.
+    
+    """
+    output = []
+    pos = 0
+    search = 0
+    closer = -1
+    while True:
+        start = text.find('{{', search)
+        if start == -1:
+            break
+        # Templates can't be empty, so the closer starts at least one 
+        # character in, e.g. }}} closes with the last two.
+        if closer < start + 3:
+            closer = text.find('}}', start + 3)
+            if closer == -1:
+                break
+        brace = text.find('{', start + 2, closer)
+        if brace != -1:
+            # Any template that starts before the brace contains it.
+            search = brace - 1
+            continue
+        output.append(text[pos:start])
+        pos = search = closer + 2
+    if not output:
+        return text, False
+    output.append(text[pos:])
+    return ''.join(output), True
+
+
+def _remove_nested_templates(text):
+    """
+    Remove {{templates}} at any depth in a single scan.
     
+    Each brace is pushed onto the output on its own, and a template is
+    popped off as soon as its closing braces arrive, which gives the
+    same result as `_remove_templates`.
     
-def extract_phrases_about_subject(name_to_article, limit=None):
+    """
+    output = []
+    open_braces = []  # The indices of the { in `output`.
+    pos = 0
+    for match in _BRACE.finditer(text):
+        i = match.start()
+        if i > pos:
+            output.append(text[pos:i])
+        pos = i + 1
+        if text[i] == '{':
+            open_braces.append(len(output))
+            output.append('{')
+            continue
+        # A second } closes the template that starts at the last {{, as
+        # long as there's something between them. Templates can't be 
+        # empty, so e.g. {{}}} closes with the last two.
+        if output and output[-1] == '}' and open_braces:
+            start = open_braces[-1]
+            if start > 0 and output[start - 1] == '{' and len(output) - 1 > start + 1:
+                del output[start - 1:]
+                del open_braces[-2:]
+                continue
+        output.append('}')
+    output.append(text[pos:])
+    return ''.join(output)
+
+
+def _replace_unpiped_links(text):
+    """
+    Replace each [[target]] with its target.
+    
+    This is `re.sub(r'\\[\\[([^|]+?)\\]\\]', r'\\1', text)`, which can 
+    span lines.
+    
+    """
+    output = []
+    pos = 0
+    search = 0
+    closer = -1
+    while True:
+        start = text.find('[[', search)
+        if start == -1:
+            break
+        if closer < start + 3:
+            closer = text.find(']]', start + 3)
+            if closer == -1:
+                break
+        pipe = text.find('|', start + 2, closer)
+        if pipe != -1:
+            # Any link that starts before the pipe contains it.
+            search = pipe + 1
+            continue
+        output.append(text[pos:start])
+        output.append(text[start + 2:closer])
+        pos = search = closer + 2
+    output.append(text[pos:])
+    return ''.join(output)
+
+
+def _replace_piped_links(text):
+    """
+    Replace each [[target|label]] with its label.
+    
+    This is `re.sub(r'\\[\\[(.+?)\\|(.+?)\\]\\]', r'\\2', text)`, which 
+    can't span lines. The target runs to the first pipe and the label 
+    to the next ]], which can be the end of a later link.
+    
+    """
+    output = []
+    pos = 0
+    search = 0
+    line_end = -1
+    while True:
+        start = text.find('[[', search)
+        if start == -1:
+            break
+        if line_end < start:
+            line_end = text.find('\n', start)
+            if line_end == -1:
+                line_end = len(text)
+        pipe = text.find('|', start + 3, line_end)
+        closer = -1 if pipe == -1 else text.find(']]', pipe + 2, line_end)
+        if closer == -1:
+            # No link that starts later on this line can be closed either.
+            search = line_end + 1
+            continue
+        output.append(text[pos:start])
+        output.append(text[pipe + 1:closer])
+        pos = search = closer + 2
+    output.append(text[pos:])
+    return ''.join(output)
+    
+
+
+def extract_phrases_about_subject(name_to_article, limit=None, batch_size=1000, n_process=1,
+                                  checkpoint_name=None, resume=True, progress_hook=None):
     """
     Convert raw articles to extracted strings about the article's subject.
     
+    The paragraphs of all the articles are streamed through the large
+    spacy model's `pipe` method and the parsed paragraphs are routed
+    back to their articles.
+    
     Args:
         name_to_article (Dict[str, str]): A dictionary mapping character
             names to their articles.
+        limit (int): The maximum number of articles to process.
+        batch_size (int): The number of paragraphs spacy parses per batch.
+        n_process (int): The number of processes spacy parses with.
+        checkpoint_name (str): If given, the finished articles are saved
+            to a `checkpoints.Checkpoint` with this name, and articles
+            in an existing checkpoint are skipped. The checkpoint is 
+            deleted once every article has been processed.
+        resume (bool): Whether to resume from an existing checkpoint.
+        progress_hook (Callable[[dict], Any]): The progress hook. See
+            `checkpoints.Progress`.
     
     Returns:
         tokenized_sents (Dict[str, str]): A dictionary mapping article
@@ -157,52 +966,116 @@ def extract_phrases_about_subject(name_to_article, limit=None):
             
     """
     
+    checkpoint = None
+    if checkpoint_name is not None:
+        checkpoint = checkpoints.Checkpoint(checkpoint_name, resume=resume)
+    
+    # Articles in the checkpoint (and those past the limit) are dropped
+    # here, but the output keeps the order of `name_to_article`.
+    article_names = list(name_to_article)
+    if limit is not None:
+        article_names = article_names[:limit]
+    done = dict(checkpoint.results) if checkpoint is not None else {}
+    remaining = {name: name_to_article[name] for name in article_names if name not in done}
+    
+    phrases = iter_phrases_about_subject(
+        remaining.items(), 
+        batch_size=batch_size, 
+        n_process=n_process,
+        progress_hook=progress_hook,
+        total=len(remaining)
+    )
+    for article_name, tokenized, lemmatized in phrases:
+        done[article_name] = (tokenized, lemmatized)
+        if checkpoint is not None:
+            checkpoint.add(article_name, (tokenized, lemmatized))
+    
+    if checkpoint is not None:
+        checkpoint.delete()
+    
     tokenized_articles = {}
     lemmatized_articles = {}
+    for article_name in article_names:
+        tokenized, lemmatized = done[article_name]
+        tokenized_articles[article_name] = tokenized
+        lemmatized_articles[article_name] = lemmatized
+    
+    return tokenized_articles, lemmatized_articles
 
-    for article_name, text in name_to_article.items():
-        character_name = re.sub(r'\(.*\)', '', article_name)
-        text = de_wiki(text, remove_section_names=True)
+
+def iter_phrases_about_subject(name_article_pairs, batch_size=1000, n_process=1, 
+                               progress_hook=None, total=None):
+    """
+    Lazily convert raw articles to extracted strings about their subject.
+    
+    This is the generator behind `extract_phrases_about_subject`.
+    
+    Args:
+        name_article_pairs (Iterable[Tuple[str, str]]): (name, article)
+            pairs, where the articles are raw Wikitext.
+        batch_size (int): The number of paragraphs spacy parses per batch.
+        n_process (int): The number of processes spacy parses with.
+        progress_hook (Callable[[dict], Any]): The progress hook. See
+            `checkpoints.Progress`.
+        total (int): The number of articles, if known, for the ETA.
+    
+    Yields:
+        Tuple[str, str, str]: The name and the tokenized and lemmatized
+            phrases of each article, in input order.
+    
+    """
+    progress = checkpoints.Progress('Articles processed', total=total, hook=progress_hook)
+    tokenized_sents = []
+    lemmatized_sents = []
+    
+    paragraphs = _iter_subject_paragraphs(name_article_pairs)
+    subject_tokens_iterator = transforms.iter_subject_tokens(
+        paragraphs, 
+        batch_size=batch_size, 
+        n_process=n_process
+    )
+    
+    for subject_tokens, (article_name, character_name, article_size) in subject_tokens_iterator:
+        if article_size is not None:
+            yield article_name, ' '.join(tokenized_sents), ' '.join(lemmatized_sents)
+            tokenized_sents = []
+            lemmatized_sents = []
+            progress.update(num_bytes=article_size, last=article_name)
+            continue
         
-        tokenized_sents = []
-        lemmatized_sents = []
-        paragrahs = (p.strip() for p in text.split('\n') if p.strip())
-        
-        for paragraph in paragrahs:
-            # Extract spacy tokens representing mentions of the character.
-            subject_tokens = transforms.get_subject_tokens(paragraph, character_name)
-            for subject_token in subject_tokens:
-                extracted = transforms.extract_phrase(subject_token, character_name)
-                tokenized_sent = transforms.tokens_to_str(
-                    extracted, 
-                    spaces_before_punct=True,
-                    lower_case=True,
-                    remove_numbers=True
-                )
-                tokenized_sents.append(tokenized_sent)
-                lemmatized_sent = transforms.tokens_to_str(
-                    extracted, 
-                    remove_punct=True, 
-                    convert_to_lemmas=True,
-                    remove_stop_words=True,
-                    lower_case=True,
-                    remove_numbers=True
-                )
-                lemmatized_sents.append(lemmatized_sent)
-        
-        tokenized_articles[article_name] = ' '.join(tokenized_sents)
-        lemmatized_articles[article_name] = ' '.join(lemmatized_sents)
-        
-        if len(tokenized_articles) % 100 == 0:
-            print('Processed:', len(tokenized_articles), 'Last:', article_name)
-        
-        if limit is not None and len(tokenized_articles) == limit:
-            break
+        for subject_token in subject_tokens:
+            extracted = transforms.extract_phrase(subject_token, character_name)
+            tokenized_sent, lemmatized_sent = transforms.extracted_phrase_to_strs(extracted)
+            tokenized_sents.append(tokenized_sent)
+            lemmatized_sents.append(lemmatized_sent)
     
-    return tokenized_articles, lemmatized_articles
+    progress.finish()
+
+
+def _iter_subject_paragraphs(name_article_pairs):
+    """
+    Yield the paragraphs of each article for `transforms.iter_subject_tokens`.
+    
+    Each paragraph's context is a (article_name, character_name, 
+    article_size) tuple, where `article_size` is None. An empty 
+    paragraph whose context has the article's size follows the last
+    paragraph of each article, so that articles without paragraphs 
+    still get an entry.
+    
+    """
+    for article_name, text in name_article_pairs:
+        character_name = re.sub(r'\(.*\)', '', article_name)
+        article_size = len(text)
+        text = de_wiki(text, remove_section_names=True)
+        for paragraph in text.split('\n'):
+            paragraph = paragraph.strip()
+            if paragraph:
+                yield paragraph, character_name, (article_name, character_name, None)
+        yield '', character_name, (article_name, character_name, article_size)
         
 
 def sandbox1():
+    import joblib
     file_name = 'character_bios.pickle'
     load_path = os.path.join(data_dir_path, file_name)
     name_to_article = joblib.load(load_path)
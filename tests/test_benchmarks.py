@@ -0,0 +1,34 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from hwtf import benchmarks
+
+
+# The subprocesses import hwtf from the repository, wherever pytest runs.
+_REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run_python(code):
+    result = subprocess.run([sys.executable, '-c', code], cwd=_REPO_PATH,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+
+def test_modules_import_within_budget():
+    problems = _run_python(
+        'import json; from hwtf import benchmarks; print(json.dumps(benchmarks.check_import_time()))'
+    )
+    assert problems == {}
+
+
+@pytest.mark.parametrize('module', ['hwtf.transforms', 'hwtf.data'])
+def test_modules_defer_heavy_imports(module):
+    imported = _run_python(
+        f'import json, sys, {module}; '
+        f'print(json.dumps([m for m in {list(benchmarks.DEFERRED_IMPORTS)!r} if m in sys.modules]))'
+    )
+    assert imported == []
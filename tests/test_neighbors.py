@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from hwtf import neighbors, utils
+from hwtf.neighbors import VectorIndex
+
+
+def _random_vectors(num_vectors, dim=8, seed=0):
+    return np.random.default_rng(seed).normal(size=(num_vectors, dim)).astype(np.float32)
+
+
+def _unit(vectors):
+    vectors = np.atleast_2d(vectors)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _assert_state(index, names, vectors):
+    """Check an index's names, ids, and normalized vectors."""
+    assert len(index) == len(names)
+    assert index.names == list(names)
+    assert index.name_to_id == {name: i for i, name in enumerate(names)}
+    np.testing.assert_allclose(index.vectors, _unit(vectors), atol=1e-6)
+
+
+def test_add_appends_to_the_index():
+    vectors = _random_vectors(10)
+    index = VectorIndex(['a', 'b', 'c'], vectors[:3], use_hnsw=False)
+    for i in range(3, 10):
+        index.add([str(i)], vectors[i:i + 1])
+    _assert_state(index, ['a', 'b', 'c'] + [str(i) for i in range(3, 10)], vectors)
+    np.testing.assert_allclose(index.get_vector('c'), _unit(vectors[2])[0], atol=1e-6)
+
+
+def test_add_replaces_existing_names():
+    vectors = _random_vectors(4)
+    index = VectorIndex(['a', 'b'], vectors[:2], use_hnsw=False)
+    index.add(['b', 'c'], vectors[2:])
+    _assert_state(index, ['a', 'b', 'c'], vectors[[0, 2, 3]])
+    assert index.query(vectors[2], k=1)[0][0] == 'b'
+
+
+@pytest.mark.parametrize('existing', [0, 2])
+def test_add_keeps_the_last_vector_of_repeated_names(existing):
+    vectors = _random_vectors(existing + 3)
+    names = ['x', 'y'][:existing]
+    index = VectorIndex(names, vectors[:existing], use_hnsw=False)
+    index.add(['b', 'b', 'c'], vectors[existing:])
+    _assert_state(index, names + ['b', 'c'],
+                  np.concatenate([vectors[:existing], vectors[existing + 1:]]))
+
+
+def test_add_leaves_the_index_alone_on_errors():
+    vectors = _random_vectors(3)
+    index = VectorIndex(['a', 'b'], vectors[:2], use_hnsw=False)
+    with pytest.raises(ValueError):
+        index.add(['c', 'd'], vectors[2:])
+    with pytest.raises(ValueError):
+        index.add(['c'], _random_vectors(1, dim=4))
+    _assert_state(index, ['a', 'b'], vectors[:2])
+
+
+def test_query_matches_brute_force():
+    vectors = _random_vectors(50)
+    queries = _random_vectors(5, seed=1)
+    index = VectorIndex([str(i) for i in range(50)], vectors, use_hnsw=False)
+    similarities = _unit(queries) @ _unit(vectors).T
+    for result, row in zip(index.query(queries, k=5), similarities):
+        assert [int(name) for name, _ in result] == list(np.argsort(-row)[:5])
+        np.testing.assert_allclose([similarity for _, similarity in result],
+                                   np.sort(row)[::-1][:5], atol=1e-5)
+
+
+def test_save_and_load(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'data_dir_path', str(tmp_path))
+    vectors = _random_vectors(6)
+    index = VectorIndex(['a', 'b', 'c', 'd'], vectors[:4], use_hnsw=False)
+    index.save('index')
+
+    loaded = VectorIndex.load('index', use_hnsw=False)
+    _assert_state(loaded, ['a', 'b', 'c', 'd'], vectors[:4])
+    assert loaded.query(vectors[1], k=2) == index.query(vectors[1], k=2)
+
+    # The memory mapped vectors are copied before they're changed.
+    loaded.add(['b', 'e', 'f'], vectors[[4, 5, 0]])
+    _assert_state(loaded, ['a', 'b', 'c', 'd', 'e', 'f'], vectors[[0, 4, 2, 3, 5, 0]])
+    _assert_state(VectorIndex.load('index', use_hnsw=False), ['a', 'b', 'c', 'd'], vectors[:4])
+
+
+@pytest.mark.skipif(neighbors.hnswlib is None, reason='No hnswlib.')
+def test_hnsw_index_rejects_existing_names():
+    vectors = _random_vectors(3)
+    index = VectorIndex(['a', 'b'], vectors[:2], use_hnsw=True)
+    with pytest.raises(ValueError):
+        index.add(['c', 'a'], vectors[1:])
+    assert index.names == ['a', 'b']
+    assert len(index) == 2
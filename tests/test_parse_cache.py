@@ -0,0 +1,142 @@
+import functools
+import itertools
+import os
+
+import pytest
+
+from hwtf import parse_cache, utils
+
+
+_TEXTS = [f'Zuko chased the Avatar for {i} years.' for i in range(10)]
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    """Give the parse cache its own state and data directory."""
+    pytest.importorskip('spacy')
+    monkeypatch.setattr(utils, 'data_dir_path', str(tmp_path))
+    monkeypatch.setattr(parse_cache, '_caches', {})
+    monkeypatch.setattr(parse_cache, '_read_only', False)
+    monkeypatch.setattr(parse_cache, '_enabled', True)
+    yield tmp_path
+    for cache in parse_cache._caches.values():
+        cache.close()
+
+
+def _make_model(version='0.0.0'):
+    import spacy
+    nlp = spacy.blank('en')
+    nlp.meta['version'] = version
+    ruler = nlp.add_pipe('attribute_ruler')
+    ruler.add([[{'ORTH': 'Zuko'}]], {'LEMMA': 'zuko', 'POS': 'PROPN'})
+    ruler.add([[{'ORTH': 'chased'}]], {'LEMMA': 'chase', 'POS': 'VERB', 'TAG': 'VBD'})
+    return nlp
+
+
+def _forbid_parsing(monkeypatch):
+    """Make parsing raise, so only cached documents can be returned."""
+    def parse(nlp, text):
+        raise AssertionError(f'{text!r} was parsed.')
+    monkeypatch.setattr(parse_cache, '_parse', parse)
+
+
+def _reopen():
+    """Flush the caches and forget them, as if in a new process."""
+    parse_cache.flush()
+    for cache in parse_cache._caches.values():
+        cache.close()
+    parse_cache._caches.clear()
+
+
+def _assert_same_docs(docs, expected_docs):
+    for doc, expected in zip(docs, expected_docs, strict=True):
+        assert [(token.text, token.lemma_, token.pos_, token.tag_) for token in doc] == [
+            (token.text, token.lemma_, token.pos_, token.tag_) for token in expected
+        ]
+
+
+def test_parse_round_trip(cache_dir, monkeypatch):
+    expected = [parse_cache.parse(_make_model(), text) for text in _TEXTS]
+    _reopen()
+    _forbid_parsing(monkeypatch)
+    _assert_same_docs([parse_cache.parse(_make_model(), text) for text in _TEXTS], expected)
+
+
+def test_pipe_round_trip(cache_dir, monkeypatch):
+    nlp = _make_model()
+    texts = [(text, i) for i, text in enumerate(_TEXTS)]
+    expected = list(parse_cache.pipe(nlp, texts[::2], as_tuples=True))
+    _reopen()
+    # The cached texts are replaced with empty strings.
+    docs = list(parse_cache.pipe(_make_model(), texts, as_tuples=True))
+    assert [context for _, context in docs] == list(range(len(_TEXTS)))
+    _assert_same_docs([doc for doc, _ in docs[::2]], [doc for doc, _ in expected])
+    _assert_same_docs([doc for doc, _ in docs], [nlp(text) for text in _TEXTS])
+    assert docs[1][0][1].lemma_ == 'chase'
+
+
+def test_pipe_caches_docs_parsed_by_several_processes(cache_dir, monkeypatch):
+    nlp = _make_model()
+    expected = list(parse_cache.pipe(nlp, _TEXTS, n_process=2, batch_size=2))
+    _reopen()
+    _forbid_parsing(monkeypatch)
+    _assert_same_docs([parse_cache.parse(_make_model(), text) for text in _TEXTS], expected)
+
+
+def test_changing_the_model_invalidates_the_cache(cache_dir, monkeypatch):
+    parse_cache.parse(_make_model(), _TEXTS[0])
+    _reopen()
+    parsed = []
+    monkeypatch.setattr(parse_cache, '_parse', lambda nlp, text: parsed.append(text) or nlp(text))
+    parse_cache.parse(_make_model(version='0.0.1'), _TEXTS[0])
+    nlp = _make_model()
+    nlp.add_pipe('sentencizer', name='other')
+    parse_cache.parse(nlp, _TEXTS[0])
+    assert parsed == [_TEXTS[0]] * 2
+    parse_cache.parse(_make_model(), _TEXTS[0])
+    assert len(parsed) == 2
+
+
+def test_least_recently_used_shards_are_evicted(cache_dir, monkeypatch):
+    monkeypatch.setattr(parse_cache, 'SHARD_SIZE', 2)
+    clock = itertools.count()
+    monkeypatch.setattr(parse_cache.time, 'time', lambda: next(clock))
+    nlp = _make_model()
+    for text in _TEXTS[:6]:
+        parse_cache.parse(nlp, text)
+    cache = parse_cache._get_cache(nlp)
+    shard_sizes = dict(cache.conn.execute('SELECT shard, size FROM shards'))
+    assert sorted(shard_sizes) == [1, 2, 3]
+
+    # Use the first shard, so the second is the least recently used.
+    parse_cache.parse(nlp, _TEXTS[0])
+    monkeypatch.setattr(parse_cache, 'MAX_CACHE_BYTES',
+                        shard_sizes[1] + shard_sizes[3] + max(shard_sizes.values()) + 10)
+    for text in _TEXTS[6:8]:
+        parse_cache.parse(nlp, text)
+    assert sorted(shard for shard, in cache.conn.execute('SELECT shard FROM shards')) == [1, 3, 4]
+    assert sorted(os.listdir(cache.dir_path)) == ['000001.spacy', '000003.spacy',
+                                                  '000004.spacy', 'index.sqlite']
+    assert cache.get(parse_cache._get_key(_TEXTS[2])) is None
+    assert cache.get(parse_cache._get_key(_TEXTS[4])) is not None
+
+
+def _parse_in_worker(texts):
+    nlp = _make_model()
+    return [doc.text for doc in parse_cache.pipe(nlp, texts)]
+
+
+def test_docs_parsed_by_workers_are_cached_by_the_parent(cache_dir, monkeypatch):
+    # The texts repeat across tasks, so some come back more than once.
+    tasks = [_TEXTS[i:i + 4] for i in range(0, len(_TEXTS), 3)]
+    func = functools.partial(parse_cache.run_in_worker, _parse_in_worker)
+    results = utils.imap_in_order(func, tasks, 2, initializer=parse_cache.init_worker)
+    assert list(parse_cache.store_worker_results(results)) == tasks
+    assert not list((cache_dir / parse_cache.PARSE_CACHE_DIR_NAME).glob('*/*.spacy'))
+    # The documents can be read before they're written to disk.
+    _forbid_parsing(monkeypatch)
+    nlp = _make_model()
+    expected = [nlp(text) for text in _TEXTS]
+    _assert_same_docs([parse_cache.parse(nlp, text) for text in _TEXTS], expected)
+    _reopen()
+    _assert_same_docs([parse_cache.parse(_make_model(), text) for text in _TEXTS], expected)
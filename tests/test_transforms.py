@@ -0,0 +1,342 @@
+import itertools
+import os
+import random
+import re
+
+import numpy as np
+import pytest
+
+from hwtf import benchmarks, fixtures, transforms, utils, wikipedia
+
+
+#
+# BLACK LISTED WORDS
+#
+
+
+_HAS_BLACK_LIST = os.path.exists(
+    os.path.join(utils.data_dir_path, 'character_article_word_black_list.csv')
+)
+
+# Word lists that stress the trie, each with the old loop as reference.
+_ADVERSARIAL_WORD_LISTS = {
+    'shared_prefixes': ['abc', 'abd', 'abcde', 'abc d', 'abx y', 'ab'],
+    'prefix_words': ['main', 'main character', 'mainland', 'ma', 'main char', 'character', 'char'],
+    'overlapping_words': ['big deal', 'deal breaker', 'deal', 'breaker big'],
+    'regex_metacharacters': ['c++', 'a.b', 'x|y', '[ab]c', 'colou?r', 'e.g.', 'st. louis', 'a'],
+    'non_word_edges': ['-x-', 'abcd', 'cd', "o'", "'o", 'a--b', 'x, y', 'zzz'],
+    'unicode': ['café', 'naïve', 'über', 'cafés'],
+}
+
+
+def _sort_words(words):
+    return sorted(words, key=lambda x: -len(x))
+
+
+def _random_texts(words, num_texts=3000, seed=0):
+    """Join pieces of `words` and some noise with random separators."""
+    rng = random.Random(seed)
+    pieces = {piece for word in words for piece in re.split(r'(\W)', word) if piece}
+    pieces |= {' ', '-', ',', '.', '\n', 'the', 'x', 'MAIN', 'Character'}
+    pieces = sorted(pieces) + list(words) + [word.upper() for word in words]
+    for _ in range(num_texts):
+        yield ''.join(rng.choice(pieces) + rng.choice(('', ' ', ' '))
+                      for _ in range(rng.randint(1, 12)))
+
+
+def _assert_matches_loop(texts, words, monkeypatch):
+    words = _sort_words(words)
+    patterns = transforms._compile_word_list(words)
+    monkeypatch.setattr(transforms, '_get_word_black_list_patterns', lambda: patterns)
+    for text in texts:
+        expected = benchmarks._remove_black_listed_words_loop(text, words)
+        assert transforms.remove_black_listed_words(text) == expected, text
+
+
+@pytest.mark.skipif(not _HAS_BLACK_LIST, reason='No word black list.')
+def test_remove_black_listed_words_matches_loop_on_articles():
+    articles = fixtures.make_synthetic_articles(200, seed=2).values()
+    for text in [wikipedia.de_wiki(article) for article in articles]:
+        expected = benchmarks._remove_black_listed_words_loop(text)
+        assert transforms.remove_black_listed_words(text) == expected
+
+
+@pytest.mark.skipif(not _HAS_BLACK_LIST, reason='No word black list.')
+def test_remove_black_listed_words_matches_loop_on_random_text(monkeypatch):
+    words = transforms._word_black_list
+    _assert_matches_loop(_random_texts(words), words, monkeypatch)
+
+
+@pytest.mark.parametrize('name', sorted(_ADVERSARIAL_WORD_LISTS))
+def test_remove_black_listed_words_matches_loop_on_adversarial_words(name, monkeypatch):
+    words = _ADVERSARIAL_WORD_LISTS[name]
+    _assert_matches_loop(_random_texts(words), words, monkeypatch)
+
+
+def test_compile_word_list_merges_plain_words():
+    patterns = transforms._compile_word_list(_sort_words(['main', 'main character', 'villain']))
+    assert [pattern.pattern for pattern in patterns] == [r'\b(?:main(?:\ character)?|villain)\b']
+    assert transforms._compile_word_list([]) == []
+
+
+#
+# PARSED DOCS
+#
+
+
+# Words for random docs, with their part of speech.
+_DOC_WORDS = {
+    'Zuko': 'PROPN', 'Prince': 'PROPN', 'Iroh': 'PROPN', 'Azula': 'PROPN', 'Aang': 'NOUN',
+    'he': 'PRON', 'she': 'PRON', 'they': 'PRON', 'it': 'PRON',
+    'the': 'DET', 'a': 'DET', 'fire': 'NOUN', 'nation': 'NOUN', 'years': 'NOUN',
+    'was': 'AUX', 'chased': 'VERB', 'did': 'AUX', 'and': 'CCONJ', 'of': 'ADP', 'across': 'ADP',
+    ',': 'PUNCT', '.': 'PUNCT', ';': 'PUNCT', ':': 'PUNCT', '"': 'PUNCT', '-': 'PUNCT',
+    '(': 'PUNCT', ')': 'PUNCT', "n't": 'PART', "'s": 'PART', '3': 'NUM', 'three': 'NUM',
+}
+_DOC_DEPS = ('nsubj',) * 6 + ('nsubjpass', 'dobj', 'compound', 'case', 'punct', 'amod', 'prep', 'conj')
+# Subjects are made common so that docs often have several of them.
+_SUBJECT_WORDS = ('Zuko', 'Iroh', 'Azula', 'he', 'she')
+_TARGET_NAMES = ('Prince Zuko', 'zuko', 'Iroh of the Fire Nation', 'Azula')
+
+
+def _random_docs(num_docs=300, seed=0):
+    """Yield docs with random words, tags, and dependency trees, one tree per sentence."""
+    spacy = pytest.importorskip('spacy')
+    from spacy.tokens import Doc
+    vocab = spacy.blank('en').vocab
+    rng = random.Random(seed)
+    all_words = sorted(_DOC_WORDS)
+    for _ in range(num_docs):
+        words, heads, deps = [], [], []
+        for _ in range(rng.randint(1, 4)):
+            start = len(words)
+            length = rng.randint(1, 12)
+            words.extend(rng.choice(_SUBJECT_WORDS if rng.random() < 0.3 else all_words) 
+                         for _ in range(length))
+            # Attach each token to a random token that's already in the tree.
+            order = rng.sample(range(start, start + length), length)
+            sentence_heads = {order[0]: order[0]}
+            for i, token in enumerate(order[1:], 1):
+                sentence_heads[token] = rng.choice(order[:i])
+            heads.extend(sentence_heads[i] for i in range(start, start + length))
+            deps.extend('ROOT' if sentence_heads[i] == i else rng.choice(_DOC_DEPS) 
+                        for i in range(start, start + length))
+        yield Doc(vocab, words=words, heads=heads, deps=deps, 
+                  pos=[_DOC_WORDS[word] for word in words],
+                  lemmas=['be' if word == 'was' else word.lower() for word in words])
+
+
+#
+# SUBJECT SELECTION
+#
+
+
+def test_select_subject_tokens_matches_pairwise():
+    for doc in _random_docs():
+        for target_name in _TARGET_NAMES:
+            expected = benchmarks._select_subject_tokens_pairwise(doc, target_name)
+            actual = transforms._select_subject_tokens(doc, target_name)
+            assert [token.i for token in actual] == [token.i for token in expected]
+
+
+def test_select_subject_tokens_on_long_chains():
+    # Every subject hangs off the one before it, which the ancestor 
+    # counts have to walk in one go. Only the first subject, whose head
+    # is the root, is kept.
+    spacy = pytest.importorskip('spacy')
+    from spacy.tokens import Doc
+    words = ['Zuko'] * 3000
+    doc = Doc(spacy.blank('en').vocab, words=words, heads=[max(i - 1, 0) for i in range(3000)],
+              deps=['ROOT'] + ['nsubj'] * 2999, pos=['PROPN'] * 3000)
+    assert [token.i for token in transforms._select_subject_tokens(doc, 'Zuko')] == [1]
+
+
+#
+# PHRASE RENDERING
+#
+
+
+_TOKENS_TO_STR_OPTIONS = ('spaces_before_punct', 'cap_first_word', 'add_period', 
+                          'convert_to_lemmas', 'remove_stop_words', 'remove_punct', 
+                          'lower_case', 'remove_numbers')
+
+
+def _random_phrases(num_phrases=100, seed=0):
+    """Yield lists of tokens and meta-tokens like those `extract_phrase` returns."""
+    rng = random.Random(seed)
+    docs = _random_docs(num_phrases, seed=seed)
+    for i, doc in enumerate(docs):
+        if i % 2:
+            target_name = rng.choice(_TARGET_NAMES)
+            for subject_token in transforms._select_subject_tokens(doc, target_name):
+                yield transforms.extract_phrase(subject_token, target_name)
+        else:
+            meta_tokens = ('<SUBJECT>', '<ENITY>', '.', '')
+            yield [rng.choice(meta_tokens) if rng.random() < 0.2 else token for token in doc]
+
+
+def test_tokens_to_str_matches_original():
+    phrases = [tokens for tokens in _random_phrases() if tokens]
+    for values in itertools.product((False, True), repeat=len(_TOKENS_TO_STR_OPTIONS)):
+        options = dict(zip(_TOKENS_TO_STR_OPTIONS, values))
+        for tokens in phrases:
+            # The original modifies its input, so it gets a copy.
+            expected = benchmarks._tokens_to_str_original(list(tokens), **options)
+            assert transforms.tokens_to_str(tokens, **options) == expected
+
+
+def test_extracted_phrase_to_strs_matches_original():
+    for tokens in _random_phrases(seed=1):
+        if not tokens:
+            continue
+        # The original rendered the same list twice, and the first call
+        # could add a period that the second kept.
+        original_tokens = list(tokens)
+        expected = (
+            benchmarks._tokens_to_str_original(original_tokens, spaces_before_punct=True, 
+                                               lower_case=True, remove_numbers=True),
+            benchmarks._tokens_to_str_original(original_tokens, remove_punct=True, 
+                                               convert_to_lemmas=True, remove_stop_words=True, 
+                                               lower_case=True, remove_numbers=True)
+        )
+        assert transforms.extracted_phrase_to_strs(tokens) == expected
+
+
+def test_render_phrase_renders_option_sets_independently():
+    option_sets = [dict(zip(_TOKENS_TO_STR_OPTIONS[3:], values)) 
+                   for values in itertools.product((False, True), repeat=5)]
+    for tokens in _random_phrases(seed=2):
+        if not tokens:
+            continue
+        phrase = transforms.phrase_from_tokens(tokens)
+        expected = [transforms.render_phrase(phrase, [options])[0] for options in option_sets]
+        assert transforms.render_phrase(phrase, option_sets) == expected
+
+
+#
+# NLP MODEL MANAGEMENT
+#
+
+
+# The components of en_core_web_sm, which the stand-in models below
+# imitate with components that don't need training.
+_SMALL_MODEL_PIPE_NAMES = ('tok2vec', 'tagger', 'parser', 'senter', 'attribute_ruler', 
+                           'lemmatizer', 'ner')
+
+
+@pytest.fixture
+def models(tmp_path, monkeypatch):
+    """Give the model manager its own state and data directory."""
+    pytest.importorskip('spacy')
+    monkeypatch.setattr(utils, 'data_dir_path', str(tmp_path))
+    monkeypatch.setattr(transforms, '_model_configs', 
+                        {kind: dict(config) for kind, config in transforms._model_configs.items()})
+    monkeypatch.setattr(transforms, '_model_cache', {})
+    monkeypatch.setattr(transforms, '_model_sizes', {})
+    monkeypatch.setattr(transforms, '_model_memory_budget', None)
+    return tmp_path
+
+
+def _save_model(path, pipe_names=_SMALL_MODEL_PIPE_NAMES, name='stand_in', num_patterns=0, 
+                vectors=None):
+    """
+    Save a model with the given component names to a directory and return its path.
+    
+    The model also gets an entity ruler with `num_patterns` patterns, 
+    to give it a component with weights on disk, and `vectors`, a dict
+    of word vectors, if they're given.
+    
+    """
+    import spacy
+    from spacy.vectors import Vectors
+    nlp = spacy.blank('en')
+    nlp.meta['name'] = name
+    for pipe_name in pipe_names:
+        nlp.add_pipe('sentencizer', name=pipe_name)
+    if num_patterns:
+        ruler = nlp.add_pipe('entity_ruler')
+        ruler.add_patterns([{'label': 'CHARACTER', 'pattern': f'Character {i}'} 
+                            for i in range(num_patterns)])
+    if vectors:
+        nlp.vocab.vectors = Vectors(strings=nlp.vocab.strings, keys=list(vectors), 
+                                    data=np.array(list(vectors.values())), name=f'{name}_vectors')
+    nlp.to_disk(path)
+    return str(path)
+
+
+def _get_dir_size(path):
+    return sum(os.path.getsize(os.path.join(dir_path, file_name)) 
+               for dir_path, _, file_names in os.walk(path) for file_name in file_names)
+
+
+def test_minimal_model_only_tokenizes(models):
+    transforms.configure_model('minimal', name=_save_model(models / 'sm'))
+    assert transforms.get_minimal_model().pipe_names == []
+    assert transforms.to_tokens('Zuko chased the Avatar, for 3 years!') == (
+        'Zuko chased the Avatar , for 3 years !'
+    )
+    assert transforms.to_lemmas('Zuko chased the Avatar, for 3 years!') == 'zuko chased avatar years'
+
+
+def test_models_are_evicted_to_fit_the_memory_budget(models):
+    transforms.configure_model('minimal', name=_save_model(models / 'sm', num_patterns=500))
+    transforms.configure_model('large', name=_save_model(models / 'lg', (), 'large', num_patterns=1000))
+    minimal = transforms.get_minimal_model()
+    large = transforms.get_large_model()
+    # The sizes are those of the loaded components on disk.
+    assert transforms._model_sizes == {'minimal': _get_dir_size(models / 'sm' / 'entity_ruler'), 
+                                       'large': _get_dir_size(models / 'lg' / 'entity_ruler')}
+    assert 0 < transforms._model_sizes['minimal'] < transforms._model_sizes['large']
+    
+    transforms.set_model_memory_budget(transforms._model_sizes['large'] + 1)
+    assert list(transforms._model_cache) == ['large']
+    assert transforms.get_minimal_model() is not minimal
+    assert list(transforms._model_cache) == ['minimal']
+    transforms.set_model_memory_budget(None)
+    assert transforms.get_large_model() is not large
+    assert list(transforms._model_cache) == ['minimal', 'large']
+
+
+def test_release_model(models):
+    transforms.configure_model('minimal', name=_save_model(models / 'sm', num_patterns=10))
+    minimal = transforms.get_minimal_model()
+    assert transforms.get_minimal_model() is minimal
+    transforms.release_model('minimal')
+    assert 'minimal' not in transforms._model_cache and 'minimal' not in transforms._model_sizes
+    assert transforms.get_minimal_model() is not minimal
+    # Releasing a model that isn't loaded does nothing.
+    transforms.release_model('large')
+
+
+def test_models_reload_with_memory_mapped_vectors(models):
+    vectors = {'zuko': [1, 2, 3], 'iroh': [4, 5, 6], 'azula': [7, 8, 9]}
+    path = _save_model(models / 'lg', (), 'large', num_patterns=10, 
+                       vectors={word: np.array(vector, dtype=np.float32) 
+                                for word, vector in vectors.items()})
+    transforms.configure_model('large', name=path)
+    for _ in range(2):
+        nlp = transforms.get_large_model()
+        assert isinstance(nlp.vocab.vectors.data, np.memmap)
+        assert nlp.vocab.vectors.name == 'large_vectors'
+        for word, vector in vectors.items():
+            assert nlp.vocab[word].vector.tolist() == vector
+        # The shared vectors don't count towards the budget.
+        assert transforms._model_sizes['large'] == _get_dir_size(models / 'lg' / 'entity_ruler')
+        transforms.release_model('large')
+    vectors_path = transforms._get_vectors_path(path)
+    assert os.path.dirname(vectors_path) == str(models / transforms.VECTORS_DIR_NAME)
+    assert os.path.isfile(vectors_path)
+
+
+def test_memory_mapped_vectors_keep_their_settings(models):
+    from spacy.strings import StringStore
+    from spacy.vectors import Vectors
+    vectors = Vectors(strings=StringStore(), data=np.eye(3, dtype=np.float32), 
+                      keys=['Zuko', 'Iroh', 'Azula'], attr='LOWER', name='settings')
+    path = str(models / 'vectors.npy')
+    assert transforms._save_vectors(vectors, path)
+    loaded = transforms._load_vectors(path)
+    assert isinstance(loaded.data, np.memmap)
+    assert (loaded.name, loaded.mode, loaded.attr) == ('settings', 'default', vectors.attr)
+    assert loaded.key2row == vectors.key2row
+    assert np.array_equal(loaded.data, vectors.data)
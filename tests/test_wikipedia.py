@@ -0,0 +1,247 @@
+import bz2
+import io
+import os
+import random
+import sqlite3
+import time
+
+import pytest
+
+from hwtf import benchmarks, checkpoints, fixtures, utils, wikipedia
+from hwtf.wikipedia import de_wiki
+
+
+# Pieces of Wikitext, including unclosed and stray markup, that are
+# joined at random to fuzz `de_wiki`.
+_FRAGMENTS = (
+    '{{', '}}', '{{cite web|url=x}}', '{{a|{{b}}}}', '{{a|{{b|{{c}}}}}}', '{', '}',
+    '<ref>', '</ref>', '<ref name="a">r</ref>', '<ref name=b/>', '<REF>x</Ref>',
+    '<!--', '-->', '<!-- c -->', '[[File:x.jpg|thumb|cap]]', '[[File:', '[[file:y.png]]',
+    '{|', '|}', '{| class="w"\n|a\n|}', '<small>', '</small>', '<br>', '<b>x</b>', '<', '>',
+    '== Early life ==', '=== Sub ===', '== See also ==', '== Notes ==', '=== References ===',
+    '==========', '=', '==', '====', '[[', ']]', '[[Link]]', '[[Target|label]]', '[[a|b|c]]',
+    '[[Image:x.png|thumb|A [[nested]] cap]]', '[', ']', '|', "'''bold'''", "''it''", "'''", "''",
+    '<nowiki>n</nowiki>', '<nowiki>', '\n', '\n\n', ' ', '  ', '&nbsp;', 'word', 'Zuko',
+    'text with words', '.', ',',
+)
+
+
+def _fuzzed_texts(num_texts=4000, max_fragments=25, seed=0):
+    rng = random.Random(seed)
+    for _ in range(num_texts):
+        yield ''.join(rng.choice(_FRAGMENTS) for _ in range(rng.randint(1, max_fragments)))
+
+
+def _assert_matches_regexes(texts, template_passes=3):
+    for text in texts:
+        for remove_section_names in (False, True):
+            expected = benchmarks._de_wiki_regex(text, remove_section_names, template_passes)
+            assert de_wiki(text, remove_section_names) == expected, text
+
+
+def test_de_wiki_matches_regexes_on_regression_corpus():
+    _assert_matches_regexes(benchmarks.DE_WIKI_REGRESSION_CORPUS.values())
+
+
+def test_de_wiki_matches_regexes_on_synthetic_articles():
+    _assert_matches_regexes(fixtures.make_synthetic_articles(500, seed=1).values())
+
+
+def test_de_wiki_matches_regexes_on_fuzzed_text():
+    # The fuzzed text nests templates at random, so it's compared with
+    # the template pass repeated until nothing changes.
+    _assert_matches_regexes(_fuzzed_texts(), template_passes=None)
+
+
+def test_de_wiki_matches_regexes_on_shallow_fuzzed_text():
+    texts = [
+        text for text in _fuzzed_texts(seed=1)
+        if benchmarks._de_wiki_regex(text, template_passes=3)
+        == benchmarks._de_wiki_regex(text, template_passes=None)
+    ]
+    _assert_matches_regexes(texts)
+
+
+@pytest.mark.skipif(not os.path.exists(wikipedia.DUMP_PATH), reason='No Wikipedia dump.')
+def test_de_wiki_matches_regexes_on_dump_articles():
+    records = wikipedia.get_page_record_iterator(workers=1)
+    texts = [record.text for record, _ in zip(records, range(2000)) if record.text]
+    _assert_matches_regexes(texts, template_passes=None)
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('A [[Foo|<!-- x -->]] b [[c|e]] d.', 'A ]] b [[c|e d.'),
+    ("'''[[Foo|{{x}}]]''' b [[c|d]]", ']] b [[c|d'),
+    ('{{a|{{b|{{c|{{d}}}}}}}} x', 'x'),
+    ('{{{a}}{ b}} x', 'x'),
+])
+def test_de_wiki_examples(text, expected):
+    assert de_wiki(text) == expected
+
+
+def test_de_wiki_deep_nesting():
+    assert de_wiki('{{' * 2000) == '{{' * 2000
+    assert de_wiki('x' + '{{a|' * 2000 + '}}' * 2000 + 'y') == 'xy'
+
+
+@pytest.mark.parametrize('piece', [
+    '<b> x ', '<!-- x ', '<ref x ', '{{a ', '[[ x ', '[[x| ', '{| x ', '[[File: x ', '== x ',
+])
+def test_de_wiki_unclosed_markup(piece):
+    # The regexes are quadratic or worse here, so they're only compared
+    # on short repeats.
+    _assert_matches_regexes([piece * 50])
+    start = time.perf_counter()
+    de_wiki(piece * 20000)
+    assert time.perf_counter() - start < 0.5
+
+
+def _use_synthetic_dump(tmp_path, monkeypatch, num_pages=100, seed=0):
+    dump_path = str(tmp_path / f'dump-{num_pages}-{seed}.xml.bz2')
+    fixtures.make_synthetic_dump(dump_path, num_pages=num_pages, seed=seed)
+    monkeypatch.setattr(wikipedia, 'DUMP_PATH', dump_path)
+    monkeypatch.setattr(utils, 'data_dir_path', str(tmp_path))
+    monkeypatch.setattr(checkpoints, '_progress_hook', None)
+    return dump_path
+
+
+@pytest.mark.parametrize('has_index', [True, False])
+def test_parallel_readers_match_serial_readers(has_index, tmp_path, monkeypatch):
+    _use_synthetic_dump(tmp_path, monkeypatch, num_pages=500)
+    offsets = wikipedia.get_stream_offsets()
+    assert len(offsets) == 5
+    if not has_index:
+        os.remove(wikipedia._get_index_path())
+        wikipedia._get_stream_offsets.cache_clear()
+        # The index leaves out the stream with the site info that 
+        # comes before the pages, but the scan finds it.
+        assert wikipedia.get_stream_offsets() == [0] + offsets
+    assert (list(wikipedia.get_article_iterator(workers=2)) 
+            == list(wikipedia.get_article_iterator(workers=1)))
+    assert (list(wikipedia.get_page_record_iterator(workers=2)) 
+            == list(wikipedia.get_page_record_iterator(workers=1)))
+
+
+def test_single_stream_dumps_are_only_probed(tmp_path, monkeypatch):
+    dump_path = _use_synthetic_dump(tmp_path, monkeypatch, num_pages=500)
+    expected = list(wikipedia.get_article_iterator(workers=1))
+    with bz2.open(dump_path, 'rb') as f:
+        data = f.read()
+    single_stream_path = str(tmp_path / 'single.xml.bz2')
+    with open(single_stream_path, 'wb') as f:
+        f.write(bz2.compress(data))
+    monkeypatch.setattr(wikipedia, 'DUMP_PATH', single_stream_path)
+    
+    # Count the bytes read by the scan, which should stop after the probe.
+    bytes_read = 0
+
+    class CountingFile(io.FileIO):
+        def read(self, size=-1):
+            nonlocal bytes_read
+            data = super().read(size)
+            bytes_read += len(data)
+            return data
+
+    monkeypatch.setattr(wikipedia, 'open', CountingFile, raising=False)
+    monkeypatch.setattr(wikipedia, '_SCAN_BLOCK_SIZE', 1024)
+    monkeypatch.setattr(wikipedia, '_MULTISTREAM_PROBE_SIZE', 4096)
+    assert os.path.getsize(single_stream_path) > 8192
+    assert wikipedia.get_stream_offsets() == [0]
+    assert bytes_read == 4096
+    # The offsets are cached.
+    assert wikipedia.get_stream_offsets() == [0]
+    assert bytes_read == 4096
+    assert list(wikipedia.get_article_iterator(workers=2)) == expected
+
+
+def _interrupt_scan(queries, checkpoint_name, monkeypatch, num_saves=3):
+    """Run a scan that saves a shard per result and dies after `num_saves` shards."""
+    init = checkpoints.Checkpoint.__init__
+    save = checkpoints.Checkpoint.save
+    saves = 0
+
+    def init_with_small_shards(self, name, shard_size=1000, resume=True):
+        init(self, name, shard_size=1, resume=resume)
+
+    def save_then_die(self, state=None):
+        nonlocal saves
+        save(self, state)
+        saves += 1
+        if saves == num_saves:
+            raise KeyboardInterrupt
+
+    with monkeypatch.context() as patch:
+        patch.setattr(checkpoints.Checkpoint, '__init__', init_with_small_shards)
+        patch.setattr(checkpoints.Checkpoint, 'save', save_then_die)
+        with pytest.raises(KeyboardInterrupt):
+            wikipedia.get_pages_with_categories(queries, checkpoint_name=checkpoint_name)
+
+
+def test_get_pages_with_categories_resumes_pages_with_several_matches(tmp_path, monkeypatch):
+    _use_synthetic_dump(tmp_path, monkeypatch)
+    # Every page matches both queries.
+    queries = {'a': {'category_patterns': [r'.+']}, 'b': {'category_patterns': [r'.+']}}
+    expected = wikipedia.get_pages_with_categories(queries)
+    _interrupt_scan(queries, 'pages', monkeypatch)
+    assert wikipedia.get_pages_with_categories(queries, checkpoint_name='pages') == expected
+
+
+@pytest.mark.parametrize('change', ['category_patterns', 'title_black_list', 'limit', 'dump'])
+def test_get_pages_with_categories_ignores_checkpoints_with_other_inputs(change, tmp_path, 
+                                                                       monkeypatch):
+    _use_synthetic_dump(tmp_path, monkeypatch)
+    query = {'category_patterns': [r'.+'], 'title_black_list': ['Zzz'], 'limit': 50}
+    _interrupt_scan({'pages': query}, 'pages', monkeypatch, num_saves=10)
+    
+    if change == 'dump':
+        _use_synthetic_dump(tmp_path, monkeypatch, num_pages=120, seed=1)
+    elif change == 'category_patterns':
+        query = {**query, 'category_patterns': [r'[a-m].+']}
+    elif change == 'title_black_list':
+        query = {**query, 'title_black_list': ['[aeiou] ']}
+    else:
+        query = {**query, 'limit': 5}
+    expected = wikipedia.get_pages_with_categories({'pages': query})
+    assert wikipedia.get_pages_with_categories({'pages': query}, checkpoint_name='pages') == expected
+
+
+_INDEX_QUERIES = {
+    'characters': {'category_patterns': [r'.+characters in.+', r'Characters in.+']},
+    'some_shows': {'category_patterns': [r'Fictional characters in (Avatar|Buffy)']},
+    'black_listed': {'category_patterns': [r'.+characters in.+'], 
+                     'title_black_list': [r'^[A-K]', r'\d5$']},
+    'limited': {'category_patterns': [r'.+'], 'title_black_list': [r'^[L-Z]'], 'limit': 20},
+    'everything': {'category_patterns': [r'.+']},
+    'nothing': {'category_patterns': [r'No such category']},
+}
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_index_queries_match_dump_scans(workers, tmp_path, monkeypatch):
+    _use_synthetic_dump(tmp_path, monkeypatch, num_pages=600)
+    wikipedia.build_dump_index(workers=workers)
+    expected = wikipedia.get_pages_with_categories(_INDEX_QUERIES)
+    assert len(expected['characters']) > len(expected['black_listed']) > 0
+    for name, query in _INDEX_QUERIES.items():
+        title_to_page = wikipedia.get_pages_with_category_from_index(**query)
+        assert list(title_to_page.items()) == list(expected[name].items()), name
+
+
+@pytest.mark.parametrize('change', ['dump_path', 'dump_size', 'dump'])
+def test_stale_index_is_rejected(change, tmp_path, monkeypatch):
+    _use_synthetic_dump(tmp_path, monkeypatch, num_pages=300)
+    wikipedia.build_dump_index(workers=1)
+    query = _INDEX_QUERIES['characters']
+    assert wikipedia.get_pages_with_category_from_index(**query)
+    
+    if change == 'dump':
+        _use_synthetic_dump(tmp_path, monkeypatch, num_pages=300, seed=1)
+    else:
+        value = {'dump_path': str(tmp_path / 'other.xml.bz2'), 
+                 'dump_size': str(os.path.getsize(wikipedia.DUMP_PATH) + 1)}[change]
+        conn = sqlite3.connect(tmp_path / wikipedia.DUMP_INDEX_FILE_NAME)
+        with conn:
+            conn.execute('UPDATE meta SET value = ? WHERE key = ?', (value, change))
+        conn.close()
+    with pytest.raises(ValueError):
+        wikipedia.get_pages_with_category_from_index(**query)